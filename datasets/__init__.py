@@ -6,5 +6,6 @@ from .supervised_dataset import *
 #from .instseg_dataset import *
 #from .ordernet_eval_dataset import *
 from .inpaint_dataset import *
+from .synthetic import *
 # from .partial_comp_dataset_nmf import * # we also don't have these?? 
 # from .partial_comp_dataset_predict_order import *
@@ -46,6 +46,10 @@ class PartialCompDataset(Dataset):
         self.border_width = config.get('border_width', 5)
         self.occluded_only = config.get('occluded_only', False)
         self.boundary_label = config.get('boundary_label', False)
+        # rgb of the whole image at a fixed scale (longer side roi_image_size)
+        # and the patch box in it, for backbones that pool the patch features
+        # from the image encoding, as inference.encode_image does (roi inference)
+        self.roi_image_size = config.get('roi_image_size', 0)
 
         self.config = config
 
@@ -89,7 +93,11 @@ class PartialCompDataset(Dataset):
                     print(fn+' image not found in folder')
                     # return Image.open('/aul/homes/byang010/attacking-amodal/COCOA/s_val2014/animal/COCO_val2014_000000000042.jpg').convert('RGB')
 
-    def _get_inst(self, idx, load_rgb=False, randshift=False):
+    def _get_inst(self, idx, load_rgb=False, randshift=False, full_image=False):
+        '''
+        full_image: rgb is (whole image fitted to roi_image_size, patch box
+            x1, y1, x2, y2 in it) instead of the patch crop
+        '''
         print('idx: ', idx)
         modal, bbox, category, imgfn, _ = self.data_reader.get_instance(idx)
         centerx = bbox[0] + bbox[2] / 2.
@@ -97,7 +105,8 @@ class PartialCompDataset(Dataset):
         size = max([np.sqrt(bbox[2] * bbox[3] * self.config['enlarge_box']), bbox[2] * 1.1, bbox[3] * 1.1])
         if size < 5 or np.all(modal == 0):
             return self._get_inst(
-                np.random.choice(len(self)), load_rgb=load_rgb, randshift=randshift)
+                np.random.choice(len(self)), load_rgb=load_rgb, randshift=randshift,
+                full_image=full_image)
 
         # shift & scale aug
         if self.phase  == 'train':
@@ -122,10 +131,18 @@ class PartialCompDataset(Dataset):
             print('about to load image: ', imgfn)
             rgb = np.array(self._load_image(os.path.join(
                 self.config['{}_image_root'.format(self.phase)], imgfn))) # uint8
-            rgb = cv2.resize(utils.crop_padding(rgb, new_bbox, pad_value=(0,0,0)),
-                (self.sz, self.sz), interpolation=cv2.INTER_CUBIC)
-            if flip:
-                rgb = rgb[:, ::-1, :]
+            if full_image:
+                x, y, w, h = new_bbox
+                if flip:
+                    rgb = np.ascontiguousarray(rgb[:, ::-1, :])
+                    x = rgb.shape[1] - x - w
+                rgb, scale = utils.fit_image(rgb, self.roi_image_size)
+                rgb = (rgb, np.array([x, y, x + w, y + h], dtype=np.float32) * scale)
+            else:
+                rgb = cv2.resize(utils.crop_padding(rgb, new_bbox, pad_value=(0,0,0)),
+                    (self.sz, self.sz), interpolation=cv2.INTER_CUBIC)
+                if flip:
+                    rgb = rgb[:, ::-1, :]
 
         if load_rgb:
             return modal, category, rgb
@@ -137,7 +154,10 @@ class PartialCompDataset(Dataset):
             self._init_memcached()
         randidx = np.random.choice(len(self))
         modal, category, rgb = self._get_inst(
-            idx, load_rgb=True, randshift=True) # modal, uint8 {0, 1} # consider not to use shift in our approach
+            idx, load_rgb=True, randshift=True,
+            full_image=self.roi_image_size > 0) # modal, uint8 {0, 1} # consider not to use shift in our approach
+        if self.roi_image_size > 0:
+            rgb, rgb_box = rgb
         if not self.config.get('use_category', True):
             category = 1
 
@@ -193,7 +213,13 @@ class PartialCompDataset(Dataset):
 
         erased_modal = erased_modal.astype(np.float32) * category
         # erase rgb
-        if rgb is not None and self.use_rgb:
+        if rgb is not None and self.use_rgb and self.roi_image_size > 0:
+            # the whole image is encoded once at inference, occluders are
+            # visible there: paste the eraser into the patch box instead of
+            # blacking it out
+            rgb = utils.paste_patch(rgb.astype(np.float64), rgb_box, eraser_rgb, eraser_mask)
+            rgb = self.img_transform(rgb).float() # C x roi_image_size x roi_image_size
+        elif rgb is not None and self.use_rgb:
             if self.use_matting:
                 eraser_mask = eraser_mask[..., None]
                 # rgb = (rgb * 1 - eraser_mask) + eraser_rgb * (eraser_mask)
@@ -216,4 +242,6 @@ class PartialCompDataset(Dataset):
         if self.boundary_label:
             target = torch.stack([target, gt_boundary.long()])
 
+        if self.roi_image_size > 0:
+            return rgb, erased_modal_tensor, eraser_tensor, target, torch.from_numpy(rgb_box)
         return rgb, erased_modal_tensor, eraser_tensor, target
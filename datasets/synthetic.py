@@ -0,0 +1,205 @@
+import os
+import json
+import numpy as np
+import cv2
+from PIL import Image
+import pycocotools.mask as maskUtils
+
+import utils
+
+
+def random_shape(rng, height, width, area):
+    '''
+    a random ellipse, rectangle or polygon of about the given area, HW uint8
+    '''
+    mask = np.zeros((height, width), dtype=np.uint8)
+    size = np.sqrt(area)
+    cx, cy = rng.uniform(0, width), rng.uniform(0, height)
+    kind = rng.randint(3)
+    if kind == 0:
+        axes = (max(int(size * rng.uniform(0.4, 0.8)), 1), max(int(size * rng.uniform(0.4, 0.8)), 1))
+        cv2.ellipse(mask, (int(cx), int(cy)), axes, rng.uniform(0, 180), 0, 360, 1, -1)
+    elif kind == 1:
+        w, h = size * rng.uniform(0.6, 1.4), size * rng.uniform(0.6, 1.4)
+        box = cv2.boxPoints(((cx, cy), (w, h), rng.uniform(0, 90)))
+        cv2.fillPoly(mask, [box.astype(np.int32)], 1)
+    else:
+        num = rng.randint(5, 9)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, num))
+        radius = size * rng.uniform(0.4, 0.8, num)
+        points = np.stack([cx + radius * np.cos(angles), cy + radius * np.sin(angles)], axis=1)
+        cv2.fillPoly(mask, [points.astype(np.int32)], 1)
+    return mask
+
+
+def random_amodal(rng, height, width, num, occlusion):
+    mean_area = 2. * occlusion * height * width / max(num, 1)
+    if num == 0:
+        return np.zeros((0, height, width), dtype=np.uint8)
+    return np.stack([random_shape(rng, height, width, mean_area * rng.uniform(0.3, 1.7))
+                     for _ in range(num)])
+
+
+def visible_masks(amodal):
+    '''
+    modal masks of amodal masks stacked in depth order, later ones in front
+    '''
+    front = np.zeros(amodal.shape[1:], dtype=bool)
+    modal = np.zeros_like(amodal)
+    for i in range(amodal.shape[0] - 1, -1, -1):
+        modal[i] = amodal[i] & ~front
+        front |= amodal[i].astype(bool)
+    return modal
+
+
+def render_scene(rng, amodal):
+    '''
+    shapes painted back to front on noise, HW3 uint8
+    '''
+    height, width = amodal.shape[1:]
+    image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8) // 4 + 96
+    for i in range(amodal.shape[0]):
+        color = rng.randint(0, 256, 3)
+        texture = rng.randint(-24, 25, (height, width, 1))
+        shape = amodal[i].astype(bool)
+        image[shape] = np.clip(color + texture, 0, 255)[shape].astype(np.uint8)
+    return image
+
+
+def random_scene(height=480, width=640, num=8, occlusion=0.5, num_categories=1, min_visible=1,
+                 seed=None):
+    '''
+    A synthetic occlusion scene: num random shapes stacked in depth order,
+    later instances are in front. occlusion (> 0) scales the instances, their
+    amodal areas sum to about 2 * occlusion of the image. Instances with
+    less than min_visible visible pixels are dropped.
+    Returns image (HW3, uint8, shapes painted in depth order on noise),
+    modal, amodal (NHW, uint8), category (N, in [1, num_categories]).
+    '''
+    rng = np.random.RandomState(seed)
+    amodal = random_amodal(rng, height, width, num, occlusion)
+    modal = visible_masks(amodal)
+    category = rng.randint(1, num_categories + 1, num)
+    image = render_scene(rng, amodal)
+    if num == 0:
+        # an empty scene, the noise background only
+        return image, modal, amodal, category
+    keep = modal.reshape(num, -1).sum(axis=1) >= min_visible
+    return image, modal[keep], amodal[keep], category[keep]
+
+
+def mask_polygon(mask):
+    '''
+    largest outer contour of a mask, [x1, y1, x2, y2, ...], None if there is none
+    '''
+    contours = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_SIMPLE)[-2]
+    contours = [c for c in contours if len(c) > 2]
+    if len(contours) == 0:
+        return None
+    contour = max(contours, key=cv2.contourArea)
+    return [float(v) for v in contour.reshape(-1)]
+
+
+def encode_mask(mask):
+    rle = maskUtils.encode(np.asfortranarray(mask.astype(np.uint8)))
+    rle['counts'] = rle['counts'].decode()
+    return rle
+
+
+def scene_annotations(rng, height, width, num, occlusion, num_categories, min_visible):
+    '''
+    A random scene whose amodal masks are exactly the polygons of its
+    annotation. Returns the image and, per kept instance (in depth order,
+    later in front, as in random_scene), the amodal polygon, modal and
+    amodal masks and category, and the occluding pairs (front, back).
+    '''
+    shapes = random_amodal(rng, height, width, num, occlusion)
+    polygons = [p for p in (mask_polygon(m) for m in shapes) if p is not None]
+    if len(polygons) > 0:
+        amodal = np.stack([maskUtils.decode(maskUtils.frPyObjects([p], height, width))[:, :, 0]
+                           for p in polygons])
+    else:
+        amodal = np.zeros((0, height, width), dtype=np.uint8)
+    modal = visible_masks(amodal)
+    image = render_scene(rng, amodal)
+    category = rng.randint(1, num_categories + 1, len(polygons))
+    if len(polygons) == 0:
+        return image, polygons, modal, amodal, category, []
+
+    keep = np.nonzero(modal.reshape(len(polygons), -1).sum(axis=1) >= min_visible)[0]
+    polygons = [polygons[k] for k in keep]
+    modal, amodal, category = modal[keep], amodal[keep], category[keep]
+    # j is in front of i when j > i and their amodal masks overlap
+    flat = amodal.reshape(len(keep), -1).astype(np.float32)
+    overlap = np.triu(np.dot(flat, flat.T) > 0, 1)
+    pairs = [(j, i) for i, j in zip(*np.nonzero(overlap))]
+    return image, polygons, modal, amodal, category, pairs
+
+
+def cocoa_annotation(image_id, polygons, modal, amodal, pairs):
+    num = len(polygons)
+    regions = []
+    for i in range(num):
+        regions.append({
+            'segmentation': polygons[i], 'visible_mask': encode_mask(modal[i]),
+            'area': float(amodal[i].sum()), 'isStuff': 0, 'name': 'thing',
+            'order': num - i, 'occlude_rate': 1. - modal[i].sum() / float(max(amodal[i].sum(), 1))})
+    return {'image_id': image_id, 'id': image_id, 'size': num, 'regions': regions,
+            'depth_constraint': ','.join('{}-{}'.format(f + 1, b + 1) for f, b in pairs)}
+
+
+def kins_annotations(image_id, start_id, polygons, modal, amodal, category):
+    anns = []
+    for i in range(len(polygons)):
+        anns.append({
+            'id': start_id + i, 'image_id': image_id, 'category_id': int(category[i]),
+            'segmentation': [polygons[i]], 'bbox': utils.mask_to_bbox(amodal[i]),
+            'area': float(amodal[i].sum()), 'iscrowd': 0,
+            'inmodal_seg': encode_mask(modal[i]), 'inmodal_bbox': utils.mask_to_bbox(modal[i]),
+            'i_area': float(modal[i].sum())})
+    return anns
+
+
+def write_dataset(root, split, fmt='COCOA', num_images=10, height=480, width=640,
+                  min_instances=2, max_instances=8, occlusion=0.5, num_categories=7,
+                  min_visible=16, seed=None):
+    '''
+    Writes a synthetic amodal dataset readable by reader.COCOADataset
+    (fmt COCOA: regions with visible_mask and depth_constraint) or
+    reader.KINSLVISDataset (fmt KINS: inmodal_seg and segmentation):
+    images to root/split/ and the annotation to root/annotations/split.json.
+    Returns the image root and the annotation file.
+    '''
+    if fmt not in ['COCOA', 'KINS']:
+        raise Exception("No such format: {}".format(fmt))
+    rng = np.random.RandomState(seed)
+    image_root = os.path.join(root, split)
+    annot_file = os.path.join(root, 'annotations', '{}.json'.format(split))
+    for d in [image_root, os.path.dirname(annot_file)]:
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    images, annotations = [], []
+    for image_id in range(1, num_images + 1):
+        num = rng.randint(min_instances, max_instances + 1)
+        image, polygons, modal, amodal, category, pairs = scene_annotations(
+            rng, height, width, num, occlusion, num_categories if fmt == 'KINS' else 1,
+            min_visible)
+        file_name = '{:06d}.png'.format(image_id)
+        Image.fromarray(image).save(os.path.join(image_root, file_name))
+        images.append({'id': image_id, 'file_name': file_name, 'width': width, 'height': height})
+        if fmt == 'COCOA':
+            annotations.append(cocoa_annotation(image_id, polygons, modal, amodal, pairs))
+        else:
+            annotations.extend(kins_annotations(
+                image_id, len(annotations) + 1, polygons, modal, amodal, category))
+
+    if fmt == 'COCOA':
+        categories = [{'supercategory': 'object', 'id': 1, 'name': 'thing'}]
+    else:
+        categories = [{'supercategory': 'object', 'id': c, 'name': 'class{}'.format(c)}
+                      for c in range(1, num_categories + 1)]
+    with open(annot_file, 'w') as f:
+        json.dump({'images': images, 'annotations': annotations, 'categories': categories}, f)
+    return image_root, annot_file
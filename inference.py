@@ -5,6 +5,7 @@ import torch
 import torch.nn as nn
 
 import utils
+from models.backbone import compiled
 import pdb
 from skimage.morphology import convex_hull
 from torch.nn import functional as F
@@ -31,71 +32,361 @@ def get_eraser(inst_ind, idx, bbox, input_size):
     eraser = (eraser == idx + 1)
     return torch.from_numpy(eraser.astype(np.float32)).unsqueeze(0)
 
-def net_forward(model, image, inmodal_patch, eraser, use_rgb, th, args=None, debug=False):
-    if use_rgb:
-        image = args.img_transform(image.astype(np.float32)).unsqueeze(0) # CHW
-        image = image.cuda()
+def model_device(model):
+    '''
+    device of the network wrapped by model (model.model)
+    '''
+    if hasattr(model, 'device'):
+        return model.device
+    return next(model.model.parameters()).device
 
-    inmodal_patch = torch.from_numpy(inmodal_patch.astype(np.float32)).unsqueeze(0).unsqueeze(0).cuda()
+def setup_cpu_inference(model, num_threads=0, channels_last=True):
+    '''
+    Moves the network of model to the CPU for inference, sets the number of
+    intra-op threads (0 keeps the torch default) and optionally switches to
+    channels-last memory format, which to_input then also uses for inputs.
+    '''
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    model.device = torch.device('cpu')
+    model.model.to(model.device)
+    if channels_last:
+        model.model.to(memory_format=torch.channels_last)
+    model.channels_last = channels_last
+    return model
+
+def compile_model(model, mode, example_inputs=None):
+    '''
+    Compiles the backbone of model (after loading its weights and
+    setup_cpu_inference) for inference. mode: a torch.compile backend (e.g.
+    inductor), compiled in place, or torchscript: traced and frozen for the
+    shapes of example_inputs ((x,) or (x, rgb), see
+    models.backbone.compiled.example_inputs), whose spatial size must be the
+    input_size of inference. The traced backbone takes positional inputs
+    only, so roi image features (encode_image) need the eager or
+    torch.compile backbone.
+    '''
+    net = backbone(model)
+    if mode == 'torchscript':
+        if example_inputs is None:
+            raise Exception("torchscript compilation requires example_inputs")
+        inputs = tuple(to_input(x, model) for x in example_inputs)
+        model.model.module = compiled.trace_module(net, inputs, use_rgb=len(inputs) > 1)
+    else:
+        compiled.compile_module(net, backend=mode)
+    return model
 
-    with torch.no_grad():        
-        if eraser is not None:
-            eraser = torch.from_numpy(eraser.astype(np.float32)).unsqueeze(0).unsqueeze(0).cuda()
-            if use_rgb:
-                output = model.model(torch.cat([inmodal_patch, eraser], dim=1), image)
-            else:
-                output = model.model(torch.cat([inmodal_patch, eraser], dim=1))
+def to_input(x, model):
+    '''
+    NCHW array or tensor -> tensor on the device (and memory format) of model
+    '''
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(x)
+    x = x.to(model_device(model))
+    if getattr(model, 'channels_last', False):
+        x = x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+class OnnxNet(object):
+    '''
+    Runs an exported backbone (see tools/export_onnx.py) through ONNX Runtime
+    with the call signature of the torch network: net(mask) or net(mask, rgb),
+    torch tensors in and out (a tuple for networks with several outputs).
+    '''
+    def __init__(self, path, num_threads=0):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [inp.name for inp in self.session.get_inputs()]
+
+    def __call__(self, *inputs):
+        feed = {name: np.ascontiguousarray(x.detach().cpu().numpy())
+                for name, x in zip(self.input_names, inputs)}
+        outputs = [torch.from_numpy(x) for x in self.session.run(None, feed)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+class OnnxEngine(object):
+    '''
+    Stands in for a model in the inference functions (they only use
+    model.model and the device of model), executing on the CPU.
+    '''
+    def __init__(self, path, num_threads=0):
+        self.model = OnnxNet(path, num_threads=num_threads)
+        self.device = torch.device('cpu')
+
+
+def backbone(model):
+    ''' the network wrapped by model.model (DistModule / FixModule) '''
+    return getattr(model.model, 'module', model.model)
+
+def encode_image(model, image, args):
+    '''
+    Runs the image encoder of the backbone (unet2res) once on the whole
+    image (HW3), fitted to the data option roi_image_size the backbone was
+    trained with (see utils.fit_image), so that objects have the scale of
+    training. Pass the result as image_feat to infer_order / infer_amodal,
+    patches then pool their features from it instead of encoding rgb crops.
+    Returns the features and the scale of the image.
+    '''
+    size = args.data.get('roi_image_size', 0)
+    if size <= 0:
+        raise Exception("roi image features need a backbone trained with the data option roi_image_size")
+    image, scale = utils.fit_image(image.astype(np.float32), size)
+    image = to_input(args.img_transform(image).unsqueeze(0), model) # 13SS
+    with torch.inference_mode():
+        return backbone(model).encode_image(image), scale
+
+def roi_input(model, roi, size):
+    '''
+    roi: (encode_image output, xywh box of the patch in the image)
+    -> image features of the patch, pooled as in training (box_image_feat)
+    '''
+    (image_feat, scale), bbox = roi
+    net = backbone(model)
+    box = torch.tensor([[0, bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3]]],
+                       dtype=image_feat.dtype, device=image_feat.device)
+    box[:, 1:] *= scale
+    with torch.inference_mode():
+        return net.roi_image_feat(image_feat, box, size // net.encoder_stride)
+
+def net_forward_prob(model, image, inmodal_patch, eraser, use_rgb, args=None, debug=False,
+                     roi=None):
+    '''
+    Runs the completion network on one patch and returns the foreground
+    probability map (HW, float32) before thresholding, see forward_threshold.
+    With debug, the normalized std map (HW) is returned as well.
+    roi: (image_feat, bbox), pool the image features of the patch from the
+        whole-image encoding instead of encoding image, see encode_image.
+    '''
+    if roi is not None:
+        image = None
+    elif use_rgb and torch.is_tensor(image): # normalized, see PatchCache.rgb_input
+        image = to_input(image.unsqueeze(0), model) # 13HW
+    elif use_rgb:
+        image = to_input(args.img_transform(image.astype(np.float32)).unsqueeze(0), model) # 13HW
+
+    # single float conversion for the stacked mask input
+    if eraser is not None:
+        inputs = np.stack([inmodal_patch, eraser]).astype(np.float32)[np.newaxis] # 12HW
+    else:
+        inputs = inmodal_patch.astype(np.float32)[np.newaxis, np.newaxis] # 11HW
+    inputs = to_input(inputs, model)
+
+    with torch.inference_mode():
+        if roi is not None:
+            output = model.model(inputs, img_feat=roi_input(model, roi, inputs.size(2)))
+        elif use_rgb:
+            output = model.model(inputs, image)
         else:
-            if use_rgb:
-                output = model.model(torch.cat([inmodal_patch], dim=1), image)
-            else:
-                output = model.model(inmodal_patch)
+            output = model.model(inputs)
 
-    output.detach_()
+    prob, std = output_prob(output, args)
+    prob = prob[0].cpu().numpy()
+    if debug:
+        return prob, std[0].cpu().numpy()
+    else:
+        return prob
 
-    std = torch.zeros_like(output[0, 0])
+def output_prob(output, args):
+    '''
+    network output (NCHW) -> foreground probability (NHW) and the normalized
+    std (NHW, zeros unless the gaussian loss is used)
+    '''
+    std = torch.zeros_like(output[:, 0])
 
     if args is not None and args.model['use_std']:
         loss_mode = args.model.get('loss_mode', 'gaussian')
+        prob = output[:, 0].sigmoid()
         if loss_mode == 'gaussian':
-            mean = output[0, 0].sigmoid()
-            # th = 0.5 
-            # for COCOA: 0.5 for infer_amodal, 0.5 for infer_order
-            # for KINS: 0.3 for infer_amodal, 0.4 for infer_order
-            result = (mean > th).cpu().numpy().astype(np.uint8)
             std = F.softplus(output[:, 1:]) + 1e-16
             std = std / (F.adaptive_max_pool2d(std, 1) + 1e-16)
-            std = std[0, 0]
-        else:
-            result = (output[0, 0].sigmoid() > 0.5).cpu().numpy().astype(np.uint8)
-            other = output[0, 1].cpu().numpy()
+            std = std[:, 0]
     else:    
-        # result = output.argmax(1)[0].cpu().numpy().astype(np.uint8)   
-        if args.data['dataset'] == 'KINS': 
-            # for boundary_no_rgb: best th=0.3 for infer_amodal, 0.5 for infer_order
-            # for default_no_rgb: 0.2 for infer_amodal, 0.1 for infer_order
+        if args.data['dataset'] == 'KINS' or args.data['use_default']: 
             output = nn.functional.softmax(output, dim=1)
-            result = (output[0,1,:,:] > th).cpu().numpy().astype(np.uint8)
+            prob = output[:,1,:,:]
         else:
-            if args.data['use_default']:
-                output = nn.functional.softmax(output, dim=1)
-                result = (output[0,1,:,:] > th).cpu().numpy().astype(np.uint8)
+            prob = (output.argmax(1) == 1).float()
+    return prob, std
+
+def net_forward_batch(model, patches, use_rgb, th, args=None, batch_size=32):
+    '''
+    Thresholded network outputs of the patches (dicts with 'image',
+    'inmodal' and 'eraser', see prepare_order_patches), forwarded in batches
+    of up to batch_size patches of the same size. Patches may come from
+    different images.
+    '''
+    groups = {}
+    for i, patch in enumerate(patches):
+        groups.setdefault((patch['inmodal'].shape, patch['eraser'] is None), []).append(i)
+    results = [None] * len(patches)
+    for inds in groups.values():
+        for start in range(0, len(inds), batch_size):
+            batch = [patches[i] for i in inds[start:start + batch_size]]
+            if batch[0]['eraser'] is not None:
+                inputs = np.stack([np.stack([p['inmodal'], p['eraser']]) for p in batch])
             else:
-                result = output.argmax(1)[0].cpu().numpy().astype(np.uint8)
+                inputs = np.stack([p['inmodal'][np.newaxis] for p in batch])
+            inputs = to_input(inputs.astype(np.float32), model) # N2HW
+            with torch.inference_mode():
+                if use_rgb:
+                    image = to_input(torch.stack([
+                        p['image'] if torch.is_tensor(p['image'])
+                        else args.img_transform(p['image'].astype(np.float32))
+                        for p in batch]), model)
+                    output = model.model(inputs, image)
+                else:
+                    output = model.model(inputs)
+                prob, _ = output_prob(output, args)
+            masks = (prob.cpu().numpy() > forward_threshold(th, args)).astype(np.uint8)
+            for i, mask in zip(inds[start:start + batch_size], masks):
+                results[i] = mask
+    return results
+
+def forward_threshold(th, args):
+    '''
+    threshold applied by net_forward to the output of net_forward_prob
+    '''
+    if args is not None and args.model['use_std']:
+        if args.model.get('loss_mode', 'gaussian') == 'gaussian':
+            # for COCOA: 0.5 for infer_amodal, 0.5 for infer_order
+            # for KINS: 0.3 for infer_amodal, 0.4 for infer_order
+            return th
+        return 0.5
+    if args.data['dataset'] == 'KINS' or args.data['use_default']:
+        # for boundary_no_rgb: best th=0.3 for infer_amodal, 0.5 for infer_order
+        # for default_no_rgb: 0.2 for infer_amodal, 0.1 for infer_order
+        return th
+    return 0.5 # argmax
+
+def net_forward(model, image, inmodal_patch, eraser, use_rgb, th, args=None, debug=False,
+                session=None, key=None, roi=None):
+    '''
+    session, key: when given, the probability map is memoized in the
+        InferenceSession under key, see InferenceSession.
+    roi: see net_forward_prob
+    '''
+    if debug:
+        prob, std = net_forward_prob(
+            model, image, inmodal_patch, eraser, use_rgb, args=args, debug=True, roi=roi)
+    elif session is not None:
+        prob = session.forward(key, lambda: net_forward_prob(
+            model, image, inmodal_patch, eraser, use_rgb, args=args, roi=roi))
+    else:
+        prob = net_forward_prob(model, image, inmodal_patch, eraser, use_rgb, args=args, roi=roi)
+
+    result = (prob > forward_threshold(th, args)).astype(np.uint8)
 
     if debug:
-        return result, std.cpu().numpy()
+        return result, std
     else:
         return result
 
+
+class InferenceSession(object):
+    '''
+    Memoizes completion forwards within an image, so that the amodal stage
+    reuses the order stage forwards (an instance with a single ancestor is
+    completed with exactly the order-stage inputs). Entries are keyed by
+    (target, eraser ids, crop, preprocessing) and hold the threshold-free
+    probability map, thresholds are applied by the caller.
+    Call reset() before each new image, hits/misses accumulate.
+    dtype: optional storage type of the maps, e.g. np.float16 to keep many
+        maps around (threshold sweeps), at the cost of rounding.
+    '''
+    def __init__(self, dtype=None):
+        self.cache = {}
+        self.hits = 0
+        self.misses = 0
+        self.dtype = dtype
+
+    def reset(self):
+        self.cache = {}
+
+    def forward(self, key, func):
+        if key in self.cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            prob = func()
+            self.cache[key] = prob if self.dtype is None else prob.astype(self.dtype)
+        return self.cache[key]
+
+    def hit_rate(self):
+        return self.hits / float(max(self.hits + self.misses, 1))
+
+class PatchCache(object):
+    '''
+    Per-image cache of the patches shared by infer_order and infer_amodal:
+    resized visible masks keyed by (instance, crop box, size, interpolation)
+    and rgb crops resized and normalized (args.img_transform) once per
+    (crop box, size). Erasing is applied to the normalized tensor, see
+    rgb_input. Call reset() before each new image.
+    '''
+    def __init__(self):
+        self.reset()
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self.cache = {}
+
+    def get(self, key, func):
+        if key in self.cache:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.cache[key] = func()
+        return self.cache[key]
+
+    def modal_patch(self, inmodal, idx, bbox, newsize, interp):
+        ''' resized crop of inmodal[idx], a copy the caller may modify '''
+        key = ('modal', int(idx), tuple(int(b) for b in bbox), newsize, interp)
+        return self.get(key, lambda: crop_mask(inmodal[idx], bbox, newsize, interp)).copy()
+
+    def rgb_input(self, image, bbox, newsize, eraser, args):
+        '''
+        normalized rgb network input (3HW tensor) of the crop, with the eraser
+        region blacked out unless the data uses matting
+        '''
+        key = ('rgb', tuple(int(b) for b in bbox), newsize)
+        tensor = self.get(key, lambda: args.img_transform(
+            crop_image(image, bbox, newsize).astype(np.float32)))
+        if args.data.get('use_matting', False):
+            return tensor
+        # normalized value of a black pixel
+        fill = self.get('fill', lambda: args.img_transform(
+            np.zeros((1, 1, 3), dtype=np.float32))[:, 0, 0])
+        erase = torch.from_numpy(eraser.astype(np.float32))
+        return tensor * (1 - erase) + fill[:, None, None] * erase
+
+def crop_mask(mask, bbox, newsize, interp):
+    patch = utils.crop_padding(mask, bbox, pad_value=(0,))
+    if newsize is not None:
+        patch = resize_mask(patch, newsize, interp)
+    return patch
+
+def crop_image(image, bbox, newsize):
+    patch = utils.crop_padding(image, bbox, pad_value=(0,0,0))
+    if newsize is not None:
+        patch = cv2.resize(patch, (newsize, newsize), interpolation=cv2.INTER_CUBIC)
+    return patch
+
+def patch_key(tid, eraser_ids, bbox, newsize, interp, dilate_kernel, supervised=False):
+    return (int(tid), tuple(sorted(int(e) for e in eraser_ids)),
+            tuple(int(b) for b in bbox), newsize, interp, dilate_kernel, supervised)
+
 def net_forward_ordernet(model, image, inmodal1, inmodal2, use_rgb):
     if use_rgb:
-        image = torch.from_numpy(image.transpose((2,0,1)).astype(np.float32)).unsqueeze(0).cuda()
-    inmodal1 = torch.from_numpy(
-        inmodal1.astype(np.float32)).unsqueeze(0).unsqueeze(0).cuda()
-    inmodal2 = torch.from_numpy(
-        inmodal2.astype(np.float32)).unsqueeze(0).unsqueeze(0).cuda()
-    with torch.no_grad():
+        image = to_input(image.transpose((2,0,1)).astype(np.float32)[np.newaxis], model)
+    inmodal1 = to_input(inmodal1.astype(np.float32)[np.newaxis, np.newaxis], model)
+    inmodal2 = to_input(inmodal2.astype(np.float32)[np.newaxis, np.newaxis], model)
+    with torch.inference_mode():
         if use_rgb:
             output1 = nn.functional.softmax(model.model(
                 torch.cat([inmodal1, inmodal2, image], dim=1)))
@@ -145,54 +436,96 @@ def infer_amodal_hull(inmodal, bboxes, order_matrix, order_grounded=True):
         amodal.append(hull)
     return amodal
 
-def infer_order_hull(inmodal):
+def bordering_pairs(inmodal):
+    '''
+    All pairs (i < j) of instances for which bordering(inmodal[i], inmodal[j]),
+    as a P2 array, computed with one product over the occupied pixels.
+    '''
     num = inmodal.shape[0]
+    if num < 2:
+        return np.zeros((0, 2), dtype=int)
+    dilate_kernel = np.array([[0, 1, 0],
+                              [1, 1, 1],
+                              [0, 1, 0]], dtype=np.uint8)
+    dilated = np.stack([cv2.dilate(m.astype(np.uint8), dilate_kernel, iterations=1)
+                        for m in inmodal]).reshape(num, -1)
+    active = np.nonzero(dilated.any(axis=0))[0]
+    touch = np.dot(dilated[:, active].astype(np.float32),
+                   (inmodal.reshape(num, -1)[:, active] > 0).astype(np.float32).T)
+    return np.stack(np.nonzero(np.triu(touch > 0, 1)), axis=1)
+
+def pairs_to_order(num, pairs, i_occluded):
+    '''
+    order matrix with order[i, j] = -1 (i occluded by j) where i_occluded
+    and 1 otherwise, for the pairs (i, j) and antisymmetric
+    '''
     order_matrix = np.zeros((num, num), dtype=int)
+    values = np.where(i_occluded, -1, 1)
+    order_matrix[pairs[:, 0], pairs[:, 1]] = values
+    order_matrix[pairs[:, 1], pairs[:, 0]] = -values
+    return order_matrix
+
+def instance_hull(mask):
+    '''
+    convex hull of a mask, computed in its bounding box
+    '''
+    hull = np.zeros(mask.shape, dtype=bool)
+    x, y, w, h = utils.mask_to_bbox(mask)
+    if w > 0:
+        hull[y:y+h, x:x+w] = convex_hull.convex_hull_image(mask[y:y+h, x:x+w])
+    return hull
+
+def infer_order_hull(inmodal):
+    '''
+    j is above i if the convex hull of i covers more of j than the other way
+    round. Hulls are computed once per instance of a bordering pair.
+    '''
+    num = inmodal.shape[0]
+    pairs = bordering_pairs(inmodal)
+    if len(pairs) == 0:
+        return np.zeros((num, num), dtype=int)
     occ_value_matrix = np.zeros((num, num), dtype=np.float32)
-    for i in range(num):
-        for j in range(i + 1, num):
-            if bordering(inmodal[i], inmodal[j]):
-                amodal_i = convex_hull.convex_hull_image(inmodal[i])
-                amodal_j = convex_hull.convex_hull_image(inmodal[j])
-                occ_value_matrix[i, j] = ((amodal_i > inmodal[i]) & (inmodal[j] == 1)).sum()
-                occ_value_matrix[j, i] = ((amodal_j > inmodal[j]) & (inmodal[i] == 1)).sum()
+    insts = np.unique(pairs)
+    visible = inmodal[insts].reshape(len(insts), -1) == 1
+    extra = np.stack([instance_hull(inmodal[i]) for i in insts]).reshape(len(insts), -1) & ~visible
+    active = np.nonzero(extra.any(axis=0))[0]
+    # occ[i, j]: pixels of j in the hull of i outside i
+    occ = np.dot(extra[:, active].astype(np.float32), visible[:, active].astype(np.float32).T)
+    pos = np.zeros(num, dtype=int)
+    pos[insts] = np.arange(len(insts))
+    occ_value_matrix[pairs[:, 0], pairs[:, 1]] = occ[pos[pairs[:, 0]], pos[pairs[:, 1]]]
+    occ_value_matrix[pairs[:, 1], pairs[:, 0]] = occ[pos[pairs[:, 1]], pos[pairs[:, 0]]]
+    order_matrix = np.zeros((num, num), dtype=int)
     order_matrix[occ_value_matrix > occ_value_matrix.transpose()] = -1
     order_matrix[occ_value_matrix < occ_value_matrix.transpose()] = 1
     order_matrix[(occ_value_matrix == 0) & (occ_value_matrix == 0).transpose()] = 0
     return order_matrix
 
+def infer_order_convex(inmodal):
+    '''
+    order of the convex (hull completion) baseline, see infer_order_hull
+    '''
+    return infer_order_hull(inmodal)
+
 def infer_order_area(inmodal, above='larger'):
     num = inmodal.shape[0]
-    order_matrix = np.zeros((num, num), dtype=int)
-    for i in range(num):
-        for j in range(i + 1, num):
-            if bordering(inmodal[i], inmodal[j]):
-                area_i = inmodal[i].sum()
-                area_j = inmodal[j].sum()
-                if (area_i < area_j and above == 'larger') or \
-                   (area_i >= area_j and above == 'smaller'):
-                    order_matrix[i, j] = -1 # i occluded by j
-                    order_matrix[j, i] = 1
-                else:
-                    order_matrix[i, j] = 1
-                    order_matrix[j, i] = -1
-    return order_matrix
+    pairs = bordering_pairs(inmodal)
+    area = inmodal.sum(axis=(1, 2))
+    area_i, area_j = area[pairs[:, 0]], area[pairs[:, 1]]
+    if above == 'larger':
+        i_occluded = area_i < area_j
+    else:
+        i_occluded = area_i >= area_j
+    return pairs_to_order(num, pairs, i_occluded)
 
 def infer_order_yaxis(inmodal):
     num = inmodal.shape[0]
-    order_matrix = np.zeros((num, num), dtype=int)
-    for i in range(num):
-        for j in range(i + 1, num):
-            if bordering(inmodal[i], inmodal[j]):
-                center_i = [coord.mean() for coord in np.where(inmodal[i] == 1)] # y, x
-                center_j = [coord.mean() for coord in np.where(inmodal[j] == 1)] # y, x
-                if center_i[0] < center_j[0]: # i higher than j in y axis
-                    order_matrix[i, j] = -1 # i occluded by j
-                    order_matrix[j, i] = 1
-                else:
-                    order_matrix[i, j] = 1
-                    order_matrix[j, i] = -1
-    return order_matrix
+    pairs = bordering_pairs(inmodal)
+    # y of the centroids, bordering instances are not empty
+    rows = (inmodal == 1).sum(axis=2)
+    center_y = np.dot(rows, np.arange(inmodal.shape[1])) / np.maximum(rows.sum(axis=1), 1)
+    i_occluded = center_y[pairs[:, 0]] < center_y[pairs[:, 1]] # i higher than j in y axis
+    return pairs_to_order(num, pairs, i_occluded)
 
 def infer_order_sup(model, image, inmodal, bboxes, input_size=256, use_rgb=True):
     num = inmodal.shape[0]
@@ -230,42 +563,32 @@ def infer_order_sup(model, image, inmodal, bboxes, input_size=256, use_rgb=True)
 
     return order_matrix
 
-def infer_order(model, image, inmodal, category, bboxes, use_rgb=True, th=0.5, dilate_kernel=0, input_size=None, min_input_size=32, interp='nearest', debug_info=False, args=None, supervised=False):
+def prepare_order_patches(image, inmodal, category, bboxes, dilate_kernel=0, input_size=None,
+                          min_input_size=32, interp='nearest', args=None, supervised=False,
+                          use_rgb=True, cache=None):
     '''
-    image: HW3, inmodal: NHW, category: N, bboxes: N4
+    Network inputs of infer_order without running the network.
+    Returns ind (P2: target, eraser of each bordering pair) and one patch per
+    pair: a dict with the network inputs 'image' (normalized tensor, None
+    without use_rgb), 'inmodal', 'eraser', the session 'key', the crop
+    'bbox' and, for order_from_patches, the erased 'visible' mask, the
+    'erased' region and the crop to patch size 'ratio'.
+    cache: PatchCache of the image, shared with prepare_amodal_patches
     '''
-    deal_with_fullcover = False
+    if cache is None:
+        cache = PatchCache()
     num = inmodal.shape[0]
-    order_matrix = np.zeros((num, num), dtype=int)
     ind = []
-    if deal_with_fullcover:
-        fullcover_inds = []
     for i in range(num):
         for j in range(i + 1, num):
             if bordering(inmodal[i], inmodal[j]):
                 ind.append([i, j])
                 ind.append([j, i])
-            if deal_with_fullcover:
-                fullcover = fullcovering(inmodal[i], inmodal[j], bboxes[i], bboxes[j])
-                if fullcover == 1:
-                    fullcover_inds.append([i, j])
-                elif fullcover == 2:
-                    fullcover_inds.append([j, i])
-    pairnum = len(ind)
-    if pairnum == 0:
-        return order_matrix
-    ind = np.array(ind)
-    eraser_patches = []
-    inmodal_patches = []
-    amodal_patches = []
-    ratios = []
-    erasers = []
-    for i in range(pairnum):
+    ind = np.array(ind, dtype=int).reshape(-1, 2)
+    patches = []
+    for i in range(ind.shape[0]):
         tid = ind[i, 0]
         eid = ind[i, 1]
-        image_patch = utils.crop_padding(image, bboxes[tid], pad_value=(0,0,0))
-        inmodal_patch = utils.crop_padding(inmodal[tid], bboxes[tid], pad_value=(0,))
-        eraser = utils.crop_padding(inmodal[eid], bboxes[tid], pad_value=(0,))
 
         if input_size is not None:
             newsize = input_size
@@ -274,24 +597,18 @@ def infer_order(model, image, inmodal, category, bboxes, use_rgb=True, th=0.5, d
         else:
             newsize = None
 
-        if newsize is not None:
-            inmodal_patch = resize_mask(inmodal_patch, newsize, interp)
-            image_patch = cv2.resize(image_patch, 
-                (newsize, newsize), interpolation=cv2.INTER_CUBIC)
-            eraser = resize_mask(eraser, newsize, interp)
+        inmodal_patch = cache.modal_patch(inmodal, tid, bboxes[tid], newsize, interp)
+        eraser = crop_mask(inmodal[eid], bboxes[tid], newsize, interp)
 
         if dilate_kernel > 0:
             eraser = cv2.dilate(eraser, np.ones((dilate_kernel, dilate_kernel), np.uint8),
                                 iterations=1)
         # erase inmodal
         inmodal_patch[eraser == 1] = 0
-        # gather
-        inmodal_patches.append(inmodal_patch)
-        eraser_patches.append(eraser)
-        ratios.append(1. if newsize is None else bboxes[tid,2] / float(newsize))
-
-        if not args.data.get('use_matting', False): 
-            image_patch = image_patch * (1 - eraser[..., None])
+        patch = {'visible': inmodal_patch, 'erased': eraser, 'bbox': bboxes[tid],
+                 'ratio': 1. if newsize is None else bboxes[tid,2] / float(newsize)}
+        patch['image'] = cache.rgb_input(image, bboxes[tid], newsize, eraser, args) \
+            if use_rgb else None
 
         if not args.data['use_default']:
             border_width = args.data.get('border_width', 5)
@@ -303,30 +620,68 @@ def infer_order(model, image, inmodal, category, bboxes, use_rgb=True, th=0.5, d
         if supervised:
             eraser = None
 
+        patch['key'] = patch_key(tid, [eid], bboxes[tid], newsize, interp, dilate_kernel, supervised)
+        patch['eraser'] = eraser
         if args.data['dataset'] == 'KINS': 
-            amodal_patch = net_forward(
-                model, image_patch, inmodal_patch * category[tid], eraser, use_rgb, th, args=args)
+            patch['inmodal'] = inmodal_patch * category[tid]
         else:
-            amodal_patch = net_forward(
-                model, image_patch, inmodal_patch * 1, eraser, use_rgb, th, args=args)
-
-        amodal_patches.append(amodal_patch)
+            patch['inmodal'] = inmodal_patch * 1
+        patches.append(patch)
+    return ind, patches
 
+def order_from_patches(num, ind, patches, amodal_patches):
+    '''
+    order matrix from the completed pair patches (see prepare_order_patches)
+    '''
+    order_matrix = np.zeros((num, num), dtype=int)
     occ_value_matrix = np.zeros((num, num), dtype=np.float32)
     for i, idx in enumerate(ind):
         occ_value_matrix[idx[0], idx[1]] = (
-            ((amodal_patches[i] > inmodal_patches[i]) & (eraser_patches[i] == 1)).sum() * (ratios[i] ** 2))
+            ((amodal_patches[i] > patches[i]['visible']) & (patches[i]['erased'] == 1)).sum() * (patches[i]['ratio'] ** 2))
 
     order_matrix[occ_value_matrix > occ_value_matrix.transpose()] = -1
     order_matrix[occ_value_matrix < occ_value_matrix.transpose()] = 1
     order_matrix[(occ_value_matrix == 0) & (occ_value_matrix == 0).transpose()] = 0
+    return order_matrix
+
+def infer_order(model, image, inmodal, category, bboxes, use_rgb=True, th=0.5, dilate_kernel=0, input_size=None, min_input_size=32, interp='nearest', debug_info=False, args=None, supervised=False,
+                session=None, image_feat=None, cache=None):
+    '''
+    image: HW3, inmodal: NHW, category: N, bboxes: N4
+    session: optional InferenceSession shared with infer_amodal
+    image_feat: optional encode_image output, rgb features of the patches are
+        pooled from it (a backbone trained with roi_image_size)
+    cache: optional PatchCache of the image shared with infer_amodal
+    '''
+    deal_with_fullcover = False
+    num = inmodal.shape[0]
+    ind, patches = prepare_order_patches(
+        image, inmodal, category, bboxes, dilate_kernel=dilate_kernel, input_size=input_size,
+        min_input_size=min_input_size, interp=interp, args=args, supervised=supervised,
+        use_rgb=use_rgb and image_feat is None, cache=cache)
+    if len(patches) == 0:
+        return np.zeros((num, num), dtype=int)
+
+    amodal_patches = []
+    for patch in patches:
+        roi = None if image_feat is None else (image_feat, patch['bbox'])
+        amodal_patches.append(net_forward(
+            model, patch['image'], patch['inmodal'], patch['eraser'], use_rgb, th, args=args,
+            session=session, key=patch['key'], roi=roi))
+
+    order_matrix = order_from_patches(num, ind, patches, amodal_patches)
     if deal_with_fullcover:
-        for fc in fullcover_inds:
-            assert order_matrix[fc[0], fc[1]] == 0
-            order_matrix[fc[0], fc[1]] = -1
-            order_matrix[fc[1], fc[0]] = 1
+        for i in range(num):
+            for j in range(i + 1, num):
+                fullcover = fullcovering(inmodal[i], inmodal[j], bboxes[i], bboxes[j])
+                fc = [i, j] if fullcover == 1 else [j, i] if fullcover == 2 else None
+                if fc is not None:
+                    assert order_matrix[fc[0], fc[1]] == 0
+                    order_matrix[fc[0], fc[1]] = -1
+                    order_matrix[fc[1], fc[0]] = 1
     if debug_info:
-        return order_matrix, ind, inmodal_patches, eraser_patches, amodal_patches
+        return order_matrix, ind, [p['visible'] for p in patches], \
+            [p['erased'] for p in patches], amodal_patches
     else:
         return order_matrix
 
@@ -356,32 +711,45 @@ def fullcovering(mask1, mask2, box1, box2):
         return 0
 
 def infer_gt_order(inmodal, amodal):
-    #inmodal = inmodal.numpy()
-    #amodal = amodal.numpy()
+    '''
+    For bordering i, j: i is above j (1) if more of the visible i lies in
+    the amodal j than the other way round, computed for all pairs with one
+    product over the pixels covered by any visible mask.
+    '''
     num = inmodal.shape[0]
     gt_order_matrix = np.zeros((num, num), dtype=int)
-    for i in range(num):
-        for j in range(i + 1, num):
-            if not bordering(inmodal[i], inmodal[j]):
-                continue
-            occ_ij = ((inmodal[i] == 1) & (amodal[j] == 1)).sum()
-            occ_ji = ((inmodal[j] == 1) & (amodal[i] == 1)).sum()
-            #assert not (occ_ij > 0 and occ_ji > 0) # assertion error, why?
-            if occ_ij == 0 and occ_ji == 0: # bordering but not occluded
-                continue
-            gt_order_matrix[i, j] = 1 if occ_ij >= occ_ji else -1
-            gt_order_matrix[j, i] = -gt_order_matrix[i, j]
+    pairs = bordering_pairs(inmodal)
+    if len(pairs) == 0:
+        return gt_order_matrix
+    visible = inmodal.reshape(num, -1) == 1
+    active = np.nonzero(visible.any(axis=0))[0]
+    # occ[i, j]: pixels of the visible i inside the amodal j
+    occ = np.dot(visible[:, active].astype(np.float32),
+                 (amodal.reshape(num, -1)[:, active] == 1).astype(np.float32).T)
+    occ_ij = occ[pairs[:, 0], pairs[:, 1]]
+    occ_ji = occ[pairs[:, 1], pairs[:, 0]]
+    occluded = (occ_ij > 0) | (occ_ji > 0) # bordering but not occluded otherwise
+    pairs, values = pairs[occluded], np.where(occ_ij >= occ_ji, 1, -1)[occluded]
+    gt_order_matrix[pairs[:, 0], pairs[:, 1]] = values
+    gt_order_matrix[pairs[:, 1], pairs[:, 0]] = -values
     return gt_order_matrix
 
-def eval_order(order_matrix, gt_order_matrix):
+def eval_order(order_matrix, gt_order_matrix, with_err=True):
+    '''
+    with_err=False skips the table of wrong pairs (show_err is None)
+    '''
     inst_num = order_matrix.shape[0]
-    allpair_true = ((order_matrix == gt_order_matrix).sum() - inst_num) / 2
+    correct = order_matrix == gt_order_matrix
+    allpair_true = (correct.sum() - inst_num) / 2
     allpair = (inst_num  * inst_num - inst_num) / 2
 
-    occpair_true = ((order_matrix == gt_order_matrix) & (gt_order_matrix != 0)).sum() / 2
-    occpair = (gt_order_matrix != 0).sum() / 2
+    occluded = gt_order_matrix != 0
+    occpair_true = (correct & occluded).sum() / 2
+    occpair = occluded.sum() / 2
 
-    err = np.where(order_matrix != gt_order_matrix)
+    if not with_err:
+        return allpair_true, allpair, occpair_true, occpair, None
+    err = np.where(~correct)
     gt_err = gt_order_matrix[err]
     pred_err = order_matrix[err]
     show_err = np.concatenate([np.array(err).T + 1, gt_err[:,np.newaxis], pred_err[:,np.newaxis]], axis=1)
@@ -438,14 +806,14 @@ def infer_instseg(model, image, category, bboxes, new_bboxes, input_size, th, rg
         bbox_mask[rel_bbox[1]:rel_bbox[1]+rel_bbox[3], rel_bbox[0]:rel_bbox[0]+rel_bbox[2]] = 1
         bbox_mask = cv2.resize(bbox_mask, (input_size, input_size),
             interpolation=cv2.INTER_NEAREST)
-        bbox_mask_tensor = torch.from_numpy(
-            bbox_mask.astype(np.float32) * category[i]).unsqueeze(0).unsqueeze(0).cuda()
+        bbox_mask_tensor = to_input(
+            (bbox_mask.astype(np.float32) * category[i])[np.newaxis, np.newaxis], model)
         image_patch = cv2.resize(utils.crop_padding(image, new_bboxes[i], pad_value=(0,0,0)),
             (input_size, input_size), interpolation=cv2.INTER_CUBIC)
-        image_tensor = torch.from_numpy(
-            image_patch.transpose((2,0,1)).astype(np.float32)).unsqueeze(0).cuda() # 13HW
-        with torch.no_grad():
-            output = model.model(torch.cat([image_tensor, bbox_mask_tensor], dim=1)).detach()
+        image_tensor = to_input(
+            image_patch.transpose((2,0,1)).astype(np.float32)[np.newaxis], model) # 13HW
+        with torch.inference_mode():
+            output = model.model(torch.cat([image_tensor, bbox_mask_tensor], dim=1))
         if output.shape[2] != image_tensor.shape[2]:
             output = nn.functional.interpolate(
                 output, size=image_tensor.shape[2:4],
@@ -563,14 +931,22 @@ def infer_amodal_vis(model, image, inmodal, amodal, category, bboxes, order_matr
     return inmodal_patches, eraser_patches, amodal_patches, amodal_patches_gt, std_patches, boundary_patches, image_patches
 
 
-def infer_amodal(model, image, inmodal, category, bboxes, order_matrix,
-                use_rgb=True, th=0.5, dilate_kernel=0,
-                input_size=None, min_input_size=16, interp='nearest',
-                order_grounded=True, debug_info=False, args=None):
+def prepare_amodal_patches(image, inmodal, category, bboxes, order_matrix,
+                           dilate_kernel=0, input_size=None, min_input_size=16, interp='nearest',
+                           order_grounded=True, args=None, skip_th=-1, stats=None,
+                           use_rgb=True, cache=None):
+    '''
+    Network inputs of infer_amodal without running the network, one dict per
+    instance as in prepare_order_patches. Instances skipped by skip_th have
+    their result in 'amodal' and no network inputs.
+    stats: optional dict, the count of 'skipped' patches is added. Forwards
+        are counted by the caller when they run (a patch may be served by an
+        InferenceSession).
+    '''
+    if cache is None:
+        cache = PatchCache()
     num = inmodal.shape[0]
-    inmodal_patches = []
-    eraser_patches = []
-    amodal_patches = []
+    patches = []
 
     for i in range(num):
         if order_grounded == 'parents':
@@ -580,34 +956,38 @@ def infer_amodal(model, image, inmodal, category, bboxes, order_matrix,
         else:
             ancestors = get_neighbors(order_matrix, i)
             # ancestors = get_neighbors_recur(order_matrix, i)
-        image_patch = utils.crop_padding(image, bboxes[i], pad_value=(0,0,0))
-        inmodal_patch = utils.crop_padding(inmodal[i], bboxes[i], pad_value=(0,))
         if input_size is not None: # always
             newsize = input_size
         elif min_input_size > bboxes[i,2]:
             newsize = min_input_size
         else:
             newsize = None
-        if newsize is not None:
-            inmodal_patch = resize_mask(inmodal_patch, newsize, interp)
-            image_patch = cv2.resize(image_patch, 
-                (newsize, newsize), interpolation=cv2.INTER_CUBIC)
+        inmodal_patch = cache.modal_patch(inmodal, i, bboxes[i], newsize, interp)
+
+        if len(ancestors) > 0:
+            eraser = (inmodal[ancestors,...].sum(axis=0) > 0).astype(np.uint8) # union
+            eraser = utils.crop_padding(eraser, bboxes[i], pad_value=(0,))
+            if newsize is not None:
+                eraser = resize_mask(eraser, newsize, interp)
+            if dilate_kernel > 0:
+                eraser = cv2.dilate(eraser, np.ones((dilate_kernel, dilate_kernel), np.uint8),
+                                    iterations=1)
+        else:
+            eraser = np.zeros(inmodal_patch.shape, dtype=np.uint8)
+
+        # unoccluded instance, the visible mask is the answer
+        if skip_th >= 0 and eraser.sum() <= skip_th:
+            patches.append({'visible': inmodal_patch, 'erased': eraser, 'bbox': bboxes[i],
+                            'amodal': (inmodal_patch > 0).astype(np.uint8)})
+            if stats is not None:
+                stats['skipped'] = stats.get('skipped', 0) + 1
+            continue
 
-        eraser = (inmodal[ancestors,...].sum(axis=0) > 0).astype(np.uint8) # union
-        eraser = utils.crop_padding(eraser, bboxes[i], pad_value=(0,))
-        if newsize is not None:
-            eraser = resize_mask(eraser, newsize, interp)
-        if dilate_kernel > 0:
-            eraser = cv2.dilate(eraser, np.ones((dilate_kernel, dilate_kernel), np.uint8),
-                                iterations=1)
         # erase inmodal
         inmodal_patch[eraser == 1] = 0
-        # gather
-        inmodal_patches.append(inmodal_patch)
-        eraser_patches.append(eraser)
-
-        if not args.data.get('use_matting', False):
-            image_patch = image_patch * (1 - eraser[..., None])
+        patch = {'visible': inmodal_patch, 'erased': eraser, 'bbox': bboxes[i]}
+        patch['image'] = cache.rgb_input(image, bboxes[i], newsize, eraser, args) \
+            if use_rgb else None
 
         if not args.data['use_default']:
             border_width = args.data.get('border_width', 5)
@@ -616,24 +996,146 @@ def infer_amodal(model, image, inmodal, category, bboxes, order_matrix,
             modal_extend = F.max_pool2d(torch.from_numpy(inmodal_patch[None, None, ...]).float(), border_width, stride=1, padding=border_width//2)
             eraser = ((eraser_extend == 1) & (modal_extend == 1))[0, 0].numpy()
 
+        patch['key'] = patch_key(i, ancestors, bboxes[i], newsize, interp, dilate_kernel)
+        patch['eraser'] = eraser
         if args.data['dataset'] == 'KINS': 
-            amodal_patch = net_forward(
-                model, image_patch, inmodal_patch * category[i], eraser, use_rgb, th, args=args)
+            patch['inmodal'] = inmodal_patch * category[i]
         else:
-            amodal_patch = net_forward(
-                model, image_patch, inmodal_patch * 1, eraser, use_rgb, th, args=args)
+            patch['inmodal'] = inmodal_patch * 1
+        patches.append(patch)
+    return patches
 
-        amodal_patches.append(amodal_patch)
+def infer_amodal(model, image, inmodal, category, bboxes, order_matrix,
+                use_rgb=True, th=0.5, dilate_kernel=0,
+                input_size=None, min_input_size=16, interp='nearest',
+                order_grounded=True, debug_info=False, args=None,
+                skip_th=-1, stats=None, session=None, image_feat=None, cache=None):
+    '''
+    skip_th: instances whose eraser patch has at most skip_th pixels are not
+        forwarded, their visible mask is returned as the amodal mask.
+        -1 disables the fast path, 0 only skips instances without occluders.
+    stats: optional dict, counts of 'forward' (network runs, session cache
+        hits excluded) and 'skipped' patches are added.
+    session: optional InferenceSession shared with infer_order
+    image_feat, cache: see infer_order
+    '''
+    patches = prepare_amodal_patches(
+        image, inmodal, category, bboxes, order_matrix, dilate_kernel=dilate_kernel,
+        input_size=input_size, min_input_size=min_input_size, interp=interp,
+        order_grounded=order_grounded, args=args, skip_th=skip_th, stats=stats,
+        use_rgb=use_rgb and image_feat is None, cache=cache)
+
+    amodal_patches = []
+    forwards = 0
+    for patch in patches:
+        if 'amodal' not in patch:
+            roi = None if image_feat is None else (image_feat, patch['bbox'])
+            misses = None if session is None else session.misses
+            patch['amodal'] = net_forward(
+                model, patch['image'], patch['inmodal'], patch['eraser'], use_rgb, th, args=args,
+                session=session, key=patch['key'], roi=roi)
+            # patches served by the session cache are not forwarded again
+            forwards += 1 if session is None else session.misses - misses
+        amodal_patches.append(patch['amodal'])
+    if stats is not None:
+        stats['forward'] = stats.get('forward', 0) + forwards
 
     if debug_info:
-        return inmodal_patches, eraser_patches, amodal_patches
+        return [p['visible'] for p in patches], [p['erased'] for p in patches], amodal_patches
     else:
         return amodal_patches
 
 
 
+def patch_probs(model, patches, use_rgb, args=None, session=None, image_feat=None):
+    '''
+    Probability maps (before thresholding) of prepared patches, see
+    prepare_order_patches and prepare_amodal_patches. None for the patches
+    skipped by prepare_amodal_patches, which hold their result in 'amodal'.
+    '''
+    probs = []
+    for patch in patches:
+        if 'amodal' in patch:
+            probs.append(None)
+            continue
+        roi = None if image_feat is None else (image_feat, patch['bbox'])
+        func = lambda: net_forward_prob(
+            model, patch['image'], patch['inmodal'], patch['eraser'], use_rgb, args=args, roi=roi)
+        probs.append(func() if session is None else session.forward(patch['key'], func))
+    return probs
+
+def expand_bboxes(bboxes, enlarge_box):
+    '''
+    bboxes: N4 (xywh) -> square context boxes used to crop patches, N4
+    '''
+    new_bboxes = []
+    for bbox in bboxes:
+        centerx = bbox[0] + bbox[2] / 2.
+        centery = bbox[1] + bbox[3] / 2.
+        size = max([np.sqrt(bbox[2] * bbox[3] * enlarge_box),
+                    bbox[2] * 1.1, bbox[3] * 1.1])
+        new_bbox = [int(centerx - size / 2.), int(centery - size / 2.), int(size), int(size)]
+        new_bboxes.append(new_bbox)
+    return np.array(new_bboxes)
+
 def patch_to_fullimage(patches, bboxes, height, width, interp):
     amodals = []
     for patch, bbox in zip(patches, bboxes):
         amodals.append(recover_mask(patch, bbox, height, width, interp))
     return np.array(amodals)
+
+def patch_to_crops(patches, bboxes, height, width, interp):
+    '''
+    As patch_to_fullimage, but each mask is kept as (box, crop) clipped to
+    the image, see utils.crop_to_rle and crop_metrics.
+    '''
+    crops = []
+    for patch, bbox in zip(patches, bboxes):
+        crops.append(utils.clip_crop(
+            resize_mask(patch, bbox[2], interp), bbox, height, width))
+    return crops
+
+def masks_to_crops(masks):
+    '''
+    NHW masks -> (box, crop) at the bounding box of each mask
+    '''
+    crops = []
+    for mask in masks:
+        x, y, w, h = utils.mask_to_bbox(mask)
+        crops.append(([x, y, w, h], mask[y:y+h, x:x+w]))
+    return crops
+
+def gt_metrics(amodal_gt, inmodal):
+    '''
+    prediction independent part of crop_metrics: target and the invisible gt area
+    '''
+    gt = (amodal_gt == 1)
+    return gt.sum(), (gt & (inmodal == 0)).sum()
+
+def crop_metrics(crops, amodal_gt, inmodal, gt_sums=None):
+    '''
+    crops: predicted amodal masks as (box, crop), amodal_gt, inmodal: NHW
+    -> intersection, union, target, invisible intersection, invisible union
+       of the predicted and gt amodal masks, summed over instances
+    gt_sums: gt_metrics(amodal_gt, inmodal), when evaluating several
+        predictions of the same image
+    '''
+    intersection, union, target, inv_intersection, inv_union = 0, 0, 0, 0, 0
+    for i, (box, crop) in enumerate(crops):
+        x, y, w, h = box
+        pred = (crop == 1)
+        gt = (amodal_gt[i, y:y+h, x:x+w] == 1)
+        invisible = (inmodal[i, y:y+h, x:x+w] == 0)
+        inter = (pred & gt).sum()
+        inv_inter = (pred & gt & invisible).sum()
+        intersection += inter
+        inv_intersection += inv_inter
+        # |pred| - |pred & gt| here, |gt| is added below
+        union += pred.sum() - inter
+        inv_union += (pred & invisible).sum() - inv_inter
+    if gt_sums is None:
+        gt_sums = gt_metrics(amodal_gt, inmodal)
+    target = gt_sums[0]
+    inv_union += gt_sums[1]
+    union += target
+    return intersection, union, target, inv_intersection, inv_union
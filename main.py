@@ -2,6 +2,7 @@ import multiprocessing as mp
 import argparse
 import os
 import yaml
+import torch
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -22,13 +23,20 @@ def main(args):
         args.exp_path = os.path.dirname(args.config)
     # print('...finished exporting path')
 
+    # device: --device, then the config, then cuda if available
+    if args.device is not None:
+        args.model['device'] = args.device
+    args.model.setdefault('device', 'cuda' if torch.cuda.is_available() else 'cpu')
+    if args.backend is None:
+        args.backend = 'nccl' if args.model['device'].startswith('cuda') else 'gloo'
+
     # dist init
     ## when I am running it, it gets stuck here for some reason and does not ever reach trainer
     if mp.get_start_method(allow_none=True) != 'spawn':
         # print('...spawn the mp.set_start_method')
         mp.set_start_method('spawn', force=True)
     print('...initializing launcher')
-    dist_init(args.launcher, backend='nccl')
+    dist_init(args.launcher, backend=args.backend)
 
     # train
     trainer = Trainer(args)
@@ -39,8 +47,12 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Pytorch De-Occlusion.')
     parser.add_argument('--config', required=True, type=str)
-    parser.add_argument('--launcher', default='pytorch', type=str)
-    parser.add_argument('--load-iter', default=None, type=int)
+    parser.add_argument('--launcher', default='pytorch', choices=['pytorch', 'slurm', 'none'],
+                        help='none: a single process without a process group')
+    parser.add_argument('--backend', default=None, choices=['nccl', 'gloo'],
+                        help='default nccl on cuda, gloo on cpu')
+    parser.add_argument('--device', default=None, type=str, help='cuda or cpu, overrides the config')
+    parser.add_argument('--load-iter', default=None, type=int, help='-1 for the latest checkpoint')
     parser.add_argument('--load-pretrain', default=None, type=str)
     parser.add_argument('--resume', action='store_true')
     parser.add_argument('--validate', action='store_true')
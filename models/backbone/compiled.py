@@ -0,0 +1,46 @@
+# compiled execution of the backbones (torch.compile for training and inference,
+# TorchScript tracing for inference)
+
+import warnings
+import torch
+
+from .deploy import traceable
+
+
+def compile_module(module, backend='inductor', dynamic=None):
+    '''
+    Compiles the forward of module with torch.compile, in place: the module
+    keeps its parameters, state dict keys and hooks (DistModule, checkpoints
+    are unaffected). Graphs are specialised to the input shapes, with the
+    default dynamic=None a dimension only turns dynamic once it changes, so
+    training at a fixed batch and input_size (256) runs fully static graphs
+    and single patch inference recompiles at most once for other batch sizes.
+    Other methods (encode_image, roi_image_feat) stay eager.
+    '''
+    if not hasattr(torch, 'compile'):
+        raise Exception("torch.compile requires torch >= 2.0, found {}".format(torch.__version__))
+    module.forward = torch.compile(module.forward, backend=backend, dynamic=dynamic)
+    return module
+
+
+def trace_module(module, example_inputs, use_rgb=False):
+    '''
+    Traces module in eval mode for the shapes of example_inputs and freezes
+    it (constant weights, BN folded by the TorchScript optimizer). Branches
+    on the input size are fixed to the traced input_size, the batch stays
+    free. Takes the inputs positionally ((x,) or (x, rgb)), for inference
+    only.
+    '''
+    with torch.no_grad(), warnings.catch_warnings():
+        # the branches fixed to the traced shapes are intended
+        warnings.simplefilter('ignore', torch.jit.TracerWarning)
+        traced = torch.jit.trace(traceable(module, use_rgb).eval(), example_inputs)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+
+def example_inputs(in_channels, input_size=256, use_rgb=False, batch_size=1, device='cpu'):
+    ''' zero inputs (x,) or (x, rgb) of a backbone, for tracing and benchmarks '''
+    inputs = (torch.zeros(batch_size, in_channels, input_size, input_size, device=device),)
+    if use_rgb:
+        inputs += (torch.zeros(batch_size, 3, input_size, input_size, device=device),)
+    return inputs
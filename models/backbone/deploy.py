@@ -0,0 +1,115 @@
+# inference-only transforms of the backbones (BN folding, int8 quantization, export)
+
+import inspect
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def fold_bn(module):
+    '''
+    Folds every BatchNorm2d that directly follows a Conv2d into the conv, in
+    place: consecutive layers of nn.Sequential (double_conv, reduce_dim,
+    resnet downsample) and the convN/bnN pairs of the resnet stem and blocks.
+    Folded BN layers are replaced by nn.Identity. The module must be in eval
+    mode, the result is for inference only.
+    '''
+    assert not module.training, "fold_bn requires a module in eval mode"
+    _fold_bn(module)
+    return module.eval()
+
+
+def _fold_bn(module):
+    for child in module.children():
+        if isinstance(child, nn.Sequential):
+            for idx in range(len(child) - 1):
+                if isinstance(child[idx], nn.Conv2d) and isinstance(child[idx + 1], nn.BatchNorm2d):
+                    child[idx] = fuse_conv_bn_eval(child[idx], child[idx + 1])
+                    child[idx + 1] = nn.Identity()
+        _fold_bn(child)
+    for i in range(1, 4):
+        conv = getattr(module, 'conv{}'.format(i), None)
+        bn = getattr(module, 'bn{}'.format(i), None)
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(module, 'conv{}'.format(i), fuse_conv_bn_eval(conv, bn))
+            setattr(module, 'bn{}'.format(i), nn.Identity())
+
+
+class MaskInput(nn.Module):
+    ''' fixes the signature of mask-only backbones for tracing '''
+    def __init__(self, module):
+        super(MaskInput, self).__init__()
+        self.module = module
+
+    def forward(self, x):
+        return self.module(x)
+
+
+class MaskRGBInput(nn.Module):
+    ''' fixes the signature of mask + rgb backbones for tracing '''
+    def __init__(self, module):
+        super(MaskRGBInput, self).__init__()
+        self.module = module
+
+    def forward(self, x, rgb):
+        return self.module(x, rgb)
+
+
+def traceable(module, use_rgb):
+    return MaskRGBInput(module) if use_rgb else MaskInput(module)
+
+
+def prepare_int8(module, example_inputs, use_rgb=False, backend='x86'):
+    '''
+    Inserts observers for post-training static quantization (FX graph mode).
+    Run calibration forwards through the returned module, then convert it
+    with convert_int8. Quantized backbones run on CPU only.
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    torch.backends.quantized.engine = backend
+    module = traceable(module, use_rgb).eval()
+    return prepare_fx(module, get_default_qconfig_mapping(backend), example_inputs)
+
+
+def convert_int8(prepared):
+    from torch.ao.quantization.quantize_fx import convert_fx
+    return convert_fx(prepared)
+
+
+def export_torchscript(module, example_inputs, path, use_rgb=False):
+    ''' traces module for the given input shapes and saves it to path '''
+    with torch.no_grad():
+        traced = torch.jit.trace(traceable(module, use_rgb).eval(), example_inputs)
+    torch.jit.save(traced, path)
+    return traced
+
+
+def takes_rgb(module):
+    ''' whether the backbone takes the rgb patch as a second input (unet2res) '''
+    return 'rgb' in inspect.signature(module.forward).parameters
+
+
+def export_onnx(module, example_inputs, path, use_rgb=False, opset=17):
+    '''
+    Exports module to an ONNX graph with inputs "mask" (and "rgb") and
+    output "output" (outputs "output", "output1", ... for networks returning
+    a tuple, e.g. the order predictors), all with a dynamic batch dimension.
+    '''
+    input_names = ['mask', 'rgb'] if use_rgb else ['mask']
+    # the exporter restores the mode of the wrapper (recursively) after tracing
+    module = traceable(module, use_rgb).eval()
+    with torch.no_grad():
+        outputs = module(*example_inputs)
+    num_outputs = len(outputs) if isinstance(outputs, (tuple, list)) else 1
+    output_names = ['output'] + ['output{}'.format(i) for i in range(1, num_outputs)]
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names}
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript exporter, newer torch defaults to the dynamo one
+        kwargs['dynamo'] = False
+    torch.onnx.export(
+        module, example_inputs, path, input_names=input_names,
+        output_names=output_names, dynamic_axes=dynamic_axes,
+        opset_version=opset, **kwargs)
+    return path
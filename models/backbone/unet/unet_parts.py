@@ -3,6 +3,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 
 class double_conv(nn.Module):
@@ -66,6 +67,9 @@ class up(nn.Module):
         diffY = x2.size()[2] - x1.size()[2]
         diffX = x2.size()[3] - x1.size()[3]
 
+        # unconditional, so that the block stays FX traceable (int8 deploy);
+        # for inputs divisible by 16 (e.g. input_size 256) the pad is zero and
+        # compiled graphs drop it
         x1 = F.pad(x1, (diffX // 2, diffX - diffX//2,
                         diffY // 2, diffY - diffY//2))
         
@@ -86,3 +90,41 @@ class outconv(nn.Module):
     def forward(self, x):
         x = self.conv(x)
         return x
+
+
+class frozen_bn_stats(object):
+    '''
+    context in which the BatchNorm layers of module normalize with the batch
+    statistics (train mode) but leave their running statistics unchanged
+    '''
+    def __init__(self, module):
+        self.bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+
+    def __enter__(self):
+        self.saved = [(bn.momentum, None if bn.num_batches_tracked is None
+                       else bn.num_batches_tracked.clone()) for bn in self.bns]
+        for bn in self.bns:
+            bn.momentum = 0.
+        return self
+
+    def __exit__(self, *exc):
+        for bn, (momentum, tracked) in zip(self.bns, self.saved):
+            bn.momentum = momentum
+            if tracked is not None:
+                bn.num_batches_tracked.copy_(tracked)
+
+
+def checkpointed(module, *inputs):
+    '''
+    module(*inputs) without keeping its intermediate activations for
+    backward, they are recomputed in backward instead. The recomputation
+    does not update the BatchNorm running statistics a second time.
+    '''
+    recompute = [False]
+    def run(*args):
+        if recompute[0]:
+            with frozen_bn_stats(module):
+                return module(*args)
+        recompute[0] = True
+        return module(*args)
+    return torch.utils.checkpoint.checkpoint(run, *inputs, use_reentrant=False)
@@ -3,14 +3,27 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from .unet_parts import inconv, down, up, outconv
+from .unet_parts import inconv, down, up, outconv, checkpointed
 from .. import resnet
+from torchvision.ops import roi_align
 from mmcv.ops import ModulatedDeformConv2dPack as Deform
 
 
 class UNetResNet(nn.Module):
-    def __init__(self, in_channels=3, w=4, n_classes=2, use_deform=False):
+    '''
+    checkpoint: groups of blocks whose activations are recomputed in backward
+        instead of kept (activation checkpointing), any of 'down' (inc,
+        down1-4), 'up' (up1-4) and 'image_encoder'. The block outputs
+        (skip connections) are still kept. Only applies in training.
+    '''
+    checkpoint_groups = ['down', 'up', 'image_encoder']
+
+    def __init__(self, in_channels=3, w=4, n_classes=2, use_deform=False, checkpoint=()):
         super(UNetResNet, self).__init__()
+        for group in checkpoint:
+            if group not in self.checkpoint_groups:
+                raise Exception("No such checkpoint group: {}".format(group))
+        self.checkpoint = list(checkpoint)
         self.inc = inconv(in_channels, int(16 * w))
         self.down1 = down(int(16 * w), int(32 * w))
         self.down2 = down(int(32 * w), int(64 * w))
@@ -31,22 +44,65 @@ class UNetResNet(nn.Module):
         if self.use_deform:
             self.deform = Deform(int(16 * w), int(16 * w), 3, padding=1)
 
-
-    def forward(self, x, rgb, return_feat=False):
-        x1 = self.inc(x)
-        x2 = self.down1(x1)
-        x3 = self.down2(x2)
-        x4 = self.down3(x3)
-        x5 = self.down4(x4)
-        img_feat = self.image_encoder(rgb)
+        self.encoder_stride = 32
+
+    def run(self, group, module, *inputs):
+        ''' module(*inputs), checkpointed if group is in checkpoint '''
+        if group in self.checkpoint and self.training and torch.is_grad_enabled():
+            return checkpointed(module, *inputs)
+        return module(*inputs)
+
+    def encode_image(self, rgb):
+        ''' image encoder features of whole images, see roi_image_feat '''
+        return self.run('image_encoder', self.image_encoder, rgb)
+
+    def roi_image_feat(self, feat, boxes, output_size):
+        '''
+        Pools encode_image features of the regions boxes (K5: batch index,
+        x1, y1, x2, y2 in pixels of the encoded images) to
+        K x out_dim x output_size x output_size, the shape the image encoder
+        gives for a crop of output_size * encoder_stride pixels.
+        '''
+        return roi_align(feat, boxes, output_size, spatial_scale=1. / self.encoder_stride,
+                         sampling_ratio=2, aligned=True)
+
+    def box_image_feat(self, rgb, rgb_box, size):
+        '''
+        rgb: whole images, rgb_box: N4 box (x1, y1, x2, y2) of the mask patch
+        in each, encoded as a whole and pooled at the patches for a size patch
+        (the roi_image_size training mode, as inference.roi_input)
+        '''
+        index = torch.arange(rgb.size(0), dtype=rgb_box.dtype, device=rgb_box.device)
+        boxes = torch.cat([index[:, None], rgb_box], dim=1)
+        return self.roi_image_feat(self.encode_image(rgb), boxes.to(rgb.dtype),
+                                   size // self.encoder_stride)
+
+    def forward(self, x, rgb=None, return_feat=False, img_feat=None, rgb_box=None):
+        '''
+        img_feat: image features pooled with roi_image_feat, used instead of
+            encoding rgb.
+        rgb_box: rgb are whole images with the patches at rgb_box, see
+            box_image_feat. Without it rgb is the patch crop.
+        '''
+        x1 = self.run('down', self.inc, x)
+        x2 = self.run('down', self.down1, x1)
+        x3 = self.run('down', self.down2, x2)
+        x4 = self.run('down', self.down3, x3)
+        x5 = self.run('down', self.down4, x4)
+        if img_feat is None:
+            # selected by argument, not by input shape: stays FX traceable
+            if rgb_box is not None:
+                img_feat = self.box_image_feat(rgb, rgb_box, x.size(2))
+            else:
+                img_feat = self.encode_image(rgb)
         img_feat = self.reduce_dim(img_feat)
         img_feat = F.interpolate(
             img_feat, size=(x5.size(2), x5.size(3)), mode='bilinear', align_corners=True)
         cat = torch.cat((x5, img_feat), dim=1) # 256 + 128 * w
-        x = self.up1(cat, x4)
-        x = self.up2(x, x3)
-        x = self.up3(x, x2)
-        x = self.up4(x, x1)
+        x = self.run('up', self.up1, cat, x4)
+        x = self.run('up', self.up2, x, x3)
+        x = self.run('up', self.up3, x, x2)
+        x = self.run('up', self.up4, x, x1)
 
         if self.use_deform:
             x = self.deform(x)
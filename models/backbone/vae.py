@@ -133,7 +133,7 @@ class VAE(nn.Module):
             up(16 * w, n_classes)
         )
         self.head_up = nn.Upsample(scale_factor=2, mode='bilinear', align_corners=True)
-        self.eps = torch.randn([1, latent_dim]).cuda()
+        self.register_buffer('eps', torch.randn([1, latent_dim]), persistent=False)
 
     def forward(self, x):
         x = self.encoder(x)
@@ -12,11 +12,12 @@ class GANModel(object):
         netD_params = params['discriminator']
 
         # define model
+        self.device = torch.device(params.get('device', 'cuda'))
         self.model = backbone.__dict__[params['backbone_arch']](**params['backbone_param'])
         utils.init_weights(self.model, init_type='xavier')
-        self.model.cuda()
+        self.model.to(self.device)
         if dist_model:
-            self.model = utils.DistModule(self.model)
+            self.model = utils.DistModule(self.model, params.get('bucket_cap_mb', 25))
             self.world_size = dist.get_world_size()
         else:
             self.model = backbone.FixModule(self.model)
@@ -35,9 +36,9 @@ class GANModel(object):
 
         # define netD
         self.netD = backbone.__dict__[netD_params['arch']](**netD_params['arch_param'])
-        self.netD.cuda()
+        self.netD.to(self.device)
         if dist_model:
-            self.netD = utils.DistModule(self.netD)
+            self.netD = utils.DistModule(self.netD, params.get('bucket_cap_mb', 25))
         else:
             self.netD = backbone.FixModule(self.netD)
 
@@ -73,25 +74,25 @@ class GANModel(object):
         discriminator_path = os.path.join(path, "D_iter_{}.pth.tar".format(Iter))
 
         if resume:
-            utils.load_state(model_path, self.model, self.optim)
-            utils.load_state(discriminator_path, self.netD, self.optimD)
+            utils.load_state(model_path, self.model, self.optim, map_location=self.device)
+            utils.load_state(discriminator_path, self.netD, self.optimD, map_location=self.device)
         else:
-            utils.load_state(model_path, self.model)
-            utils.load_state(discriminator_path, self.netD)
+            utils.load_state(model_path, self.model, map_location=self.device)
+            utils.load_state(discriminator_path, self.netD, map_location=self.device)
 
-    def save_state(self, path, Iter):
+    def save_state(self, path, Iter, writer=None):
         model_path = os.path.join(path, "ckpt_iter_{}.pth.tar".format(Iter))
         discriminator_path = os.path.join(path, "D_iter_{}.pth.tar".format(Iter))
 
-        torch.save({
-            'step': Iter,
-            'state_dict': self.model.state_dict(),
-            'optimizer': self.optim.state_dict()}, model_path)
-
-        torch.save({
-            'step': Iter,
-            'state_dict': self.netD.state_dict(),
-            'optimizer': self.optimD.state_dict()}, discriminator_path)
+        utils.save_checkpoint(Iter, {
+            model_path: {
+                'step': Iter,
+                'state_dict': self.model.state_dict(),
+                'optimizer': self.optim.state_dict()},
+            discriminator_path: {
+                'step': Iter,
+                'state_dict': self.netD.state_dict(),
+                'optimizer': self.optimD.state_dict()}}, writer)
 
     def switch_to(self, phase):
         if phase == 'train':
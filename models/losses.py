@@ -104,10 +104,10 @@ class MaskWeightedCrossEntropyGaussian(nn.Module):
         target = target.float()
 
         mean, std = predict[:, 0], predict[:, 1]
-        mean = mean.sigmoid()
         std = F.softplus(std) + 1e-6
 
-        pre_loss = 1/2 * (F.binary_cross_entropy(mean, target, reduction='none')/std.pow(2)) + 1/2 * std.pow(2)
+        # bce on the logits, stable under reduced precision
+        pre_loss = 1/2 * (F.binary_cross_entropy_with_logits(mean, target, reduction='none')/std.pow(2)) + 1/2 * std.pow(2)
 
         loss = (self.inmask_weight * pre_loss[mask==1].sum() + self.outmask_weight * pre_loss[mask==0].sum()) / (n * h * w+1)
 
@@ -184,12 +184,12 @@ class MaskWeightedNLLMumfordShah(nn.Module):
         mask = mask.bool()
         target = target.float()
 
-        mean = predict[:, 0]
-        mean = mean.sigmoid()
+        logit = predict[:, 0]
+        mean = logit.sigmoid()
 
         norm_loss = kornia.filters.spatial_gradient(mean.unsqueeze(1)).norm(p=1, dim=2)[:, 0]
 
-        pre_loss = F.binary_cross_entropy(mean, target, reduction='none') + norm_loss * 0.1
+        pre_loss = F.binary_cross_entropy_with_logits(logit, target, reduction='none') + norm_loss * 0.1
 
         loss = (self.inmask_weight * pre_loss[mask==1].sum() + self.outmask_weight * pre_loss[mask==0].sum()) / (n * h * w)
         return loss
@@ -214,16 +214,16 @@ class MaskWeightedNLLGaussianBoundary2(nn.Module):
         std_target = target[:, 1].float()
         target = target[:, 0].float()
 
-        mean, std = predict[:, 0], predict[:, 1]
+        mean, std_logit = predict[:, 0], predict[:, 1]
         mean = mean.sigmoid()
-        std = std.sigmoid().clamp(min=1e-16)
+        std = std_logit.sigmoid().clamp(min=1e-16)
 
         pre_loss = 1/2 * ((target - mean)/std).pow(2)
         # pre_loss = 1/2 * ((target - mean)/std).pow(2) + 1/2 * std.pow(2)
 
         pre_loss = (self.inmask_weight * pre_loss[mask==1].sum() + self.outmask_weight * pre_loss[mask==0].sum()) 
 
-        std_loss = F.binary_cross_entropy(std, std_target, reduction='none')
+        std_loss = F.binary_cross_entropy_with_logits(std_logit, std_target, reduction='none')
 
         std_loss = (self.inmask_weight * 2 * std_loss[std_target==1].sum() + self.outmask_weight * std_loss[std_target==0].sum())
 
@@ -289,10 +289,10 @@ class MaskWeightedNLLMumfordShahBoundary(nn.Module):
         std_target = target[:, 1].float()
         target = target[:, 0].float()
 
-        mean = predict[:, 0]
-        mean = mean.sigmoid()
+        logit = predict[:, 0]
+        mean = logit.sigmoid()
 
-        pre_loss = F.binary_cross_entropy(mean, target, reduction='none')
+        pre_loss = F.binary_cross_entropy_with_logits(logit, target, reduction='none')
 
         pre_loss = (self.inmask_weight * pre_loss[mask==1].sum() + self.outmask_weight * pre_loss[mask==0].sum()) 
         
@@ -17,15 +17,21 @@ class PartialCompletionContent(nn.Module):
         self.with_modal = params.get('with_modal', False)
 
         # model
+        self.device = torch.device(params.get('device', 'cuda'))
+        # mixed precision (model option amp), see utils.amp_dtype
+        self.amp_dtype = utils.amp_dtype(params, self.device)
+        self.scaler = utils.grad_scaler(self.device, self.amp_dtype)
+        # gradients are accumulated over accumulate_steps micro-batches
+        self.accumulate_steps = params.get('accumulate_steps', 1)
         self.model = backbone.__dict__[params['backbone_arch']](**params['backbone_param'])
         if load_pretrain is not None:
             assert load_pretrain.endswith('.pth'), "load_pretrain should end with .pth"
-            utils.load_weights(load_pretrain, self.model)
+            utils.load_weights(load_pretrain, self.model, map_location=self.device)
 
-        self.model.cuda()
+        self.model.to(self.device)
 
         if dist_model:
-            self.model = utils.DistModule(self.model)
+            self.model = utils.DistModule(self.model, params.get('bucket_cap_mb', 25))
             self.world_size = dist.get_world_size()
         else:
             self.model = backbone.FixModule(self.model)
@@ -36,20 +42,21 @@ class PartialCompletionContent(nn.Module):
             filter(lambda p: p.requires_grad, self.model.parameters()), lr=params['lr'])
 
         # loss
-        self.criterion = InpaintingLoss(backbone.VGG16FeatureExtractor()).cuda()
+        self.criterion = InpaintingLoss(backbone.VGG16FeatureExtractor()).to(self.device)
 
-        cudnn.benchmark = True
+        if self.device.type == 'cuda':
+            cudnn.benchmark = True
 
     def set_input(self, rgb, modal, visible_mask, rgb_gt=None):
-        self.rgb = rgb.cuda()
-        self.modal = modal.cuda()
+        self.rgb = rgb.to(self.device)
+        self.modal = modal.to(self.device)
         self.visible_mask3 = visible_mask.repeat(
-            1, 3, 1, 1).cuda()
+            1, 3, 1, 1).to(self.device)
         if self.with_modal:
             self.visible_mask4 = visible_mask.repeat(
-                1, 4, 1, 1).cuda()
+                1, 4, 1, 1).to(self.device)
         if rgb_gt is not None:
-            self.rgb_gt = rgb_gt.cuda()
+            self.rgb_gt = rgb_gt.to(self.device)
 
     def forward_only(self, ret_loss=True):
         with torch.no_grad():
@@ -73,12 +80,14 @@ class PartialCompletionContent(nn.Module):
         else:
             return ret_tensors
 
-    def step(self):
-        if self.with_modal:
-            output, _ = self.model(torch.cat([self.rgb, self.modal], dim=1),
-                                   self.visible_mask4)
-        else:
-            output, _ = self.model(self.rgb, self.visible_mask3)
+    def step(self, update=True):
+        with utils.autocast(self.device, self.amp_dtype):
+            if self.with_modal:
+                output, _ = self.model(torch.cat([self.rgb, self.modal], dim=1),
+                                       self.visible_mask4)
+            else:
+                output, _ = self.model(self.rgb, self.visible_mask3)
+        output = output.float()
         if output.shape[2] != self.rgb.shape[2]:
             output = nn.functional.interpolate(
                 output, size=self.rgb.shape[2:4],
@@ -90,26 +99,30 @@ class PartialCompletionContent(nn.Module):
         for key, coef in self.params['lambda_dict'].items():
             value = coef * loss_dict[key]
             loss += value
-        self.optim.zero_grad()
-        loss.backward()
-        utils.average_gradients(self.model)
-        self.optim.step()
+        with utils.grad_sync(self.model, update):
+            self.scaler.scale(loss / self.accumulate_steps).backward()
+        if update:
+            utils.average_gradients(self.model)
+            self.scaler.step(self.optim)
+            self.scaler.update()
+            self.optim.zero_grad()
         return loss_dict
 
     def load_state(self, path, Iter, resume=False):
         path = os.path.join(path, "ckpt_iter_{}.pth.tar".format(Iter))
 
         if resume:
-            utils.load_state(path, self.model, self.optim)
+            utils.load_state(path, self.model, self.optim, map_location=self.device)
         else:
-            utils.load_state(path, self.model)
+            utils.load_state(path, self.model, map_location=self.device)
 
-    def save_state(self, path, Iter):
+    def save_state(self, path, Iter, writer=None):
         path = os.path.join(path, "ckpt_iter_{}.pth.tar".format(Iter))
-        torch.save({
+
+        utils.save_checkpoint(Iter, {path: {
             'step': Iter,
             'state_dict': self.model.state_dict(),
-            'optimizer': self.optim.state_dict()}, path)
+            'optimizer': self.optim.state_dict()}}, writer)
 
     def switch_to(self, phase):
         if phase == 'train':
@@ -17,15 +17,21 @@ class PartialCompletionContentCGAN(nn.Module):
         self.with_modal = params.get('with_modal', False)
 
         # model
+        self.device = torch.device(params.get('device', 'cuda'))
+        # mixed precision (model option amp), see utils.amp_dtype
+        self.amp_dtype = utils.amp_dtype(params, self.device)
+        self.scaler = utils.grad_scaler(self.device, self.amp_dtype)
+        # gradients are accumulated over accumulate_steps micro-batches
+        self.accumulate_steps = params.get('accumulate_steps', 1)
         self.model = backbone.__dict__[params['backbone_arch']](**params['backbone_param'])
         if load_pretrain is not None:
             assert load_pretrain.endswith('.pth'), "load_pretrain should end with .pth"
-            utils.load_weights(load_pretrain, self.model)
+            utils.load_weights(load_pretrain, self.model, map_location=self.device)
 
-        self.model.cuda()
+        self.model.to(self.device)
 
         if dist_model:
-            self.model = utils.DistModule(self.model)
+            self.model = utils.DistModule(self.model, params.get('bucket_cap_mb', 25))
             self.world_size = dist.get_world_size()
         else:
             self.model = backbone.FixModule(self.model)
@@ -41,31 +47,32 @@ class PartialCompletionContentCGAN(nn.Module):
 
         # netD
         self.netD = backbone.__dict__[params['discriminator']](**params['discriminator_params'])
-        self.netD.cuda()
+        self.netD.to(self.device)
         if dist_model:
-            self.netD = utils.DistModule(self.netD)
+            self.netD = utils.DistModule(self.netD, params.get('bucket_cap_mb', 25))
         else:
             self.netD = backbone.FixModule(self.netD)
         self.optimD = torch.optim.Adam(
             self.netD.parameters(), lr=params['lr'] * params['d2g_lr'], betas=(0.0, 0.9))
 
         # loss
-        self.criterion = InpaintingLoss(backbone.VGG16FeatureExtractor()).cuda()
-        self.gan_criterion = AdversarialLoss(type=params['gan_type']).cuda()
+        self.criterion = InpaintingLoss(backbone.VGG16FeatureExtractor()).to(self.device)
+        self.gan_criterion = AdversarialLoss(type=params['gan_type']).to(self.device)
 
-        cudnn.benchmark = True
+        if self.device.type == 'cuda':
+            cudnn.benchmark = True
 
     def set_input(self, rgb, visible_mask, modal, rgb_gt=None):
-        self.rgb = rgb.cuda()
+        self.rgb = rgb.to(self.device)
         if self.with_modal:
-            self.modal = modal.cuda()
+            self.modal = modal.to(self.device)
         self.visible_mask3 = visible_mask.repeat(
-            1, 3, 1, 1).cuda()
+            1, 3, 1, 1).to(self.device)
         if self.with_modal:
             self.visible_mask4 = visible_mask.repeat(
-                1, 4, 1, 1).cuda()
+                1, 4, 1, 1).to(self.device)
         if rgb_gt is not None:
-            self.rgb_gt = rgb_gt.cuda()
+            self.rgb_gt = rgb_gt.to(self.device)
 
     def forward_only(self, ret_loss=True):
         with torch.no_grad():
@@ -94,13 +101,15 @@ class PartialCompletionContentCGAN(nn.Module):
         else:
             return ret_tensors
 
-    def step(self):
-        # output
-        if self.with_modal:
-            output, _ = self.model(torch.cat([self.rgb, self.modal], dim=1),
-                                   self.visible_mask4)
-        else:
-            output, _ = self.model(self.rgb, self.visible_mask3)
+    def step(self, update=True):
+        # output, losses are computed in fp32
+        with utils.autocast(self.device, self.amp_dtype):
+            if self.with_modal:
+                output, _ = self.model(torch.cat([self.rgb, self.modal], dim=1),
+                                       self.visible_mask4)
+            else:
+                output, _ = self.model(self.rgb, self.visible_mask3)
+        output = output.float()
         if output.shape[2] != self.rgb.shape[2]:
             output = nn.functional.interpolate(
                 output, size=self.rgb.shape[2:4],
@@ -109,12 +118,14 @@ class PartialCompletionContentCGAN(nn.Module):
         # discriminator loss
         dis_input_real = self.rgb_gt
         dis_input_fake = output.detach()
-        if self.with_modal:
-            dis_real, _ = self.netD(torch.cat([dis_input_real, self.modal], dim=1))
-            dis_fake, _ = self.netD(torch.cat([dis_input_fake, self.modal], dim=1))
-        else:
-            dis_real, _ = self.netD(dis_input_real)
-            dis_fake, _ = self.netD(dis_input_fake)
+        with utils.autocast(self.device, self.amp_dtype):
+            if self.with_modal:
+                dis_real, _ = self.netD(torch.cat([dis_input_real, self.modal], dim=1))
+                dis_fake, _ = self.netD(torch.cat([dis_input_fake, self.modal], dim=1))
+            else:
+                dis_real, _ = self.netD(dis_input_real)
+                dis_fake, _ = self.netD(dis_input_fake)
+        dis_real, dis_fake = dis_real.float(), dis_fake.float()
         dis_real_loss = self.gan_criterion(dis_real, True, True) / self.world_size
         dis_fake_loss = self.gan_criterion(dis_fake, False, True) / self.world_size
         dis_loss = (dis_real_loss + dis_fake_loss) / 2
@@ -122,11 +133,17 @@ class PartialCompletionContentCGAN(nn.Module):
         # generator adversarial loss
         gen_loss = 0
         gen_input_fake = output
-        if self.with_modal:
-            gen_fake, _ = self.netD(torch.cat([gen_input_fake, self.modal], dim=1))
-        else:
-            gen_fake, _ = self.netD(gen_input_fake)
-        gen_gan_loss = self.gan_criterion(gen_fake, True, False) * \
+        # the generator loss only reaches the generator
+        for p in self.netD.parameters():
+            p.requires_grad_(False)
+        with utils.autocast(self.device, self.amp_dtype):
+            if self.with_modal:
+                gen_fake, _ = self.netD(torch.cat([gen_input_fake, self.modal], dim=1))
+            else:
+                gen_fake, _ = self.netD(gen_input_fake)
+        for p in self.netD.parameters():
+            p.requires_grad_(True)
+        gen_gan_loss = self.gan_criterion(gen_fake.float(), True, False) * \
             self.params['adv_loss_weight'] / self.world_size
         gen_loss += gen_gan_loss
 
@@ -142,46 +159,50 @@ class PartialCompletionContentCGAN(nn.Module):
         loss_dict['dis'] = dis_loss
         loss_dict['adv'] = gen_gan_loss
 
-        # update
-        self.optimD.zero_grad()
-        dis_loss.backward()
-        utils.average_gradients(self.netD)
-        self.optimD.step()
-
-        self.optim.zero_grad()
-        gen_loss.backward()
-        utils.average_gradients(self.model)
-        self.optim.step()
+        # update, one scaler for both optimizers. Gradients are accumulated
+        # over micro-batches
+        with utils.grad_sync(self.netD, update):
+            self.scaler.scale(dis_loss / self.accumulate_steps).backward()
+        with utils.grad_sync(self.model, update):
+            self.scaler.scale(gen_loss / self.accumulate_steps).backward()
+        if update:
+            utils.average_gradients(self.netD)
+            self.scaler.step(self.optimD)
+            utils.average_gradients(self.model)
+            self.scaler.step(self.optim)
+            self.scaler.update()
+            self.optimD.zero_grad()
+            self.optim.zero_grad()
 
         return loss_dict
 
     def load_model_demo(self, path):
-        utils.load_state(path, self.model)
+        utils.load_state(path, self.model, map_location=self.device)
 
     def load_state(self, root, Iter, resume=False):
         path = os.path.join(root, "ckpt_iter_{}.pth.tar".format(Iter))
         netD_path = os.path.join(root, "D_iter_{}.pth.tar".format(Iter))
 
         if resume:
-            utils.load_state(path, self.model, self.optim)
-            utils.load_state(netD_path, self.netD, self.optimD)
+            utils.load_state(path, self.model, self.optim, map_location=self.device)
+            utils.load_state(netD_path, self.netD, self.optimD, map_location=self.device)
         else:
-            utils.load_state(path, self.model)
-            utils.load_state(netD_path, self.netD)
+            utils.load_state(path, self.model, map_location=self.device)
+            utils.load_state(netD_path, self.netD, map_location=self.device)
 
-    def save_state(self, root, Iter):
+    def save_state(self, root, Iter, writer=None):
         path = os.path.join(root, "ckpt_iter_{}.pth.tar".format(Iter))
         netD_path = os.path.join(root, "D_iter_{}.pth.tar".format(Iter))
 
-        torch.save({
-            'step': Iter,
-            'state_dict': self.model.state_dict(),
-            'optimizer': self.optim.state_dict()}, path)
-
-        torch.save({
-            'step': Iter,
-            'state_dict': self.netD.state_dict(),
-            'optimizer': self.optimD.state_dict()}, netD_path)
+        utils.save_checkpoint(Iter, {
+            path: {
+                'step': Iter,
+                'state_dict': self.model.state_dict(),
+                'optimizer': self.optim.state_dict()},
+            netD_path: {
+                'step': Iter,
+                'state_dict': self.netD.state_dict(),
+                'optimizer': self.optimD.state_dict()}}, writer)
 
     def switch_to(self, phase):
         if phase == 'train':
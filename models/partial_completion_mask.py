@@ -8,6 +8,7 @@ import inference as infer
 from . import SingleStageModel
 from . import MaskWeightedCrossEntropyLoss
 from torch.nn import functional as F
+from torchvision.ops import roi_align
 import pdb
 import math
 
@@ -36,20 +37,25 @@ class PartialCompletionMask(SingleStageModel):
         self.criterion = getattr(losses, loss_name)(
                 inmask_weight=params['inmask_weight'], outmask_weight=1.)
 
-    def set_input(self, rgb=None, mask=None, eraser=None, target=None):
-        self.eraser_boundary = eraser[:, :1].cuda()
-        self.eraser = eraser[:, 1:2].cuda()
+    def set_input(self, rgb=None, mask=None, eraser=None, target=None, rgb_box=None):
+        '''
+        rgb_box: patch boxes in rgb when rgb holds whole images (data option
+            roi_image_size), see UNetResNet.box_image_feat
+        '''
+        self.rgb_kwargs = {} if rgb_box is None else {'rgb_box': rgb_box.to(self.device)}
+        self.eraser_boundary = eraser[:, :1].to(self.device)
+        self.eraser = eraser[:, 1:2].to(self.device)
         # self.modal_boundary = eraser[:, 2:3].cuda()
-        self.target = target.cuda()
-        self.rgb = rgb.cuda()
+        self.target = target.to(self.device)
+        self.rgb = rgb.to(self.device)
         if self.use_cnp:
             temp = torch.zeros_like(mask)
             temp[mask==1] = 1
             temp[mask==0] = -1
             temp[self.eraser==1] = 0
-            self.mask = temp.cuda()
+            self.mask = temp.to(self.device)
         else:
-            self.mask = mask.cuda()
+            self.mask = mask.to(self.device)
 
     def evaluate(self, image, inmodal, category, bboxes, amodal, gt_order_matrix, input_size):
         print('...entered evaluate function')
@@ -87,7 +93,8 @@ class PartialCompletionMask(SingleStageModel):
                 dilate_kernel=self.params['inference'].get('dilate_kernel_amodal', 0),
                 input_size=input_size,
                 min_input_size=16, interp=self.params['inference']['amodal_interp'],
-                order_grounded=self.params['inference']['order_grounded'])
+                order_grounded=self.params['inference']['order_grounded'],
+                skip_th=self.params['inference'].get('amodal_skip_th', -1))
             amodal_pred = infer.patch_to_fullimage(
                 amodal_patches_pred, bboxes,
                 image.shape[0], image.shape[1],
@@ -119,10 +126,12 @@ class PartialCompletionMask(SingleStageModel):
             # else:
             #     output = output_.clone()
 
-            if self.use_rgb:
-                output_ = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1), self.rgb)
-            else:
-                output_ = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1))
+            with self.autocast():
+                if self.use_rgb:
+                    output_ = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1), self.rgb, **self.rgb_kwargs)
+                else:
+                    output_ = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1))
+            output_ = output_.float()
 
             output = output_.clone()
 
@@ -168,7 +177,7 @@ class PartialCompletionMask(SingleStageModel):
         vis_target = vis_target.unsqueeze(1)
 
         if self.use_rgb and val:
-            cm_tensors = [self.rgb.flip([1])]
+            cm_tensors = [self.display_rgb().flip([1])]
         else:
             cm_tensors = []
         
@@ -182,15 +191,23 @@ class PartialCompletionMask(SingleStageModel):
         else:
             return ret_tensors
 
-    def step(self):
-        if self.use_rgb:
-            output = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1), self.rgb)
-        else:
-            output = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1))
+    def display_rgb(self):
+        ''' the rgb patches, cropped from the whole images with rgb_box '''
+        if 'rgb_box' not in self.rgb_kwargs:
+            return self.rgb
+        box = self.rgb_kwargs['rgb_box']
+        index = torch.arange(box.size(0), dtype=box.dtype, device=box.device)
+        return roi_align(self.rgb, torch.cat([index[:, None], box], dim=1).to(self.rgb.dtype),
+                         self.mask.shape[2:], aligned=True)
+
+    def step(self, update=True):
+        with self.autocast():
+            if self.use_rgb:
+                output = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1), self.rgb, **self.rgb_kwargs)
+            else:
+                output = self.model(torch.cat([self.mask, self.eraser_boundary], dim=1))
         
-        loss = self.criterion(output, self.target, self.eraser.squeeze(1)) / self.world_size
-        self.optim.zero_grad()
-        loss.backward()
-        utils.average_gradients(self.model)
-        self.optim.step()
+        # losses in fp32
+        loss = self.criterion(output.float(), self.target, self.eraser.squeeze(1)) / self.world_size
+        self.backward_step(loss, update)
         return {'loss': loss}
@@ -4,16 +4,32 @@ import torch.backends.cudnn as cudnn
 import torch.distributed as dist
 
 from models import backbone
+from models.backbone import compiled
 import utils
 
 class SingleStageModel(object):
 
     def __init__(self, params, dist_model=False):
+        self.device = torch.device(params.get('device', 'cuda'))
+        # mixed precision (model option amp), see utils.amp_dtype
+        self.amp_dtype = utils.amp_dtype(params, self.device)
+        self.scaler = utils.grad_scaler(self.device, self.amp_dtype)
+        # gradients are accumulated over accumulate_steps micro-batches
+        self.accumulate_steps = params.get('accumulate_steps', 1)
         self.model = backbone.__dict__[params['backbone_arch']](**params['backbone_param'])
         utils.init_weights(self.model, init_type='xavier')
-        self.model.cuda()
+        self.model.to(self.device)
+        # opt-in torch.compile of the backbone forward (model option compile:
+        # true or a backend name), TorchScript is for inference only, see
+        # inference.compile_model
+        compile_backend = params.get('compile', False)
+        if compile_backend:
+            if compile_backend == 'torchscript':
+                raise Exception("torchscript is inference only, see inference.compile_model")
+            compiled.compile_module(
+                self.model, backend='inductor' if compile_backend is True else compile_backend)
         if dist_model:
-            self.model = utils.DistModule(self.model)
+            self.model = utils.DistModule(self.model, params.get('bucket_cap_mb', 25))
             self.world_size = dist.get_world_size()
         else:
             self.model = backbone.FixModule(self.model)
@@ -30,33 +46,53 @@ class SingleStageModel(object):
         else:   
             raise Exception("No such optimizer: {}".format(params['optim']))
 
-        cudnn.benchmark = True
+        if self.device.type == 'cuda':
+            cudnn.benchmark = True
 
     def forward_only(self, ret_loss=True):
         pass
 
-    def step(self):
+    def step(self, update=True):
         pass
 
+    def autocast(self):
+        return utils.autocast(self.device, self.amp_dtype)
+
+    def backward_step(self, loss, update=True):
+        '''
+        backward, with loss scaling under float16 amp. Gradients of
+        accumulate_steps micro-batches add up; only the last one (update)
+        averages them across processes, overlapped with its backward (see
+        utils.DistModule), and steps the optimizer.
+        Parameters and checkpoints stay fp32.
+        '''
+        with utils.grad_sync(self.model, update):
+            self.scaler.scale(loss / self.accumulate_steps).backward()
+        if update:
+            utils.average_gradients(self.model)
+            self.scaler.step(self.optim)
+            self.scaler.update()
+            self.optim.zero_grad()
+
     def load_state(self, path, Iter=None, resume=False):
         if Iter is not None:
             path = os.path.join(path, "ckpt_iter_{}.pth.tar".format(Iter))
 
         if resume:
-            utils.load_state(path, self.model, self.optim)
+            utils.load_state(path, self.model, self.optim, map_location=self.device)
         else:
-            utils.load_state(path, self.model)
+            utils.load_state(path, self.model, map_location=self.device)
 
     def load_pretrain(self, load_path):
-        utils.load_state(load_path, self.model)
+        utils.load_state(load_path, self.model, map_location=self.device)
 
-    def save_state(self, path, Iter):
+    def save_state(self, path, Iter, writer=None):
         path = os.path.join(path, "ckpt_iter_{}.pth.tar".format(Iter))
 
-        torch.save({
+        utils.save_checkpoint(Iter, {path: {
             'step': Iter,
             'state_dict': self.model.state_dict(),
-            'optimizer': self.optim.state_dict()}, path)
+            'optimizer': self.optim.state_dict()}}, writer)
 
     def switch_to(self, phase):
         if phase == 'train':
@@ -20,9 +20,9 @@ class Supervised(SingleStageModel):
         self.criterion = nn.CrossEntropyLoss()
 
     def set_input(self, rgb=None, mask=None, target=None):
-        self.rgb = rgb.cuda()
-        self.mask = mask.cuda()
-        self.target = target.cuda()
+        self.rgb = rgb.to(self.device)
+        self.mask = mask.to(self.device)
+        self.target = target.to(self.device)
 
     def evaluate(self, image, inmodal, category, bboxes, amodal, gt_order_matrix, input_size):
         # amodal
@@ -44,10 +44,12 @@ class Supervised(SingleStageModel):
 
     def forward_only(self, ret_loss=True, val=False):
         with torch.no_grad():
-            if self.use_rgb:
-                output = self.model(self.mask, self.rgb)
-            else:
-                output = self.model(self.mask)
+            with self.autocast():
+                if self.use_rgb:
+                    output = self.model(self.mask, self.rgb)
+                else:
+                    output = self.model(self.mask)
+            output = output.float()
             if output.shape[2] != self.mask.shape[2]:
                 output = nn.functional.interpolate(
                     output, size=self.mask.shape[2:4],
@@ -70,14 +72,12 @@ class Supervised(SingleStageModel):
         else:
             return ret_tensors
 
-    def step(self):
-        if self.use_rgb:
-            output = self.model(self.mask, self.rgb)
-        else:
-            output = self.model(self.mask)
-        loss = self.criterion(output, self.target) / self.world_size
-        self.optim.zero_grad()
-        loss.backward()
-        utils.average_gradients(self.model)
-        self.optim.step()
+    def step(self, update=True):
+        with self.autocast():
+            if self.use_rgb:
+                output = self.model(self.mask, self.rgb)
+            else:
+                output = self.model(self.mask)
+        loss = self.criterion(output.float(), self.target) / self.world_size
+        self.backward_step(loss, update)
         return {'loss': loss}
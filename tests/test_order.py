@@ -0,0 +1,27 @@
+import sys
+import numpy as np
+import pytest
+sys.path.append('.')
+import inference as infer
+
+
+def masks(num, height=20, width=20):
+    inmodal = np.zeros((num, height, width), dtype=np.uint8)
+    for i in range(num):
+        inmodal[i, 3 + 4 * i:9 + 4 * i, 3:9] = 1
+    return inmodal
+
+ORDER_FUNCS = [
+    ('area', lambda m: infer.infer_order_area(m)),
+    ('area_smaller', lambda m: infer.infer_order_area(m, above='smaller')),
+    ('yaxis', infer.infer_order_yaxis),
+    ('hull', infer.infer_order_hull),
+    ('gt', lambda m: infer.infer_gt_order(m, m)),
+]
+
+@pytest.mark.parametrize('num', [0, 1])
+@pytest.mark.parametrize('name,func', ORDER_FUNCS, ids=[n for n, _ in ORDER_FUNCS])
+def test_order_few_instances(name, func, num):
+    order_matrix = func(masks(num))
+    assert order_matrix.shape == (num, num)
+    assert not order_matrix.any()
@@ -4,6 +4,8 @@ import numpy as np
 import json
 import sys
 import pycocotools.mask as maskUtils
+sys.path.append('.')
+import utils
 
 def read_annot(ann, h, w):
     modal = maskUtils.decode(maskUtils.frPyObjects(ann['inmodal_seg'], h, w))
@@ -22,7 +24,10 @@ def helper(args):
     return task(*args)
 
 def compute(data, annot_data, size_dict):
-    num = len(data)
+    '''
+    data: results in the order of annot_data, may be an iterator (utils.iter_results)
+    '''
+    num = len(annot_data)
     pool = mp.Pool(16)
     args = zip(annot_data, data, [size_dict] * num)
     ret = list(tqdm.tqdm(pool.imap(helper, args), total=num))
@@ -36,7 +41,7 @@ if __name__ == "__main__":
         res_data = json.load(open(res_fn, 'r'))['annotations']
     else:
         res_fn = '{}/amodalcomp_test_{}.json'.format(fold, method)
-        res_data = json.load(open(res_fn, 'r'))
+        res_data = utils.iter_results(res_fn)
     annot_fn = 'data/KINS/instances_val.json'
 
     annot_data = json.load(open(annot_fn, 'r'))
@@ -0,0 +1,131 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import torch
+sys.path.append('.')
+from models import backbone
+from models.backbone import compiled, deploy
+import utils
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='eager vs compiled backbone step time on cpu, randomly initialised')
+    parser.add_argument('--archs', default=['unet2', 'unet2res', 'unet2PredictOrder',
+                                            'unet2resPredictOrder'], nargs='+')
+    parser.add_argument('--modes', default=['eager', 'inductor', 'torchscript', 'int8'], nargs='+',
+                        choices=['eager', 'inductor', 'torchscript', 'int8'],
+                        help='torchscript and int8 (fold_bn + FX quantization, as tools/test.py '
+                             '--deploy int8) are timed for inference only')
+    parser.add_argument('--in-channels', default=2, type=int)
+    parser.add_argument('--input-size', default=256, type=int)
+    parser.add_argument('--train-batch', default=4, type=int)
+    parser.add_argument('--infer-batch', default=1, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int, help='untimed steps after compilation')
+    parser.add_argument('--threads', default=0, type=int, help='0 for torch default')
+    parser.add_argument('--output', default=None, type=str, help='json file of the results')
+    args = parser.parse_args()
+    return args
+
+def build_net(arch, in_channels):
+    torch.manual_seed(0)
+    net = backbone.__dict__[arch](in_channels, n_classes=2)
+    utils.init_weights(net, init_type='xavier')
+    return net
+
+def output_sum(output):
+    # the order predictors return (mask output, order logits)
+    if isinstance(output, (tuple, list)):
+        return sum(o.float().sum() for o in output)
+    return output.float().sum()
+
+def time_steps(step, args):
+    '''
+    seconds of the first call (compilation included) and the mean of the
+    timed calls after warmup
+    '''
+    start = time.time()
+    step()
+    first = time.time() - start
+    for _ in range(args.warmup):
+        step()
+    times = []
+    for _ in range(args.iters):
+        start = time.time()
+        step()
+        times.append(time.time() - start)
+    return first, float(np.mean(times))
+
+def bench_train(arch, mode, args):
+    net = build_net(arch, args.in_channels).train()
+    if mode == 'inductor':
+        compiled.compile_module(net, backend='inductor')
+    use_rgb = deploy.takes_rgb(net)
+    inputs = compiled.example_inputs(args.in_channels, args.input_size, use_rgb, args.train_batch)
+    inputs = tuple(torch.rand_like(x) for x in inputs)
+    optim = torch.optim.SGD(net.parameters(), lr=1e-4, momentum=0.9)
+
+    def step():
+        optim.zero_grad()
+        output_sum(net(*inputs)).backward()
+        optim.step()
+    return time_steps(step, args)
+
+def bench_infer(arch, mode, args):
+    net = build_net(arch, args.in_channels).eval()
+    use_rgb = deploy.takes_rgb(net)
+    inputs = compiled.example_inputs(args.in_channels, args.input_size, use_rgb, args.infer_batch)
+    inputs = tuple(torch.rand_like(x) for x in inputs)
+    start = time.time()
+    if mode == 'inductor':
+        compiled.compile_module(net, backend='inductor')
+    elif mode == 'torchscript':
+        net = compiled.trace_module(net, inputs, use_rgb=use_rgb)
+    elif mode == 'int8':
+        # fails if the backbone stopped being FX traceable
+        prepared = deploy.prepare_int8(deploy.fold_bn(net), inputs, use_rgb=use_rgb)
+        with torch.no_grad():
+            prepared(*inputs) # calibration
+        net = deploy.convert_int8(prepared)
+    prepare = time.time() - start
+
+    def step():
+        with torch.inference_mode():
+            net(*inputs)
+    first, mean = time_steps(step, args)
+    return prepare + first, mean
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    results = []
+    for arch in args.archs:
+        for phase, bench in [('train', bench_train), ('infer', bench_infer)]:
+            eager = None
+            for mode in args.modes:
+                if phase == 'train' and mode in ['torchscript', 'int8']:
+                    continue
+                first, step_time = bench(arch, mode, args)
+                if mode == 'eager':
+                    eager = step_time
+                results.append({'arch': arch, 'phase': phase, 'mode': mode,
+                                'first_s': first, 'step_ms': 1000. * step_time,
+                                'speedup': eager / step_time if eager is not None else None})
+                print("{:<22s} {:<5s} {:<11s} first: {:8.2f} s  step: {:9.2f} ms  speedup: {}".format(
+                    arch, phase, mode, first, 1000. * step_time,
+                    '{:.3f}'.format(results[-1]['speedup']) if eager is not None else '-'))
+
+    if args.output is not None:
+        if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+            os.makedirs(os.path.dirname(args.output))
+        with open(args.output, 'w') as f:
+            json.dump({'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                       'input_size': args.input_size, 'train_batch': args.train_batch,
+                       'infer_batch': args.infer_batch, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,94 @@
+import argparse
+import os
+import sys
+import time
+import yaml
+import numpy as np
+from PIL import Image
+import torch
+import torchvision.transforms as transforms
+sys.path.append('.')
+from datasets import reader
+import models
+import inference as infer
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='images/sec of infer_order + infer_amodal on CPU')
+    parser.add_argument('--config', required=True, type=str)
+    parser.add_argument('--load-model', required=True, type=str)
+    parser.add_argument('--annotation', required=True, type=str)
+    parser.add_argument('--image-root', required=True, type=str)
+    parser.add_argument('--num-images', default=50, type=int)
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='0 for torch default')
+    parser.add_argument('--no-channels-last', action='store_true')
+    parser.add_argument('--order-th', default=0.5, type=float)
+    parser.add_argument('--amodal-th', default=0.5, type=float)
+    args = parser.parse_args()
+    return args
+
+def build_reader(dataset, annotation):
+    if dataset == 'COCOA':
+        return reader.COCOADataset(annotation)
+    elif dataset == 'KINSNew':
+        return reader.KINSNewDataset(dataset, annotation)
+    else:
+        return reader.KINSLVISDataset(dataset, annotation)
+
+def main(args):
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    for k, v in config.items():
+        setattr(args, k, v)
+
+    args.model['device'] = 'cpu'
+    model = models.__dict__[args.model['algo']](args.model, dist_model=False)
+    model.load_state(args.load_model)
+    model.switch_to('eval')
+    infer.setup_cpu_inference(model, num_threads=args.threads,
+                              channels_last=not args.no_channels_last)
+
+    args.img_transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(args.data['data_mean'], args.data['data_std'])
+    ])
+
+    data_reader = build_reader(args.data['dataset'], args.annotation)
+    num = min(args.num_images + args.warmup, data_reader.get_image_length())
+    use_rgb = args.model['use_rgb']
+
+    order_time, amodal_time, timed = 0., 0., 0
+    for i in range(num):
+        modal, category, bboxes, _, image_fn = data_reader.get_image_instances(i)
+        image = Image.open(os.path.join(args.image_root, image_fn)).convert('RGB')
+        if image.size[0] != modal.shape[2] or image.size[1] != modal.shape[1]:
+            image = image.resize((modal.shape[2], modal.shape[1]))
+        image = np.array(image)
+        bboxes = infer.expand_bboxes(bboxes, args.data['enlarge_box'])
+
+        start = time.time()
+        order_matrix = infer.infer_order(
+            model, image, modal, category, bboxes, use_rgb=use_rgb, th=args.order_th,
+            input_size=256, min_input_size=16, interp='nearest', args=args)
+        mid = time.time()
+        infer.infer_amodal(
+            model, image, modal, category, bboxes, order_matrix, use_rgb=use_rgb,
+            th=args.amodal_th, input_size=256, min_input_size=16, interp='linear',
+            order_grounded=True, args=args)
+        end = time.time()
+
+        if i >= args.warmup:
+            order_time += mid - start
+            amodal_time += end - mid
+            timed += 1
+
+    total = order_time + amodal_time
+    print("threads: {}, channels_last: {}, images: {}".format(
+        torch.get_num_threads(), not args.no_channels_last, timed))
+    print("infer_order: {:.4g} s/img, infer_amodal: {:.4g} s/img, throughput: {:.4g} images/sec".format(
+        order_time / max(timed, 1), amodal_time / max(timed, 1), timed / max(total, 1e-10)))
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+sys.path.append('.')
+import models
+
+MODES = {
+    # name: (bucket_cap_mb, overlap with backward)
+    'per-tensor': (0, False),
+    'bucketed': (25, False),
+    'overlapped': (25, True),
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='data parallel training step time on cpu with gloo, per gradient sync mode')
+    parser.add_argument('--arch', default='unet2', choices=['unet2', 'unet2res'])
+    parser.add_argument('--procs', default=[1, 2, 4, 8], type=int, nargs='+')
+    parser.add_argument('--modes', default=list(MODES.keys()), nargs='+', choices=list(MODES.keys()))
+    parser.add_argument('--batch-size', default=2, type=int, help='per process')
+    parser.add_argument('--input-size', default=128, type=int)
+    parser.add_argument('--iters', default=10, type=int)
+    parser.add_argument('--warmup', default=2, type=int)
+    parser.add_argument('--threads', default=1, type=int, help='torch threads per process')
+    parser.add_argument('--output', default=None, type=str, help='json file of the results')
+    args = parser.parse_args()
+    return args
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def build_model(args, mode):
+    params = {'algo': 'PartialCompletionMask', 'backbone_arch': args.arch,
+              'backbone_param': {'in_channels': 2, 'n_classes': 2},
+              'use_rgb': args.arch == 'unet2res', 'inmask_weight': 5.,
+              'optim': 'SGD', 'lr': 0.001, 'weight_decay': 0.0001, 'device': 'cpu',
+              'bucket_cap_mb': MODES[mode][0]}
+    model = models.__dict__[params['algo']](params, dist_model=True)
+    # without overlap all buckets are reduced after backward
+    model.model.require_grad_sync = MODES[mode][1]
+    model.switch_to('train')
+    return model
+
+def worker(rank, world_size, port, args, queue):
+    torch.set_num_threads(args.threads)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=world_size)
+    torch.manual_seed(rank)
+    n, s = args.batch_size, args.input_size
+    inputs = (torch.randn(n, 3, s, s), (torch.rand(n, 1, s, s) > 0.5).float(),
+              (torch.rand(n, 2, s, s) > 0.5).float(), (torch.rand(n, s, s) > 0.5).long())
+    results = {}
+    for mode in args.modes:
+        model = build_model(args, mode)
+        model.set_input(*inputs)
+        times = []
+        for i in range(args.warmup + args.iters):
+            dist.barrier()
+            start = time.time()
+            model.step()
+            if i >= args.warmup:
+                times.append(time.time() - start)
+        # the slowest process sets the pace
+        step_time = torch.tensor(np.mean(times))
+        dist.all_reduce(step_time, op=dist.ReduceOp.MAX)
+        results[mode] = step_time.item()
+    if rank == 0:
+        queue.put(results)
+    dist.destroy_process_group()
+
+def main(args):
+    ctx = mp.get_context('spawn')
+    results = []
+    for world_size in args.procs:
+        queue = ctx.Queue()
+        port = free_port()
+        procs = [ctx.Process(target=worker, args=(rank, world_size, port, args, queue))
+                 for rank in range(world_size)]
+        for p in procs:
+            p.start()
+        times = queue.get()
+        for p in procs:
+            p.join()
+        for mode, t in times.items():
+            results.append({'procs': world_size, 'mode': mode, 'step_ms': 1000. * t,
+                            'samples_per_s': world_size * args.batch_size / t})
+
+    # scaling efficiency: throughput over procs x the throughput of the fewest procs
+    for mode in args.modes:
+        curve = [r for r in results if r['mode'] == mode]
+        base = curve[0]['samples_per_s'] / curve[0]['procs']
+        for r in curve:
+            r['efficiency'] = r['samples_per_s'] / (r['procs'] * base)
+            print("{:2d} procs  {:<11s} step: {:9.2f} ms  {:8.2f} samples/s  efficiency: {:.3f}".format(
+                r['procs'], mode, r['step_ms'], r['samples_per_s'], r['efficiency']))
+
+    if args.output is not None:
+        if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+            os.makedirs(os.path.dirname(args.output))
+        with open(args.output, 'w') as f:
+            json.dump({'arch': args.arch, 'torch': torch.__version__, 'threads': args.threads,
+                       'batch_size': args.batch_size, 'input_size': args.input_size,
+                       'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import yaml
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+sys.path.append('.')
+from datasets import synthetic
+import models
+import inference as infer
+import utils
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='per-stage latency of inference.py on synthetic scenes, randomly initialised model')
+    parser.add_argument('--arch', default='unet2', choices=['unet2', 'unet2res'])
+    parser.add_argument('--config', default=None, type=str,
+                        help='take the model and data settings from a config (weights stay random)')
+    parser.add_argument('--sizes', default=['240x320', '480x640'], nargs='+',
+                        help='image sizes, HxW')
+    parser.add_argument('--instances', default=[4, 8, 16], type=int, nargs='+')
+    parser.add_argument('--occlusion', default=0.5, type=float, help='see datasets.synthetic.random_scene')
+    parser.add_argument('--scenes', default=3, type=int, help='scenes per (size, instances)')
+    parser.add_argument('--repeat', default=3, type=int, help='timed runs per scene')
+    parser.add_argument('--warmup', default=1, type=int)
+    parser.add_argument('--input-size', default=256, type=int)
+    parser.add_argument('--threads', default=0, type=int, help='0 for torch default')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None, type=str, help='json file of the results')
+    args = parser.parse_args()
+    return args
+
+def build_model(args):
+    if args.config is not None:
+        with open(args.config) as f:
+            config = yaml.load(f, Loader=yaml.FullLoader)
+        params, data = config['model'], config['data']
+    else:
+        params = {'algo': 'PartialCompletionMask', 'backbone_arch': args.arch,
+                  'backbone_param': {'in_channels': 2, 'n_classes': 2},
+                  'use_rgb': args.arch == 'unet2res', 'use_std': True, 'inmask_weight': 5.,
+                  'optim': 'SGD', 'lr': 0.001, 'weight_decay': 0.0001}
+        data = {'dataset': 'COCOA', 'use_default': False, 'enlarge_box': 3.,
+                'data_mean': [0.485, 0.456, 0.406], 'data_std': [0.229, 0.224, 0.225]}
+    params['device'] = 'cpu'
+    args.model, args.data = params, data
+    args.img_transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(data['data_mean'], data['data_std'])
+    ])
+    model = models.__dict__[params['algo']](params, dist_model=False)
+    model.switch_to('eval')
+    infer.setup_cpu_inference(model, num_threads=args.threads)
+    return model
+
+def run_stages(model, scene, args):
+    '''
+    runs the stages of one scene, returns {stage: seconds}
+    '''
+    image, modal, amodal, category = scene
+    h, w = image.shape[:2]
+    num = modal.shape[0]
+    bboxes = infer.expand_bboxes([utils.mask_to_bbox(m) for m in modal], args.data['enlarge_box'])
+    use_rgb = args.model['use_rgb']
+    times = {}
+
+    start = time.time()
+    for i in range(num):
+        for j in range(i + 1, num):
+            infer.bordering(modal[i], modal[j])
+    times['bordering'] = time.time() - start
+
+    start = time.time()
+    order_matrix = infer.infer_order(
+        model, image, modal, category, bboxes, use_rgb=use_rgb, th=0.5,
+        input_size=args.input_size, min_input_size=16, interp='nearest', args=args)
+    times['infer_order'] = time.time() - start
+
+    start = time.time()
+    for i in range(num):
+        infer.get_ancestors(order_matrix, i)
+    times['get_ancestors'] = time.time() - start
+
+    start = time.time()
+    amodal_patches = infer.infer_amodal(
+        model, image, modal, category, bboxes, order_matrix, use_rgb=use_rgb, th=0.5,
+        input_size=args.input_size, min_input_size=16, interp='linear',
+        order_grounded=True, args=args)
+    times['infer_amodal'] = time.time() - start
+
+    start = time.time()
+    infer.patch_to_fullimage(amodal_patches, bboxes, h, w, interp='linear')
+    times['patch_to_fullimage'] = time.time() - start
+
+    start = time.time()
+    infer.infer_gt_order(modal, amodal)
+    times['infer_gt_order'] = time.time() - start
+    return times
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    model = build_model(args)
+    rng = np.random.RandomState(args.seed)
+    results = []
+    for size in args.sizes:
+        h, w = [int(x) for x in size.split('x')]
+        for num in args.instances:
+            samples = {}
+            for s in range(args.scenes):
+                scene = synthetic.random_scene(h, w, num, occlusion=args.occlusion,
+                                               seed=rng.randint(1 << 30))
+                for r in range(args.warmup + args.repeat):
+                    times = run_stages(model, scene, args)
+                    if r >= args.warmup:
+                        for stage, t in times.items():
+                            samples.setdefault(stage, []).append(t)
+            for stage, values in samples.items():
+                values = 1000. * np.array(values)
+                results.append({'size': size, 'instances': num, 'stage': stage,
+                                'samples': len(values), 'mean_ms': float(values.mean()),
+                                'p50_ms': float(np.percentile(values, 50)),
+                                'p95_ms': float(np.percentile(values, 95))})
+                print("{:>9s} {:3d} inst  {:<20s} p50: {:9.3f} ms  p95: {:9.3f} ms".format(
+                    size, num, stage, results[-1]['p50_ms'], results[-1]['p95_ms']))
+
+    # scaling curves: p50 of each stage over the instance counts, per size
+    print("p50 (ms) vs instances {}".format(args.instances))
+    for size in args.sizes:
+        for stage in samples.keys():
+            curve = [r['p50_ms'] for r in results if r['size'] == size and r['stage'] == stage]
+            print("{:>9s} {:<20s} {}".format(size, stage, ' '.join('{:9.3f}'.format(t) for t in curve)))
+
+    if args.output is not None:
+        if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+            os.makedirs(os.path.dirname(args.output))
+        with open(args.output, 'w') as f:
+            json.dump({'commit': git_commit(), 'arch': args.model['backbone_arch'],
+                       'torch': torch.__version__, 'threads': torch.get_num_threads(),
+                       'machine': platform.processor() or platform.machine(),
+                       'occlusion': args.occlusion, 'input_size': args.input_size,
+                       'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -0,0 +1,135 @@
+import argparse
+import json
+import os
+import sys
+import weakref
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+sys.path.append('.')
+from models import backbone
+from models.backbone.unet.unet_resnet_model import UNetResNet
+import utils
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='peak activation memory of a training step per batch element, '
+                    'with and without activation checkpointing (UNetResNet backbones)')
+    parser.add_argument('--arch', default='unet2res')
+    parser.add_argument('--in-channels', default=2, type=int)
+    parser.add_argument('--input-size', default=256, type=int)
+    parser.add_argument('--batch-sizes', default=[2, 4], type=int, nargs=2,
+                        help='the per-element memory is the increase between the two')
+    parser.add_argument('--configs', default=['none', 'down', 'up', 'image_encoder', 'all'], nargs='+',
+                        help='checkpoint groups, comma separated, or none / all')
+    parser.add_argument('--device', default='cpu', type=str)
+    parser.add_argument('--output', default=None, type=str, help='json file of the results')
+    args = parser.parse_args()
+    return args
+
+
+class LiveMemory(TorchDispatchMode):
+    '''
+    Tracks the bytes of the tensor storages created by the ops run under it
+    that are alive, and their peak, for cpu where the allocator has no stats.
+    Tensors created before (parameters, inputs) are not counted.
+    '''
+    def __init__(self):
+        super(LiveMemory, self).__init__()
+        self.refs = {} # storage pointer: [tensors alive, bytes]
+        self.current = 0
+        self.peak = 0
+
+    def release(self, ptr):
+        ref = self.refs[ptr]
+        ref[0] -= 1
+        if ref[0] == 0:
+            self.current -= ref[1]
+            del self.refs[ptr]
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        out = func(*args, **(kwargs or {}))
+        for t in tree_flatten(out)[0]:
+            if not torch.is_tensor(t) or t.device.type == 'meta':
+                continue
+            storage = t.untyped_storage()
+            ptr = storage.data_ptr()
+            if ptr == 0:
+                continue
+            if ptr not in self.refs:
+                self.refs[ptr] = [0, storage.nbytes()]
+                self.current += storage.nbytes()
+                self.peak = max(self.peak, self.current)
+            self.refs[ptr][0] += 1
+            weakref.finalize(t, self.release, ptr)
+        return out
+
+
+def build_net(args, checkpoint):
+    torch.manual_seed(0)
+    net = backbone.__dict__[args.arch](args.in_channels, n_classes=2, checkpoint=checkpoint)
+    utils.init_weights(net, init_type='xavier')
+    return net.to(args.device).train()
+
+def step_memory(net, batch_size, args):
+    '''
+    bytes allocated by a forward and backward of batch_size inputs, above
+    the memory in use before: held after the forward (the activations kept
+    for backward) and the peak over the step (with the gradients)
+    '''
+    device = torch.device(args.device)
+    s = args.input_size
+    x = torch.rand(batch_size, args.in_channels, s, s, device=device)
+    rgb = torch.rand(batch_size, 3, s, s, device=device)
+    net.zero_grad(set_to_none=True)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        loss = net(x, rgb).sum()
+        held = torch.cuda.memory_allocated(device) - base
+        loss.backward()
+        torch.cuda.synchronize()
+        return held, torch.cuda.max_memory_allocated(device) - base
+    tracker = LiveMemory()
+    with tracker:
+        loss = net(x, rgb).sum()
+        held = tracker.current
+        loss.backward()
+    return held, tracker.peak
+
+def main(args):
+    results = []
+    b1, b2 = args.batch_sizes
+    mb = 2. ** 20
+    for config in args.configs:
+        if config == 'none':
+            checkpoint = []
+        elif config == 'all':
+            checkpoint = UNetResNet.checkpoint_groups
+        else:
+            checkpoint = config.split(',')
+        net = build_net(args, checkpoint)
+        step_memory(net, b1, args) # warmup
+        held1, peak1 = step_memory(net, b1, args)
+        held2, peak2 = step_memory(net, b2, args)
+        results.append({'checkpoint': config, 'batch_sizes': [b1, b2],
+                        'held_mb': [held1 / mb, held2 / mb], 'peak_mb': [peak1 / mb, peak2 / mb],
+                        # per batch element: the increase between the batch sizes
+                        'held_per_element_mb': (held2 - held1) / mb / (b2 - b1),
+                        'peak_per_element_mb': (peak2 - peak1) / mb / (b2 - b1)})
+        print("checkpoint: {:<22s} per element, held after forward: {:8.1f} MB  "
+              "peak: {:8.1f} MB  (peak at batch {}: {:.1f} MB)".format(
+                  config, results[-1]['held_per_element_mb'], results[-1]['peak_per_element_mb'],
+                  b2, peak2 / mb))
+
+    if args.output is not None:
+        if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+            os.makedirs(os.path.dirname(args.output))
+        with open(args.output, 'w') as f:
+            json.dump({'arch': args.arch, 'torch': torch.__version__, 'device': args.device,
+                       'input_size': args.input_size, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
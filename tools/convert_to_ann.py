@@ -1,5 +1,8 @@
 import json
 import argparse
+import sys
+sys.path.append('.')
+import utils
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -11,23 +14,23 @@ def parse_args():
 
 def main():
     args = parse_args()
-    with open(args.res, 'r') as f:
-        data = json.load(f)
+    # results are streamed (utils.iter_results), .json, .jsonl or .gz
+    data = utils.iter_results(args.res)
     with open(args.ann, 'r') as f:
         annot = json.load(f)
 
-    print(data[0].keys())
-    exit()
-
     output_json_dict = dict()
     output_json_dict['images'] = annot['images']
     # output_json_dict['categories'] = annot['categories'] # for KINS
     # output_json_dict['categories'] = [{'supercategory': 'thing', 'id': 1, 'name': 'thing'}] # for COCOA thing class only 
     output_json_dict['categories'] = [{'supercategory': 'object', 'id': 1, 'name': 'stuff'}, {'supercategory': 'object', 'id': 2, 'name': 'thing'}] # for COCOA stuff and thing class only 
-    output_json_dict['annotations'] = data
 
+    # annotations are written last, one at a time
     with open(args.output, 'w') as f:
-        json.dump(output_json_dict, f)
+        f.write(json.dumps(output_json_dict)[:-1] + ', "annotations": [')
+        for i, ann in enumerate(data):
+            f.write((', ' if i > 0 else '') + json.dumps(ann))
+        f.write(']}')
 
 if __name__ == '__main__':
     main()
@@ -3,6 +3,7 @@ from pycocotools.coco import COCO
 from pycocotools.cocoeval import COCOeval
 import sys
 sys.path.append('.')
+import utils
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -17,6 +18,8 @@ def main(args):
 def evaluate(res_file, gt_file):
     annType = 'segm'
     cocoGt = COCO(gt_file)
+    if utils.is_jsonl(res_file) or res_file.endswith('.gz'):
+        res_file = list(utils.iter_results(res_file))
     cocoDt = cocoGt.loadRes(res_file)
     cocoEval = COCOeval(cocoGt, cocoDt, annType)
     cocoEval.params.imgIds = cocoGt.getImgIds()
@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import yaml
+import numpy as np
+import torch
+sys.path.append('.')
+import models
+import inference as infer
+from models.backbone import deploy
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='export the backbone of a trained model (unet2, unet2res, order nets) to ONNX')
+    parser.add_argument('--config', required=True, type=str)
+    parser.add_argument('--load-model', required=True, type=str)
+    parser.add_argument('--output', required=True, type=str)
+    parser.add_argument('--input-size', default=256, type=int)
+    parser.add_argument('--opset', default=17, type=int)
+    parser.add_argument('--fold-bn', action='store_true', help='fold BatchNorm into convs before export')
+    parser.add_argument('--check-batch', default=4, type=int,
+                        help='batch size of the ONNX Runtime vs PyTorch check, 0 to skip')
+    args = parser.parse_args()
+    return args
+
+def as_tuple(output):
+    # the order predictors return (mask output, order logits)
+    return tuple(output) if isinstance(output, (tuple, list)) else (output,)
+
+def main(args):
+    with open(args.config) as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    for k, v in config.items():
+        setattr(args, k, v)
+
+    args.model['device'] = 'cpu'
+    model = models.__dict__[args.model['algo']](args.model, dist_model=False)
+    model.load_state(args.load_model)
+    model.switch_to('eval')
+    net = model.model.module
+    if args.fold_bn:
+        deploy.fold_bn(net)
+
+    # order networks take the rgb patch concatenated to the masks
+    use_rgb = deploy.takes_rgb(net)
+    in_channels = args.model['backbone_param'].get('in_channels', 2)
+    size = args.input_size
+
+    def example_inputs(batch):
+        inputs = (torch.randn(batch, in_channels, size, size),)
+        if use_rgb:
+            inputs += (torch.randn(batch, 3, size, size),)
+        return inputs
+
+    if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    deploy.export_onnx(net, example_inputs(1), args.output, use_rgb=use_rgb, opset=args.opset)
+    print("Exported {} (inputs: {}) to {}".format(
+        args.model['backbone_arch'], 'mask, rgb' if use_rgb else 'mask', args.output))
+
+    if args.check_batch > 0:
+        inputs = example_inputs(args.check_batch)
+        with torch.no_grad():
+            expected = as_tuple(net(*inputs))
+        outputs = as_tuple(infer.OnnxNet(args.output)(*inputs))
+        for k, (output, target) in enumerate(zip(outputs, expected)):
+            print("ONNX Runtime vs PyTorch, batch {}, output {}: max abs diff {:.3g}".format(
+                args.check_batch, k, np.abs(output.numpy() - target.numpy()).max()))
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args)
@@ -0,0 +1,45 @@
+import argparse
+import sys
+sys.path.append('.')
+from datasets import synthetic
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='write a synthetic COCOA / KINS style amodal dataset (images + annotations)')
+    parser.add_argument('--root', required=True, type=str)
+    parser.add_argument('--format', default='COCOA', choices=['COCOA', 'KINS'])
+    parser.add_argument('--splits', default=['train', 'val'], nargs='+')
+    parser.add_argument('--num-images', default=[100, 20], type=int, nargs='+',
+                        help='images per split')
+    parser.add_argument('--height', default=480, type=int)
+    parser.add_argument('--width', default=640, type=int)
+    parser.add_argument('--min-instances', default=2, type=int)
+    parser.add_argument('--max-instances', default=8, type=int)
+    parser.add_argument('--occlusion', default=0.5, type=float,
+                        help='amodal areas sum to about 2 * occlusion of the image')
+    parser.add_argument('--num-categories', default=7, type=int, help='KINS format only')
+    parser.add_argument('--min-visible', default=16, type=int,
+                        help='instances with fewer visible pixels are dropped')
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+    return args
+
+def main(args):
+    if len(args.num_images) != len(args.splits):
+        raise Exception("--num-images needs one value per split")
+    dataset = 'COCOA' if args.format == 'COCOA' else 'KINS'
+    print("data:")
+    print("    dataset: \"{}\"".format(dataset))
+    for k, (split, num) in enumerate(zip(args.splits, args.num_images)):
+        image_root, annot_file = synthetic.write_dataset(
+            args.root, split, fmt=args.format, num_images=num, height=args.height,
+            width=args.width, min_instances=args.min_instances,
+            max_instances=args.max_instances, occlusion=args.occlusion,
+            num_categories=args.num_categories, min_visible=args.min_visible,
+            seed=args.seed + k)
+        print("    {}_image_root: \"{}\"".format(split, image_root))
+        print("    {}_annot_file: \"{}\"".format(split, annot_file))
+
+if __name__ == '__main__':
+    args = parse_args()
+    main(args)
@@ -13,12 +13,20 @@ from datasets import reader
 import models
 import inference as infer
 import utils
+from models.backbone import deploy
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import torch
 
 import torchvision.transforms as transforms
 
+# patch resizing of the amodal stage
+AMODAL_INTERP = 'linear'
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', required=True, type=str)
@@ -30,9 +38,66 @@ def parse_args():
     parser.add_argument('--annotation', required=True, type=str)
     parser.add_argument('--image-root', required=True, type=str)
     parser.add_argument('--test-num', default=-1, type=int)
-    parser.add_argument('--output', default=None, type=str)
+    parser.add_argument('--output', default=None, type=str,
+                        help='COCO results: .json, or .jsonl (json lines), .gz to compress')
     parser.add_argument('--dilate_kernel', default=0, type=int)
+    parser.add_argument('--amodal-skip-th', default=-1, type=int,
+                        help='eraser pixels up to which amodal forward is skipped, -1 to disable')
+    parser.add_argument('--share-forwards', action='store_true',
+                        help='reuse order-stage forwards in the amodal stage '
+                             '(the order stage then resizes patches with linear, as the amodal one)')
+    parser.add_argument('--order-interp', default=None, type=str,
+                        help='order stage patch resizing, default nearest, '
+                             'or linear with --share-forwards')
+    parser.add_argument('--device', default='cuda', type=str)
+    parser.add_argument('--threads', default=0, type=int, help='cpu threads, 0 for torch default')
+    parser.add_argument('--deploy', default='fp32', choices=['fp32', 'fold_bn', 'int8'],
+                        help='fold_bn: fold BatchNorm into convs, int8: also quantize (cpu only)')
+    parser.add_argument('--compile', default='none', choices=['none', 'inductor', 'torchscript'],
+                        help='compiled backbone: torch.compile (inductor) or traced TorchScript')
+    parser.add_argument('--calib-num', default=300, type=int, help='calibration patches for int8')
+    parser.add_argument('--calib-annotation', default=None, type=str,
+                        help='calibration split, defaults to --annotation')
+    parser.add_argument('--calib-image-root', default=None, type=str)
+    parser.add_argument('--save-deploy', default=None, type=str,
+                        help='save the deployed backbone as TorchScript')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='overlap image loading / patch preparation with batched forwards')
+    parser.add_argument('--workers', default=4, type=int, help='preparation threads of --pipeline')
+    parser.add_argument('--batch-size', default=32, type=int, help='patches per forward of --pipeline')
+    parser.add_argument('--queue-size', default=8, type=int, help='images in flight in --pipeline')
+    parser.add_argument('--roi-image', action='store_true',
+                        help='encode each image once and pool patch rgb features (roi_image_size backbones)')
+    parser.add_argument('--engine', default='torch', choices=['torch', 'onnx'])
+    parser.add_argument('--onnx-model', default=None, type=str,
+                        help='backbone exported by tools/export_onnx.py, for --engine onnx')
+    parser.add_argument('--parity-num', default=0, type=int,
+                        help='images on which the onnx engine is compared to the PyTorch path')
+    parser.add_argument('--sweep-order-th', default=None, type=float, nargs='+',
+                        help='evaluate every order threshold x amodal threshold in one model pass')
+    parser.add_argument('--sweep-amodal-th', default=None, type=float, nargs='+',
+                        help='amodal thresholds of the sweep, --amodal-th if not given')
+    parser.add_argument('--sweep-output', default=None, type=str,
+                        help='json file for the metrics of every setting of the sweep')
+    parser.add_argument('--sweep-fp16', action='store_true',
+                        help='keep the probability maps of the sweep in float16 (half the memory); '
+                             'rounding of up to 2.5e-4 can flip pixels at a threshold, so metrics '
+                             'may differ slightly from a plain run with that threshold')
+    parser.add_argument('--num-shards', default=int(os.environ.get('WORLD_SIZE', 1)), type=int,
+                        help='split the images over processes (default: $WORLD_SIZE or 1)')
+    parser.add_argument('--shard-id', default=int(os.environ.get('RANK', 0)), type=int,
+                        help='images i with i %% num_shards == shard_id (default: $RANK or 0)')
+    parser.add_argument('--resume', action='store_true',
+                        help='checkpoint results after every image and skip the images already done')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge the checkpoints of --num-shards shards into --output, no inference')
     args = parser.parse_args()
+    # forwards are only shared between patches resized the same way
+    if args.order_interp is None:
+        args.order_interp = AMODAL_INTERP if args.share_forwards else 'nearest'
+    elif args.share_forwards and args.order_interp != AMODAL_INTERP:
+        raise Exception("--share-forwards needs --order-interp {} (as the amodal stage), "
+                        "got {}".format(AMODAL_INTERP, args.order_interp))
     return args
 
 def main(args):
@@ -51,90 +116,204 @@ def main(args):
 class Tester(object):
     def __init__(self, args):
         self.args = args
+        self.checkpoint = None
+        self.writer = None
         self.prepare_data()
 
+    def build_reader(self, annotation):
+        dataset = self.args.data['dataset']
+        if dataset == 'COCOA':
+            return reader.COCOADataset(annotation)
+        elif dataset == 'KINSNew':
+            return reader.KINSNewDataset(dataset, annotation)
+        else:
+            return reader.KINSLVISDataset(dataset, annotation)
+
     def prepare_data(self):
         config = self.args.data
         dataset = config['dataset']
         self.data_root = self.args.image_root
-        if dataset == 'COCOA':
-            self.data_reader = reader.COCOADataset(self.args.annotation)
-        else:
-            if dataset == 'KINSNew':
-                self.data_reader = reader.KINSNewDataset(
-                    dataset, self.args.annotation)
-            else:
-                self.data_reader = reader.KINSLVISDataset(
-                    dataset, self.args.annotation)
+        self.data_reader = self.build_reader(self.args.annotation)
         self.data_length = self.data_reader.get_image_length()
         self.dataset = dataset
         if self.args.test_num != -1:
             self.data_length = self.args.test_num
 
     def prepare_model(self):
+        self.args.model['device'] = self.args.device
         self.model = models.__dict__[self.args.model['algo']](self.args.model, dist_model=False)
         self.model.load_state(self.args.load_model)
         self.model.switch_to('eval')
+        if self.args.deploy != 'fp32':
+            self.deploy_model()
+        if self.model.device.type == 'cpu':
+            infer.setup_cpu_inference(self.model, num_threads=self.args.threads)
+        if self.args.compile == 'torchscript' and self.args.roi_image:
+            raise Exception("--roi-image needs the eager or inductor backbone")
+        if self.args.engine == 'onnx' and self.args.roi_image:
+            raise Exception("--roi-image needs the PyTorch engine")
+        if self.args.compile != 'none':
+            infer.compile_model(self.model, self.args.compile, self.example_inputs())
+        if self.args.engine == 'onnx':
+            if self.args.onnx_model is None:
+                raise Exception("--engine onnx requires --onnx-model")
+            torch_model = self.model
+            self.model = infer.OnnxEngine(self.args.onnx_model, num_threads=self.args.threads)
+            if self.args.parity_num > 0:
+                self.check_parity(torch_model)
+
+    def check_parity(self, torch_model):
+        '''
+        Compares the engine to the PyTorch model on the first --parity-num
+        images: raw outputs, order matrices and amodal patches (completed with
+        the PyTorch order for both, so that the inputs are the same).
+        '''
+        use_rgb = self.args.model['use_rgb']
+        inputs = self.example_inputs()
+        with torch.inference_mode():
+            expected = torch_model.model(*[infer.to_input(x, torch_model) for x in inputs]).cpu()
+        max_diff = (self.model.model(*inputs) - expected).abs().max().item()
+
+        order_agree, order_total, pixel_agree, pixel_total = 0, 0, 0, 0
+        for i in range(min(self.args.parity_num, self.data_length)):
+            modal, category, bboxes, _, image = self.load_image(self.data_reader, self.data_root, i)
+            amodal_patches = []
+            for model in [torch_model, self.model]:
+                order_matrix = infer.infer_order(
+                    model, image, modal, category, bboxes,
+                    use_rgb=use_rgb, th=self.args.order_th, dilate_kernel=self.args.dilate_kernel,
+                    input_size=256, min_input_size=16, interp=self.args.order_interp, args=self.args)
+                if model is torch_model:
+                    torch_order = order_matrix
+                amodal_patches.append(infer.infer_amodal(
+                    model, image, modal, category, bboxes, torch_order,
+                    use_rgb=use_rgb, th=self.args.amodal_th, dilate_kernel=self.args.dilate_kernel,
+                    input_size=256, min_input_size=16, interp=AMODAL_INTERP,
+                    order_grounded=True, args=self.args))
+            order_agree += (order_matrix == torch_order).sum()
+            order_total += order_matrix.size
+            for p1, p2 in zip(*amodal_patches):
+                pixel_agree += (p1 == p2).sum()
+                pixel_total += p1.size
+        print("Parity {} vs torch: max abs output diff: {:.3g}, order agreement: {:.5g}, "
+              "amodal pixel agreement: {:.5g}".format(
+                  self.args.engine, max_diff, order_agree / max(order_total, 1),
+                  pixel_agree / max(pixel_total, 1)))
+
+    def example_inputs(self):
+        in_channels = self.args.model['backbone_param']['in_channels']
+        inputs = (torch.zeros(1, in_channels, 256, 256),)
+        if self.args.model['use_rgb']:
+            inputs += (torch.zeros(1, 3, 256, 256),)
+        return inputs
+
+    def deploy_model(self):
+        '''
+        Replaces the backbone by its inference form: BN folded into convs,
+        and for int8 a post-training statically quantized copy calibrated
+        on --calib-num patches.
+        '''
+        use_rgb = self.args.model['use_rgb']
+        net = deploy.fold_bn(self.model.model.module)
+        if self.args.deploy == 'int8':
+            if self.model.device.type != 'cpu':
+                raise Exception("int8 deploy runs on cpu only, use --device cpu")
+            prepared = deploy.prepare_int8(net, self.example_inputs(), use_rgb=use_rgb)
+            self.model.model.module = prepared
+            self.calibrate(prepared)
+            net = deploy.convert_int8(prepared)
+        self.model.model.module = net
+        if self.args.save_deploy is not None:
+            deploy.export_torchscript(net, self.example_inputs(), self.args.save_deploy, use_rgb=use_rgb)
+
+    def calibrate(self, prepared):
+        ''' runs order and amodal inference until calib_num patches went through the observers '''
+        calib_reader = self.data_reader
+        calib_root = self.data_root
+        if self.args.calib_annotation is not None:
+            calib_reader = self.build_reader(self.args.calib_annotation)
+            calib_root = self.args.calib_image_root or self.data_root
+        num_patches = [0]
+        handle = prepared.register_forward_hook(
+            lambda m, inp, out: num_patches.__setitem__(0, num_patches[0] + inp[0].shape[0]))
+        use_rgb = self.args.model['use_rgb']
+        for i in range(calib_reader.get_image_length()):
+            if num_patches[0] >= self.args.calib_num:
+                break
+            modal, category, bboxes, _, image = self.load_image(calib_reader, calib_root, i)
+            order_matrix = infer.infer_order(
+                self.model, image, modal, category, bboxes,
+                use_rgb=use_rgb, th=self.args.order_th, dilate_kernel=self.args.dilate_kernel,
+                input_size=256, min_input_size=16, interp=self.args.order_interp, args=self.args)
+            infer.infer_amodal(
+                self.model, image, modal, category, bboxes, order_matrix,
+                use_rgb=use_rgb, th=self.args.amodal_th, dilate_kernel=self.args.dilate_kernel,
+                input_size=256, min_input_size=16, interp=AMODAL_INTERP,
+                order_grounded=True, args=self.args)
+        handle.remove()
+        print("Calibrated int8 backbone on {} patches".format(num_patches[0]))
+
+    def load_image(self, data_reader, data_root, i):
+        modal, category, bboxes, amodal_gt, image_fn = data_reader.get_image_instances(
+            i, with_gt=True)
+        image = Image.open(os.path.join(data_root, image_fn)).convert('RGB')
+        if image.size[0] != modal.shape[2] or image.size[1] != modal.shape[1]:
+            image = image.resize((modal.shape[2], modal.shape[1]))
+        image = np.array(image)
+        bboxes = self.expand_bbox(bboxes)
+        return modal, category, bboxes, amodal_gt, image
 
     def expand_bbox(self, bboxes):
-        new_bboxes = []
-        for bbox in bboxes:
-            centerx = bbox[0] + bbox[2] / 2.
-            centery = bbox[1] + bbox[3] / 2.
-            size = max([np.sqrt(bbox[2] * bbox[3] * self.args.data['enlarge_box']),
-                        bbox[2] * 1.1, bbox[3] * 1.1])
-            new_bbox = [int(centerx - size / 2.), int(centery - size / 2.), int(size), int(size)]
-            new_bboxes.append(new_bbox)
-        return np.array(new_bboxes)
+        return infer.expand_bboxes(bboxes, self.args.data['enlarge_box'])
 
     def run(self):
-        self.prepare_model()
-        self.infer()
-
-    def infer(self):
-        order_th = self.args.order_th
-        amodal_th = self.args.amodal_th
-
         self.args.img_transform = transforms.Compose([
                 transforms.ToTensor(),
                 transforms.Normalize(self.args.data['data_mean'], self.args.data['data_std'])
             ])
+        if self.args.merge:
+            self.merge_shards()
+            return
+        self.prepare_model()
+        if self.args.sweep_order_th is not None or self.args.sweep_amodal_th is not None:
+            if self.args.num_shards > 1 or self.args.resume:
+                raise Exception("threshold sweeps do not support --num-shards and --resume")
+            self.infer_sweep()
+        elif self.args.pipeline:
+            self.infer_pipelined()
+        else:
+            self.infer()
 
-        segm_json_results = []
-        self.count = 0
-        
-        allpair_true_rec = utils.AverageMeter()
-        allpair_rec = utils.AverageMeter()
-        occpair_true_rec = utils.AverageMeter()
-        occpair_rec = utils.AverageMeter()
-        intersection_rec = utils.AverageMeter()
-        union_rec = utils.AverageMeter()
-        target_rec = utils.AverageMeter()
+    def infer(self):
+        order_th = self.args.order_th
+        amodal_th = self.args.amodal_th
 
-        inv_intersection_rec = utils.AverageMeter()
-        inv_union_rec = utils.AverageMeter()
+        self.reset_meters()
+        indices = self.start_shard()
 
-        list_acc, list_iou = [], []
-        list_inv_iou = []
+        amodal_stats = {'forward': 0, 'skipped': 0}
+        session = infer.InferenceSession() if self.args.share_forwards else None
+        cache = infer.PatchCache()
+        infer_time = 0.
 
         # for i in tqdm(range(self.data_length), total=self.data_length):
-        for i in range(self.data_length):
-            modal, category, bboxes, amodal_gt, image_fn = self.data_reader.get_image_instances(
-                i, with_gt=True)
-
+        for i in indices:
             # data
-            image = Image.open(os.path.join(self.data_root, image_fn)).convert('RGB')
-            if image.size[0] != modal.shape[2] or image.size[1] != modal.shape[1]:
-                image = image.resize((modal.shape[2], modal.shape[1]))
-
-            image = np.array(image)
+            modal, category, bboxes, amodal_gt, image = self.load_image(
+                self.data_reader, self.data_root, i)
             h, w = image.shape[:2]
-            bboxes = self.expand_bbox(bboxes)
+            if session is not None:
+                session.reset()
+            cache.reset()
 
             # gt order
             gt_order_matrix = infer.infer_gt_order(modal, amodal_gt)
 
             # infer order
+            start = time.time()
+            image_feat = None
+            if self.args.roi_image:
+                image_feat = infer.encode_image(self.model, image, self.args)
             if self.args.order_method == 'area':
                 order_matrix = infer.infer_order_area(
                     modal, above='smaller' if self.args.data['dataset'] == 'COCOA' else 'larger')
@@ -149,45 +328,53 @@ class Tester(object):
                 order_matrix = infer.infer_order(
                     self.model, image, modal, category, bboxes,
                     use_rgb=self.args.model['use_rgb'], th=order_th, dilate_kernel=args.dilate_kernel,
-                    input_size=256, min_input_size=16, interp='nearest', debug_info=False, args=self.args)
+                    input_size=256, min_input_size=16, interp=self.args.order_interp, debug_info=False, args=self.args,
+                    session=session, image_feat=image_feat, cache=cache)
 
             elif self.args.order_method == 'sup': # supervised
                 order_matrix = infer.infer_order(
                     self.model, image, modal, category, bboxes,
                     use_rgb=self.args.model['use_rgb'], th=order_th, dilate_kernel=args.dilate_kernel,
-                    input_size=256, min_input_size=16, interp='nearest', debug_info=False, args=self.args, supervised=True)
+                    input_size=256, min_input_size=16, interp=self.args.order_interp, debug_info=False, args=self.args, supervised=True,
+                    session=session, image_feat=image_feat, cache=cache)
             else:
                 raise Exception('No such order method: {}'.format(self.args.order_method))
 
             # infer amodal
             if self.args.amodal_method == 'raw':
-                amodal_pred = modal.copy()
+                amodal_pred = infer.masks_to_crops(modal)
 
             elif self.args.amodal_method == 'ours_nog':
                 amodal_patches_pred = infer.infer_amodal(
                     self.model, image, modal, category, bboxes, order_matrix,
                     use_rgb=self.args.model['use_rgb'], th=amodal_th, dilate_kernel=args.dilate_kernel,
-                    input_size=256, min_input_size=16, interp='linear',
-                    order_grounded=False, debug_info=False, args=args)
-                amodal_pred = infer.patch_to_fullimage(
+                    input_size=256, min_input_size=16, interp=AMODAL_INTERP,
+                    order_grounded=False, debug_info=False, args=args,
+                    skip_th=self.args.amodal_skip_th, stats=amodal_stats, session=session,
+                    image_feat=image_feat, cache=cache)
+                amodal_pred = infer.patch_to_crops(
                     amodal_patches_pred, bboxes, h, w, interp='linear')
 
             elif self.args.amodal_method == 'ours_parents':
                 amodal_patches_pred = infer.infer_amodal(
                     self.model, image, modal, category, bboxes, order_matrix,
                     use_rgb=self.args.model['use_rgb'], th=amodal_th, dilate_kernel=args.dilate_kernel,
-                    input_size=256, min_input_size=16, interp='linear',
-                    order_grounded='parents', debug_info=False, args=args)
-                amodal_pred = infer.patch_to_fullimage(
+                    input_size=256, min_input_size=16, interp=AMODAL_INTERP,
+                    order_grounded='parents', debug_info=False, args=args,
+                    skip_th=self.args.amodal_skip_th, stats=amodal_stats, session=session,
+                    image_feat=image_feat, cache=cache)
+                amodal_pred = infer.patch_to_crops(
                     amodal_patches_pred, bboxes, h, w, interp='linear')
 
             elif self.args.amodal_method == 'ours':
                 amodal_patches_pred = infer.infer_amodal(
                     self.model, image, modal, category, bboxes, order_matrix,
                     use_rgb=self.args.model['use_rgb'], th=amodal_th, dilate_kernel=args.dilate_kernel,
-                    input_size=256, min_input_size=16, interp='linear',
-                    order_grounded=True, debug_info=False, args=args)
-                amodal_pred = infer.patch_to_fullimage(
+                    input_size=256, min_input_size=16, interp=AMODAL_INTERP,
+                    order_grounded=True, debug_info=False, args=args,
+                    skip_th=self.args.amodal_skip_th, stats=amodal_stats, session=session,
+                    image_feat=image_feat, cache=cache)
+                amodal_pred = infer.patch_to_crops(
                     amodal_patches_pred, bboxes, h, w, interp='linear')
 
             elif self.args.amodal_method == 'sup': # supervised
@@ -195,51 +382,24 @@ class Tester(object):
                     self.model, image, modal, category, bboxes,
                     use_rgb=self.args.model['use_rgb'], th=amodal_th, input_size=256,
                     min_input_size=16, interp='linear', args=args)
-                amodal_pred = infer.patch_to_fullimage(
+                amodal_pred = infer.patch_to_crops(
                     amodal_patches_pred, bboxes, h, w, interp='linear')
 
             elif self.args.amodal_method == 'convex':
-                amodal_pred = np.array(infer.infer_amodal_hull(
+                amodal_pred = infer.masks_to_crops(infer.infer_amodal_hull(
                     modal, bboxes, None, order_grounded=False))
 
             elif self.args.amodal_method == 'convexr':
                 order_matrix = infer.infer_order_hull(modal)
-                amodal_pred = np.array(infer.infer_amodal_hull(
+                amodal_pred = infer.masks_to_crops(infer.infer_amodal_hull(
                     modal, bboxes, order_matrix, order_grounded=True))
 
             else:
                 raise Exception("No such method: {}".format(self.args.method))
+            infer_time += time.time() - start
 
-            # eval
-            allpair_true, allpair, occpair_true, occpair, _ = infer.eval_order(
-                order_matrix, gt_order_matrix)
-            allpair_true_rec.update(allpair_true)
-            allpair_rec.update(allpair)
-            occpair_true_rec.update(occpair_true)
-            occpair_rec.update(occpair)
-
-            intersection = ((amodal_pred == 1) & (amodal_gt == 1)).sum()
-            union = ((amodal_pred == 1) | (amodal_gt == 1)).sum()
-            target = (amodal_gt == 1).sum()
-            intersection_rec.update(intersection)
-            union_rec.update(union)
-            target_rec.update(target)
-
-            # for invisible mIoU 
-            inv_intersection = ((amodal_pred == 1) & (amodal_gt == 1) & (modal == 0)).sum()
-            inv_union = (((amodal_pred == 1) | (amodal_gt == 1)) & (modal == 0)).sum()
-
-            inv_intersection_rec.update(inv_intersection)
-            inv_union_rec.update(inv_union)
-
-            # for computing p-score 
-            list_acc.append(occpair_true/(occpair+1e-6))
-            list_iou.append(intersection/(union+1e-6))
-            list_inv_iou.append(inv_intersection/(inv_union+1e-6))
-
-            # make output
-            # if self.dataset == 'KINS':
-            segm_json_results.extend(self.make_KINS_output(i, amodal_pred, category))
+            self.evaluate_image(i, modal, category, amodal_gt, h, w,
+                                order_matrix, gt_order_matrix, amodal_pred)
 
         # torch.save((list_iou, list_acc, list_inv_iou), 'experiments/KINS/p_values_results/std_no_rgb_gaussian_test.pkl')
         # torch.save((list_iou, list_acc, list_inv_iou), 'experiments/KINS/p_values_results/boundary_no_rgb_gaussian_test.pkl')
@@ -251,36 +411,503 @@ class Tester(object):
         # torch.save((list_iou, list_acc), 'experiments/COCOA/p_values_results/std_no_rgb_cross_entropy_gaussian_val.pkl')
         # torch.save((list_iou, list_acc), 'experiments/COCOA/p_values_results/std_no_rgb_cross_entropy_gaussian_test.pkl')
         
+        self.finish_shard()
         # print results
-        acc_allpair = allpair_true_rec.sum / float(allpair_rec.sum) # accuracy for all pairs
-        acc_occpair = occpair_true_rec.sum / float(occpair_rec.sum) # accuray for occluded pairs
-        miou = intersection_rec.sum / (union_rec.sum + 1e-10) # mIoU
-        pacc = intersection_rec.sum / (target_rec.sum + 1e-10) # pixel accuracy
+        miou, acc_occpair = self.print_results()
+        if amodal_stats['skipped'] > 0:
+            print("Amodal forwards: {}, skipped (unoccluded): {}".format(
+                amodal_stats['forward'], amodal_stats['skipped']))
+        if session is not None:
+            print("Shared forwards: {} hits, {} misses, hit rate: {:.3g}".format(
+                session.hits, session.misses, session.hit_rate()))
+            if session.hits == 0 and session.misses > 0:
+                print("Warning: --share-forwards reused no forward, no amodal patch had "
+                      "the inputs of an order patch")
+        print("Deploy: {}, mIoU: {:.5g}, acc_occpair: {:.5g}, latency: {:.4g} ms/img".format(
+            self.args.deploy, miou, acc_occpair, 1000. * infer_time / max(len(indices), 1)))
+
+        self.save_results()
+
+    def infer_pipelined(self):
+        '''
+        Pipelined version of infer: a pool of --workers threads loads images
+        and prepares order / amodal patches while a model thread forwards
+        batches that mix patches of several images. At most --queue-size
+        images are in flight. Metrics and outputs are made in image order.
+        '''
+        args = self.args
+        grounded = {'ours': True, 'ours_nog': False, 'ours_parents': 'parents'}
+        if args.order_method not in ['ours', 'sup', 'area', 'yaxis'] or \
+                args.amodal_method not in ['ours', 'ours_nog', 'ours_parents', 'raw']:
+            raise Exception("--pipeline supports order methods ours, sup, area, yaxis "
+                            "and amodal methods ours, ours_nog, ours_parents, raw")
+        unsupported = [flag for flag, used in [
+            ('--roi-image', args.roi_image), ('--share-forwards', args.share_forwards),
+            ('--engine onnx', args.engine == 'onnx')] if used]
+        if len(unsupported) > 0:
+            raise Exception("--pipeline does not support {}".format(', '.join(unsupported)))
+        use_rgb = args.model['use_rgb']
+        self.reset_meters()
+        indices = self.start_shard()
+        amodal_stats = {'forward': 0, 'skipped': 0}
+        timer = utils.StageTimer()
+        pool = ThreadPoolExecutor(args.workers)
+        forward_queue = queue.Queue(maxsize=args.queue_size)
+        done_queue = queue.Queue()
+        in_flight = threading.BoundedSemaphore(args.queue_size)
+
+        def check(future):
+            # failures are raised in the main thread
+            if future.exception() is not None:
+                done_queue.put(future.exception())
+
+        def submit(func, *func_args):
+            pool.submit(func, *func_args).add_done_callback(check)
+
+        def load(pos):
+            with timer.stage('load + order patches'):
+                i = indices[pos]
+                modal, category, bboxes, amodal_gt, image = self.load_image(
+                    self.data_reader, self.data_root, i)
+                item = {'i': i, 'pos': pos, 'modal': modal, 'category': category, 'bboxes': bboxes,
+                        'amodal_gt': amodal_gt, 'image': image, 'h': image.shape[0],
+                        'w': image.shape[1], 'stats': {}, 'cache': infer.PatchCache(),
+                        'gt_order_matrix': infer.infer_gt_order(modal, amodal_gt)}
+                if args.order_method == 'area':
+                    item['order_matrix'] = infer.infer_order_area(
+                        modal, above='smaller' if args.data['dataset'] == 'COCOA' else 'larger')
+                elif args.order_method == 'yaxis':
+                    item['order_matrix'] = infer.infer_order_yaxis(modal)
+                else:
+                    item['ind'], item['patches'] = infer.prepare_order_patches(
+                        image, modal, category, bboxes, dilate_kernel=args.dilate_kernel,
+                        input_size=256, min_input_size=16, interp=args.order_interp, args=args,
+                        supervised=args.order_method == 'sup', use_rgb=use_rgb, cache=item['cache'])
+            if 'order_matrix' in item:
+                amodal_patches(item)
+            else:
+                forward_queue.put(('order', item))
+
+        def amodal_patches(item):
+            if args.amodal_method == 'raw':
+                item['amodal_pred'] = infer.masks_to_crops(item['modal'])
+                done_queue.put(item)
+                return
+            with timer.stage('amodal patches'):
+                item['patches'] = infer.prepare_amodal_patches(
+                    item['image'], item['modal'], item['category'], item['bboxes'],
+                    item['order_matrix'], dilate_kernel=args.dilate_kernel, input_size=256,
+                    min_input_size=16, interp=AMODAL_INTERP,
+                    order_grounded=grounded[args.amodal_method], args=args,
+                    skip_th=args.amodal_skip_th, stats=item['stats'],
+                    use_rgb=use_rgb, cache=item['cache'])
+                del item['cache']
+            forward_queue.put(('amodal', item))
+
+        def paste(item):
+            with timer.stage('paste'):
+                item['amodal_pred'] = infer.patch_to_crops(
+                    [p['amodal'] for p in item['patches']], item['bboxes'],
+                    item['h'], item['w'], interp='linear')
+            done_queue.put(item)
+
+        def forward(kind, items):
+            with timer.stage('{} forward'.format(kind), num=len(items)):
+                patches = [p for item in items for p in item['patches'] if 'amodal' not in p]
+                masks = infer.net_forward_batch(
+                    self.model, patches, use_rgb,
+                    args.order_th if kind == 'order' else args.amodal_th,
+                    args=args, batch_size=args.batch_size)
+            if kind == 'order':
+                start = 0
+                for item in items:
+                    num = len(item['patches'])
+                    item['order_matrix'] = infer.order_from_patches(
+                        item['modal'].shape[0], item['ind'], item['patches'],
+                        masks[start:start + num])
+                    start += num
+                    submit(amodal_patches, item)
+            else:
+                for item in items:
+                    item['stats']['forward'] = item['stats'].get('forward', 0) + len(
+                        [p for p in item['patches'] if 'amodal' not in p])
+                for patch, mask in zip(patches, masks):
+                    patch['amodal'] = mask
+                for item in items:
+                    submit(paste, item)
+
+        def model_loop():
+            try:
+                stop = False
+                while not stop:
+                    request = forward_queue.get()
+                    if request is None:
+                        break
+                    requests = [request]
+                    num = len(request[1]['patches'])
+                    # mix patches of the images that are ready, up to a batch
+                    while num < args.batch_size:
+                        try:
+                            request = forward_queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if request is None:
+                            stop = True
+                            break
+                        requests.append(request)
+                        num += len(request[1]['patches'])
+                    for kind in ['order', 'amodal']:
+                        items = [item for k, item in requests if k == kind]
+                        if len(items) > 0:
+                            forward(kind, items)
+            except Exception as e:
+                done_queue.put(e)
+
+        def feed():
+            for pos in range(len(indices)):
+                in_flight.acquire()
+                submit(load, pos)
+
+        start = time.time()
+        model_thread = threading.Thread(target=model_loop, daemon=True)
+        model_thread.start()
+        threading.Thread(target=feed, daemon=True).start()
+        ready = {}
+        next_i = 0
+        while next_i < len(indices):
+            item = done_queue.get()
+            if isinstance(item, Exception):
+                raise item
+            ready[item['pos']] = item
+            while next_i in ready:
+                item = ready.pop(next_i)
+                with timer.stage('metrics + output'):
+                    self.evaluate_image(
+                        item['i'], item['modal'], item['category'], item['amodal_gt'],
+                        item['h'], item['w'], item['order_matrix'], item['gt_order_matrix'],
+                        item['amodal_pred'])
+                for k, v in item['stats'].items():
+                    amodal_stats[k] += v
+                in_flight.release()
+                next_i += 1
+        forward_queue.put(None)
+        model_thread.join()
+        pool.shutdown()
+        wall = time.time() - start
+
+        self.finish_shard()
+        self.print_results()
+        if amodal_stats['skipped'] > 0:
+            print("Amodal forwards: {}, skipped (unoccluded): {}".format(
+                amodal_stats['forward'], amodal_stats['skipped']))
+        workers = {name: args.workers for name in ['load + order patches', 'amodal patches', 'paste']}
+        for line in timer.report(workers):
+            print(line)
+        print("Pipeline: {} imgs in {:.4g} s, {:.4g} imgs/s".format(
+            len(indices), wall, len(indices) / max(wall, 1e-10)))
+        self.save_results()
+
+    def infer_sweep(self):
+        '''
+        Evaluates the grid of --sweep-order-th x --sweep-amodal-th with one
+        model pass: per image, the probability maps of the order patches and
+        of the amodal patches of every distinct order matrix are kept in an
+        InferenceSession (crop-local, shared between settings; float32, so that
+        every setting reproduces a plain run, float16 with --sweep-fp16), then
+        --workers threads threshold them and compute the metrics of every
+        setting while the next images are forwarded.
+        '''
+        args = self.args
+        grounded = {'ours': True, 'ours_nog': False, 'ours_parents': 'parents'}
+        if args.order_method not in ['ours', 'sup'] or args.amodal_method not in grounded:
+            raise Exception("threshold sweeps support order methods ours, sup "
+                            "and amodal methods ours, ours_nog, ours_parents")
+        order_ths = args.sweep_order_th or [args.order_th]
+        amodal_ths = args.sweep_amodal_th or [args.amodal_th]
+        use_rgb = args.model['use_rgb']
+        names = ['occpair_true', 'occpair', 'intersection', 'union',
+                 'inv_intersection', 'inv_union']
+        sums = {(ot, at): dict.fromkeys(names, 0) for ot in order_ths for at in amodal_ths}
+        session = infer.InferenceSession(dtype=np.float16 if args.sweep_fp16 else None)
+        cache = infer.PatchCache()
+        pool = ThreadPoolExecutor(args.workers)
+        pending = []
+
+        def collect(future):
+            for setting, values in future.result().items():
+                for name, value in values.items():
+                    sums[setting][name] += value
+
+        start = time.time()
+        for i in range(self.data_length):
+            modal, category, bboxes, amodal_gt, image = self.load_image(
+                self.data_reader, self.data_root, i)
+            session.reset()
+            cache.reset()
+            image_feat = None
+            if args.roi_image:
+                image_feat = infer.encode_image(self.model, image, args)
+
+            ind, patches = infer.prepare_order_patches(
+                image, modal, category, bboxes, dilate_kernel=args.dilate_kernel,
+                input_size=256, min_input_size=16, interp=args.order_interp, args=args,
+                supervised=args.order_method == 'sup', use_rgb=use_rgb and image_feat is None,
+                cache=cache)
+            probs = infer.patch_probs(self.model, patches, use_rgb, args=args,
+                                      session=session, image_feat=image_feat)
+            order_matrices = {}
+            amodal = {} # order matrix -> amodal patches and their probability maps
+            for ot in order_ths:
+                th = infer.forward_threshold(ot, args)
+                order_matrix = infer.order_from_patches(
+                    modal.shape[0], ind, patches, [(p > th).astype(np.uint8) for p in probs])
+                order_matrices[ot] = order_matrix
+                if order_matrix.tobytes() in amodal:
+                    continue
+                amodal_patches = infer.prepare_amodal_patches(
+                    image, modal, category, bboxes, order_matrix,
+                    dilate_kernel=args.dilate_kernel, input_size=256, min_input_size=16,
+                    interp=AMODAL_INTERP, order_grounded=grounded[args.amodal_method], args=args,
+                    skip_th=args.amodal_skip_th, use_rgb=use_rgb and image_feat is None,
+                    cache=cache)
+                amodal[order_matrix.tobytes()] = (amodal_patches, infer.patch_probs(
+                    self.model, amodal_patches, use_rgb, args=args, session=session,
+                    image_feat=image_feat))
+
+            if len(pending) >= args.queue_size:
+                collect(pending.pop(0))
+            pending.append(pool.submit(
+                self.evaluate_grid, modal, amodal_gt, bboxes, image.shape[0], image.shape[1],
+                order_matrices, amodal, amodal_ths))
+        for future in pending:
+            collect(future)
+        pool.shutdown()
+        wall = time.time() - start
 
-        inv_miou = inv_intersection_rec.sum / (inv_union_rec.sum + 1e-10) # mIoU
+        results = []
+        for (ot, at), m in sums.items():
+            results.append({'order_th': ot, 'amodal_th': at,
+                            'acc_occpair': m['occpair_true'] / float(max(m['occpair'], 1)),
+                            'mIoU': m['intersection'] / (m['union'] + 1e-10),
+                            'inv_mIoU': m['inv_intersection'] / (m['inv_union'] + 1e-10)})
+            print("order_th: {:.3g}, amodal_th: {:.3g}, acc_occpair: {:.5g}, mIoU: {:.5g}, "
+                  "inv_mIoU: {:.5g}".format(ot, at, results[-1]['acc_occpair'],
+                                            results[-1]['mIoU'], results[-1]['inv_mIoU']))
+        best = max(results, key=lambda r: r['mIoU'])
+        print("Best mIoU: {:.5g} at order_th: {:.3g}, amodal_th: {:.3g}".format(
+            best['mIoU'], best['order_th'], best['amodal_th']))
+        print("Sweep: {} settings, {} forwards, {} imgs in {:.4g} s".format(
+            len(results), session.misses, self.data_length, wall))
+        if args.sweep_output is not None:
+            if os.path.dirname(args.sweep_output) and \
+                    not os.path.isdir(os.path.dirname(args.sweep_output)):
+                os.makedirs(os.path.dirname(args.sweep_output))
+            with open(args.sweep_output, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def evaluate_grid(self, modal, amodal_gt, bboxes, h, w, order_matrices, amodal, amodal_ths):
+        '''
+        metric sums of one image for every (order th, amodal th) of infer_sweep
+        '''
+        gt_order_matrix = infer.infer_gt_order(modal, amodal_gt)
+        gt_sums = infer.gt_metrics(amodal_gt, modal)
+        amodal_metrics = {}
+        results = {}
+        for ot, order_matrix in order_matrices.items():
+            _, _, occpair_true, occpair, _ = infer.eval_order(
+                order_matrix, gt_order_matrix, with_err=False)
+            patches, probs = amodal[order_matrix.tobytes()]
+            for at in amodal_ths:
+                key = (order_matrix.tobytes(), at)
+                if key not in amodal_metrics:
+                    th = infer.forward_threshold(at, self.args)
+                    masks = [p['amodal'] if prob is None else (prob > th).astype(np.uint8)
+                             for p, prob in zip(patches, probs)]
+                    amodal_metrics[key] = infer.crop_metrics(
+                        infer.patch_to_crops(masks, bboxes, h, w, interp='linear'),
+                        amodal_gt, modal, gt_sums)
+                intersection, union, _, inv_intersection, inv_union = amodal_metrics[key]
+                results[(ot, at)] = {
+                    'occpair_true': occpair_true, 'occpair': occpair,
+                    'intersection': intersection, 'union': union,
+                    'inv_intersection': inv_intersection, 'inv_union': inv_union}
+        return results
 
-        print("Evaluation results. acc_allpair: {:.5g}, acc_occpair: {:.5g} \
-              mIoU: {:.5g}, pAcc: {:.5g}, inv_mIoU: {:.5g}".format(acc_allpair, acc_occpair, miou, pacc, inv_miou))
+    def reset_meters(self):
+        self.meters = {name: utils.AverageMeter() for name in [
+            'allpair_true', 'allpair', 'occpair_true', 'occpair', 'intersection',
+            'union', 'target', 'inv_intersection', 'inv_union']}
+        # for computing p-score
+        self.list_acc, self.list_iou, self.list_inv_iou = [], [], []
+        self.count = 0
 
-        # save
-        if not os.path.isdir(os.path.dirname(self.args.output)):
+    def evaluate_image(self, i, modal, category, amodal_gt, h, w,
+                       order_matrix, gt_order_matrix, amodal_pred):
+        '''
+        amodal_pred: (box, crop) per instance, metrics in crop space
+        '''
+        allpair_true, allpair, occpair_true, occpair, _ = infer.eval_order(
+            order_matrix, gt_order_matrix, with_err=False)
+        intersection, union, target, inv_intersection, inv_union = infer.crop_metrics(
+            amodal_pred, amodal_gt, modal)
+        values = {'allpair_true': allpair_true, 'allpair': allpair,
+                  'occpair_true': occpair_true, 'occpair': occpair,
+                  'intersection': intersection, 'union': union, 'target': target,
+                  'inv_intersection': inv_intersection, 'inv_union': inv_union}
+        # make output
+        # if self.dataset == 'KINS':
+        results = self.make_KINS_output(i, amodal_pred, category, h, w)
+        self.add_image(values, results)
+        if self.checkpoint is not None:
+            self.checkpoint.write(json.dumps({
+                'i': i, 'values': {k: float(v) for k, v in values.items()},
+                'results': results}) + '\n')
+            self.checkpoint.flush()
+
+    def add_image(self, values, results):
+        for name, value in values.items():
+            self.meters[name].update(value)
+
+        self.list_acc.append(values['occpair_true']/(values['occpair']+1e-6))
+        self.list_iou.append(values['intersection']/(values['union']+1e-6))
+        self.list_inv_iou.append(values['inv_intersection']/(values['inv_union']+1e-6))
+        if self.writer is not None:
+            self.writer.write(results)
+
+    def shard_path(self, shard_id):
+        return '{}.shard{}of{}.jsonl'.format(
+            os.path.splitext(self.args.output)[0], shard_id, self.args.num_shards)
+
+    def read_shard(self, path):
+        '''
+        streams the image records of a shard checkpoint (in image order), a
+        line cut by a crash is dropped
+        '''
+        if not os.path.isfile(path):
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                yield record
+
+    def open_output(self):
+        '''
+        results are streamed to --output (see utils.ResultWriter) as images
+        are evaluated, sharded runs only write their checkpoints
+        '''
+        self.writer = None
+        if self.args.num_shards > 1:
+            return
+        if os.path.dirname(self.args.output) and not os.path.isdir(os.path.dirname(self.args.output)):
             os.makedirs(os.path.dirname(self.args.output))
-        with open(self.args.output, 'w') as f:
-            json.dump(segm_json_results, f)
+        self.writer = utils.ResultWriter(self.args.output)
+
+    def start_shard(self):
+        '''
+        Images of this shard still to be done. With --resume or several
+        shards, results are checkpointed to shard_path after every image
+        (see evaluate_image); with --resume, the images of an existing
+        checkpoint are added to the meters and skipped.
+        '''
+        args = self.args
+        if not 0 <= args.shard_id < args.num_shards:
+            raise Exception("--shard-id must be in [0, {})".format(args.num_shards))
+        indices = list(range(args.shard_id, self.data_length, args.num_shards))
+        self.checkpoint = None
+        self.open_output()
+        if not args.resume and args.num_shards == 1:
+            return indices
+        records = list(self.read_shard(self.shard_path(args.shard_id))) if args.resume else []
+        for record in records:
+            self.add_image(record['values'], record['results'])
+            self.count += len(record['results'])
+        if os.path.dirname(args.output) and not os.path.isdir(os.path.dirname(args.output)):
+            os.makedirs(os.path.dirname(args.output))
+        # rewrite the complete records, dropping a cut last line
+        with open(self.shard_path(args.shard_id) + '.tmp', 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(self.shard_path(args.shard_id) + '.tmp', self.shard_path(args.shard_id))
+        self.checkpoint = open(self.shard_path(args.shard_id), 'a')
+        done = set(record['i'] for record in records)
+        if len(done) > 0:
+            print("Resuming shard {}/{}: {} of {} images done".format(
+                args.shard_id, args.num_shards, len(done), len(indices)))
+        return [i for i in indices if i not in done]
+
+    def finish_shard(self):
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+            self.checkpoint = None
+
+    def merge_shards(self):
+        '''
+        Metrics and --output of a sharded run, from the checkpoints of all
+        shards, identical to those of a single process run. Shards are
+        streamed, image i is the next record of shard i % num_shards.
+        '''
+        num_shards = self.args.num_shards
+        shards = [self.read_shard(self.shard_path(shard_id)) for shard_id in range(num_shards)]
+        self.reset_meters()
+        self.args.num_shards = 1
+        self.open_output()
+        for i in range(self.data_length):
+            record = next(shards[i % num_shards], None)
+            if record is None or record['i'] != i:
+                raise Exception("Cannot merge, image {} is missing in shard {}".format(
+                    i, i % num_shards))
+            results = record['results']
+            for data in results:
+                data['id'] = self.count
+                self.count += 1
+            self.add_image(record['values'], results)
+        print("Merged {} shards, {} images".format(num_shards, self.data_length))
+        self.print_results()
+        self.save_results()
+
+    def print_results(self):
+        m = self.meters
+        # an empty shard (or one without occluded pairs) has no pairs, guard like the mIoU terms
+        acc_allpair = m['allpair_true'].sum / (float(m['allpair'].sum) + 1e-10) # accuracy for all pairs
+        acc_occpair = m['occpair_true'].sum / (float(m['occpair'].sum) + 1e-10) # accuray for occluded pairs
+        miou = m['intersection'].sum / (m['union'].sum + 1e-10) # mIoU
+        pacc = m['intersection'].sum / (m['target'].sum + 1e-10) # pixel accuracy
+
+        inv_miou = m['inv_intersection'].sum / (m['inv_union'].sum + 1e-10) # mIoU
 
-    def make_KINS_output(self, idx, amodal_pred, category):
+        print("Evaluation results. acc_allpair: {:.5g}, acc_occpair: {:.5g} \
+              mIoU: {:.5g}, pAcc: {:.5g}, inv_mIoU: {:.5g}".format(acc_allpair, acc_occpair, miou, pacc, inv_miou))
+        return miou, acc_occpair
+
+    def save_results(self):
+        if self.args.num_shards > 1:
+            print("Shard {}/{} done, run with --merge to write {}".format(
+                self.args.shard_id, self.args.num_shards, self.args.output))
+            return
+        self.writer.close()
+        print("Saved {} results to {}".format(self.writer.count, self.args.output))
+
+    def make_KINS_output(self, idx, amodal_pred, category, height, width):
+        '''
+        amodal_pred: (box, crop) per instance, encoded to RLE from the crop
+        '''
         results = []
-        for i in range(amodal_pred.shape[0]):
+        for i, (box, crop) in enumerate(amodal_pred):
             data = dict()
-            rle = maskUtils.encode(
-                np.array(amodal_pred[i, :, :, np.newaxis], order='F'))[0]
+            rle = utils.crop_to_rle(box, crop, height, width)
             if hasattr(self.data_reader, 'img_ids'):
                 data['image_id'] = self.data_reader.img_ids[idx]
             data['category_id'] = category[i].item()
             if isinstance(rle['counts'], bytes):
                 rle['counts'] = rle['counts'].decode()
             data['segmentation'] = rle
-            data['bbox'] = utils.mask_to_bbox(amodal_pred[i, :, :])
+            data['bbox'] = utils.mask_to_bbox(crop)
+            if data['bbox'][2] > 0:
+                data['bbox'][0] += box[0]
+                data['bbox'][1] += box[1]
             data['area'] = float(data['bbox'][2] * data['bbox'][3])
             data['iscrowd'] = 0
             data['score'] = 1.
@@ -7,7 +7,8 @@ import torch
 import torch.optim
 import torch.distributed as dist
 import torchvision.utils as vutils
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
+from concurrent.futures import ThreadPoolExecutor
 
 import models
 import utils
@@ -28,9 +29,9 @@ class Trainer(object):
 
     def __init__(self, args):
 
-        # get rank
-        self.world_size = dist.get_world_size()
-        self.rank = dist.get_rank()
+        # get rank, a single process runs without a process group
+        self.world_size = utils.get_world_size()
+        self.rank = utils.get_rank()
 
         if self.rank == 0:
             # mkdir path
@@ -65,14 +66,25 @@ class Trainer(object):
                     'global_logger',
                     '{}/logs/log_train.txt'.format(args.exp_path))
 
+            # checkpoints are written in the background
+            self.ckpt_writer = utils.CheckpointWriter(
+                '{}/checkpoints'.format(args.exp_path),
+                keep_last=args.trainer.get('keep_last', 0),
+                keep_best=args.trainer.get('keep_best', 0))
+        else:
+            self.ckpt_writer = None
+
         # create model
         self.model = models.__dict__[args.model['algo']](
-            args.model, load_pretrain=args.load_pretrain, dist_model=True)
+            args.model, load_pretrain=args.load_pretrain, dist_model=dist.is_initialized())
 
         # optionally resume from a checkpoint
         assert not (args.load_iter is not None and args.load_pretrain is not None), \
             "load_iter and load_pretrain are exclusive."
 
+        if args.load_iter is not None and args.load_iter < 0:
+            # the latest checkpoint, if any
+            args.load_iter = utils.latest_iter("{}/checkpoints".format(args.exp_path))
         if args.load_iter is not None:
             self.model.load_state("{}/checkpoints".format(args.exp_path),
                                   args.load_iter, args.resume)
@@ -82,12 +94,12 @@ class Trainer(object):
 
         self.curr_step = self.start_iter
 
-        # args.data.val_image_root = 'data/COCOA/val2014' # originally
-        args.data['val_image_root'] = '/aul/homes/byang010/attacking-amodal/COCOA/s_val2014/animal'
         print(args.data)
         
-        # lr scheduler & datasets
+        # lr scheduler & datasets, counted in effective iterations of
+        # accumulate_steps micro-batches
         trainval_class = datasets.__dict__[args.data['trainval_dataset']]
+        self.accumulate_steps = args.model.get('accumulate_steps', 1)
 
         if not args.validate:  # train
             self.lr_scheduler = utils.StepLRScheduler(
@@ -103,7 +115,7 @@ class Trainer(object):
             train_sampler = utils.DistributedGivenIterationSampler(
                 train_dataset,
                 args.model['total_iter'],
-                args.data['batch_size'],
+                args.data['batch_size'] * self.accumulate_steps,
                 last_iter=self.start_iter - 1)
             self.train_loader = DataLoader(train_dataset,
                                            batch_size=args.data['batch_size'],
@@ -113,6 +125,12 @@ class Trainer(object):
                                            sampler=train_sampler)
         
         val_dataset = trainval_class(args.data, 'val')
+        images_info = val_dataset.data_reader.images_info
+        # online validation on val_subset evenly spaced samples
+        val_subset = args.trainer.get('val_subset', 0)
+        if not args.validate and val_subset > 0 and val_subset < len(val_dataset):
+            val_dataset = Subset(val_dataset, np.unique(
+                np.linspace(0, len(val_dataset) - 1, val_subset).astype(int)).tolist())
         val_sampler = utils.DistributedSequentialSampler(val_dataset)
         self.val_loader = DataLoader(
             val_dataset,
@@ -122,6 +140,19 @@ class Trainer(object):
             pin_memory=False,
             sampler=val_sampler)
 
+        # rank 0 writes validation images in the background, and with
+        # async_val validates a copy of the weights in another thread
+        self.val_future = None
+        if self.rank == 0:
+            self.io_executor = ThreadPoolExecutor(max_workers=1)
+            self.io_futures = [self.io_executor.submit(self.save_val_images_info, images_info)]
+            if args.trainer.get('async_val', False) and not args.validate:
+                self.val_model = models.__dict__[args.model['algo']](args.model, dist_model=False)
+                self.val_model.switch_to('eval')
+                self.async_val_loader = DataLoader(
+                    val_dataset, batch_size=32, shuffle=False, num_workers=0, pin_memory=False)
+                self.val_executor = ThreadPoolExecutor(max_workers=1)
+
         self.args = args
 
     def run(self):
@@ -129,6 +160,7 @@ class Trainer(object):
         # offline validate function is called 
         if self.args.validate:
             self.validate('off_val')
+            self.finish()
             return
 
         if self.args.trainer['initial_val']:
@@ -136,6 +168,7 @@ class Trainer(object):
 
         # train
         self.train()
+        self.finish()
 
     def train(self):
 
@@ -145,33 +178,54 @@ class Trainer(object):
         for rec in self.args.trainer['loss_record']:
             recorder[rec] = utils.AverageMeter(10)
 
+        # losses are summed on device and reduced when logging
+        metrics = utils.MetricAccumulator()
+
         self.model.switch_to('train')
 
+        # an iteration is accumulate_steps micro-batches, the optimizer
+        # steps on the last one
+        accumulate_steps = self.accumulate_steps
         end = time.time()
         for i, inputs in enumerate(self.train_loader):
-            self.curr_step = self.start_iter + i
-            self.lr_scheduler.step(self.curr_step)
-            curr_lr = self.lr_scheduler.get_lr()[0]
+            if i % accumulate_steps == 0:
+                self.curr_step = self.start_iter + i // accumulate_steps
+                self.lr_scheduler.step(self.curr_step)
+                curr_lr = self.lr_scheduler.get_lr()[0]
+                iter_start, dtime, losses, samples = end, 0., {}, 0
+            update = (i + 1) % accumulate_steps == 0
 
             # measure data loading time
-            dtime_rec.update(time.time() - end)
+            dtime += time.time() - end
 
             self.model.set_input(*inputs)
-            loss_dict = self.model.step()
+            samples += inputs[0].size(0)
+            loss_dict = self.model.step(update=update)
             for k in loss_dict.keys():
-                recorder[k].update(utils.reduce_tensors(loss_dict[k]).item())
+                losses[k] = losses.get(k, 0) + loss_dict[k].detach() / accumulate_steps
+            end = time.time()
+            if not update:
+                continue
 
-            btime_rec.update(time.time() - end)
+            metrics.update(losses, samples)
+            dtime_rec.update(dtime)
+            btime_rec.update(time.time() - iter_start)
             end = time.time()
 
             self.curr_step += 1
 
-            # logging
+            # logging, the losses are the mean over the last print_freq iterations
+            if self.curr_step % self.args.trainer['print_freq'] == 0:
+                stats = metrics.reduce()
+                for k in recorder.keys():
+                    recorder[k].update(stats[k])
             if self.rank == 0 and self.curr_step % self.args.trainer[
                     'print_freq'] == 0:
                 loss_str = ""
                 if self.tb_logger is not None:
                     self.tb_logger.add_scalar('lr', curr_lr, self.curr_step)
+                    self.tb_logger.add_scalar('samples_per_sec', stats['samples_per_sec'],
+                                              self.curr_step)
                 for k in recorder.keys():
                     if self.tb_logger is not None:
                         self.tb_logger.add_scalar('train_{}'.format(k),
@@ -182,11 +236,13 @@ class Trainer(object):
 
                 self.logger.info(
                     'Iter: [{0}/{1}]\t'.format(self.curr_step,
-                                               len(self.train_loader)) +
+                                               self.args.model['total_iter']) +
                     'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'.format(
                         batch_time=btime_rec) +
                     'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'.format(
                         data_time=dtime_rec) + loss_str +
+                    '{:.1f} samples/s {:.2f} it/s\t'.format(
+                        stats['samples_per_sec'], stats['iters_per_sec']) +
                     'lr {lr:.2g}'.format(lr=curr_lr))
 
             # save
@@ -195,105 +251,130 @@ class Trainer(object):
                  self.curr_step == self.args.model['total_iter'])):
                 self.model.save_state(
                     "{}/checkpoints".format(self.args.exp_path),
-                    self.curr_step)
+                    self.curr_step, writer=self.ckpt_writer)
 
             # validate
             if (self.curr_step % self.args.trainer['val_freq'] == 0 or
                 self.curr_step == self.args.model['total_iter']):
                 self.validate('on_val')
 
-    def validate(self, phase):        
+    def validate(self, phase):
+        if phase == 'on_val' and self.args.trainer.get('async_val', False):
+            self.validate_async()
+            return None
+        self.model.switch_to('eval')
+        stats = self.run_validation(self.model, self.val_loader, phase, self.curr_step, True)
+        self.model.switch_to('train')
+        return stats
+
+    def validate_async(self):
+        '''
+        validates a snapshot of the current weights in a background thread
+        of rank 0, on the whole val subset; training goes on meanwhile
+        '''
+        if self.rank != 0:
+            return
+        self.wait_validation()
+        self.val_model.model.load_state_dict(self.model.model.state_dict())
+        self.val_future = self.val_executor.submit(
+            self.run_validation, self.val_model, self.async_val_loader, 'on_val',
+            self.curr_step, False)
+
+    def wait_validation(self):
+        if self.val_future is not None:
+            future, self.val_future = self.val_future, None
+            future.result()
+
+    def run_validation(self, model, loader, phase, step, distributed):
+        '''
+        losses over loader, reduced over the processes in one collective if
+        distributed (every process validates its shard). Visualization and
+        logging are left to rank 0, images are written in the background.
+        '''
         btime_rec = utils.AverageMeter(0)
         dtime_rec = utils.AverageMeter(0)
-        recorder = {}
-        for rec in self.args.trainer['loss_record']:
-            recorder[rec] = utils.AverageMeter(10)
-
-        self.model.switch_to('eval')
+        metrics = utils.MetricAccumulator(distributed=distributed)
+        val_iter = self.args.trainer.get('val_iter', -1)
+        disp_start = max(self.args.trainer['val_disp_start_iter'], 0)
+        disp_end = min(self.args.trainer['val_disp_end_iter'], len(loader))
+        disp = []
 
         end = time.time()
-        
-        # accessing image info
-        images_info = self.val_loader.dataset.data_reader.images_info
-        with open("batch_images_used_for_masks.json", "w") as outfile:
-            print('...how many images are we expecting to get masks for? ', len(images_info))
-            # extract the filenames for each image
-            for b in range(len(images_info)):
-                img_info = images_info[b]
-                json.dump(img_info['file_name'], outfile)
-                outfile.write('\n')
-            print('...image filenames of the batch corresponding to masks saved in file batch_images_used_for_masks.json')
-        
-        all_together = []
-        for i, inputs in enumerate(self.val_loader):
-            if ('val_iter' in self.args.trainer and self.args.trainer['val_iter'] != -1 and i == self.args.trainer['val_iter']):
+        for i, inputs in enumerate(loader):
+            if val_iter != -1 and i == val_iter:
                 break
-
             dtime_rec.update(time.time() - end)
-            
-            # inputs is a list of length 4
-            # inputs[0] has a length of size batch_size set for val_loader (right now 1000)
-            # types in inputs: <class 'torch.Tensor'> <class 'torch.Tensor'> <class 'torch.Tensor'> <class 'torch.Tensor'>
-            # print('types in inputs: ', type(inputs[0]), type(inputs[1]), type(inputs[2]), type(inputs[3]))
-            
-            # print('...inputs.data_reader.images_info', len(inputs.data_reader.images_info))
-            # print('...one of them', inputs.data_reader.images_info[0:4])
-            self.model.set_input(*inputs)
-            
-            # tensor_dict has the output of the for each val_loader input
-            tensor_dict, loss_dict = self.model.forward_only(val=phase=='off_val')
-
-            # original_images = inputs[0]
-            # new_tensor_dict = {'originals': original_images}
-            # tensor_dict.update(new_tensor_dict)
-            
-            for k in loss_dict.keys():
-                recorder[k].update(utils.reduce_tensors(loss_dict[k]).item())
+
+            model.set_input(*inputs)
+            tensor_dict, loss_dict = model.forward_only(val=phase=='off_val')
+            metrics.update(loss_dict)
+
             btime_rec.update(time.time() - end)
             end = time.time()
 
-            # tb visualize
-            
-            # if self.rank == 0:
-            # what if i try to run this for every batch
-            disp_start = max(self.args.trainer['val_disp_start_iter'], 0)
-            disp_end = min(self.args.trainer['val_disp_end_iter'], len(self.val_loader))
-            print('...i, disp_start, disp_end: ', i, disp_start, disp_end)
-            
-            if (i >= disp_start and i < disp_end):
-                all_together.append(utils.visualize_tensor(tensor_dict, self.args.data.get('data_mean', [0,0,0]), self.args.data.get('data_std', [1,1,1])))
-             
-            if (i == disp_end - 1 and disp_end > disp_start):
-                all_together = torch.cat(all_together, dim=2)
-                # so it seems all_together has a column of mask/boundary images, we want to get the column of original images (added)
-                # this only once in this for-loop
-                grid = vutils.make_grid(all_together,
-                                        nrow=1,
-                                        normalize=True,
-                                        range=(0, 255),
-                                        scale_each=False)
-                print('...grid shape from validate: ', grid.shape) # grid shape is the same as all_together shape
-                
-                if self.tb_logger is not None:
-                    self.tb_logger.add_image('Image_' + phase, grid, self.curr_step)
-                cv2.imwrite("{}/images/{}_{}_{}.png".format(self.args.exp_path, phase, self.curr_step, i), grid.permute(1, 2, 0).numpy()*255)
-
-        # logging
-        if self.rank == 0:
-            loss_str = ""
-            for k in recorder.keys():
-                if self.tb_logger is not None and phase == 'on_val':
-                    self.tb_logger.add_scalar('val_{}'.format(k),
-                                              recorder[k].avg,
-                                              self.curr_step)
-                loss_str += '{}: {loss.val:.4g} ({loss.avg:.4g})\t'.format(
-                    k, loss=recorder[k])
+            if self.rank == 0 and i >= disp_start and i < disp_end:
+                disp.append(utils.cpu_snapshot(tensor_dict))
+
+        stats = metrics.reduce()
+        if self.rank != 0:
+            return stats
+
+        self.check_io()
+        if len(disp) > 0:
+            self.io_futures.append(self.io_executor.submit(
+                self.save_visualization, disp, phase, step, disp_end - 1))
+
+        loss_str = ""
+        for k in self.args.trainer['loss_record']:
+            if self.tb_logger is not None and phase == 'on_val':
+                self.tb_logger.add_scalar('val_{}'.format(k), stats[k], step)
+            loss_str += '{}: {:.4g}\t'.format(k, stats[k])
+        self.logger.info(
+            'Validation Iter: [{0}]\t'.format(step) +
+            'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'.format(
+                batch_time=btime_rec) +
+            'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'.format(
+                data_time=dtime_rec) + loss_str)
+
+        # for keep_best, lower is better
+        if phase == 'on_val' and self.ckpt_writer is not None:
+            self.ckpt_writer.set_metric(
+                step, stats[self.args.trainer.get('best_key', self.args.trainer['loss_record'][0])])
+        return stats
+
+    def save_visualization(self, disp, phase, step, i):
+        all_together = torch.cat([utils.visualize_tensor(
+            tensor_dict, self.args.data.get('data_mean', [0,0,0]),
+            self.args.data.get('data_std', [1,1,1])) for tensor_dict in disp], dim=2)
+        grid = vutils.make_grid(all_together,
+                                nrow=1,
+                                normalize=True,
+                                value_range=(0, 255),
+                                scale_each=False)
+        if self.tb_logger is not None:
+            self.tb_logger.add_image('Image_' + phase, grid, step)
+        cv2.imwrite("{}/images/{}_{}_{}.png".format(self.args.exp_path, phase, step, i),
+                    grid.permute(1, 2, 0).numpy()*255)
+
+    def save_val_images_info(self, images_info):
+        ''' file names of the val images, one json string per line '''
+        with open("batch_images_used_for_masks.json", "w") as outfile:
+            for img_info in images_info:
+                json.dump(img_info['file_name'], outfile)
+                outfile.write('\n')
 
-            self.logger.info(
-                'Validation Iter: [{0}]\t'.format(self.curr_step) +
-                'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'.format(
-                    batch_time=btime_rec) +
-                'Data {data_time.val:.3f} ({data_time.avg:.3f})\t'.format(
-                    data_time=dtime_rec) + loss_str)
+    def check_io(self):
+        ''' raises the error of a failed background write, drops finished ones '''
+        for future in [f for f in self.io_futures if f.done()]:
+            self.io_futures.remove(future)
+            future.result()
 
-        self.model.switch_to('train')
\ No newline at end of file
+    def finish(self):
+        ''' waits for the background validation, images and checkpoints '''
+        if self.rank != 0:
+            return
+        self.wait_validation()
+        for future in self.io_futures:
+            future.result()
+        self.io_executor.shutdown()
+        self.ckpt_writer.close()
@@ -3,3 +3,5 @@ from .data_utils import *
 from .scheduler import *
 from .distributed_utils import *
 from .visualize_utils import *
+from .result_utils import *
+from .checkpoint_utils import *
@@ -0,0 +1,136 @@
+import os
+import re
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def cpu_snapshot(obj):
+    '''
+    a copy of a (nested) state dict with every tensor copied to cpu memory
+    '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def load_checkpoint(path, map_location=None):
+    '''
+    torch.load, memory-mapped if torch supports it (>= 2.1): tensors are
+    read from the file on access instead of up front.
+    '''
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(path, map_location=map_location, mmap=True)
+        except RuntimeError:
+            # legacy (non zip) checkpoints can not be memory-mapped
+            pass
+    return torch.load(path, map_location=map_location)
+
+
+def save_checkpoint(step, states, writer=None):
+    '''
+    states: {path: state dict}, written by a CheckpointWriter if given,
+    else synchronously
+    '''
+    if writer is not None:
+        writer.save(step, states)
+        return
+    for path, state in states.items():
+        torch.save(state, path)
+
+
+def checkpoint_iters(root, prefix='ckpt_iter_'):
+    ''' sorted iterations of the checkpoints {prefix}{iter}.pth.tar in root '''
+    if not os.path.isdir(root):
+        return []
+    pattern = re.compile(r'^{}(\d+)\.pth\.tar$'.format(re.escape(prefix)))
+    iters = [int(m.group(1)) for m in (pattern.match(f) for f in os.listdir(root)) if m]
+    return sorted(iters)
+
+
+def latest_iter(root, prefix='ckpt_iter_'):
+    ''' iteration of the latest checkpoint in root, None if there is none '''
+    iters = checkpoint_iters(root, prefix)
+    return iters[-1] if len(iters) > 0 else None
+
+
+class CheckpointWriter(object):
+    '''
+    Writes checkpoints in a background thread. save() copies the states to
+    cpu memory and returns, the files are written to path.tmp and renamed
+    to path when complete, so a crash never leaves a partial checkpoint.
+
+    Retention (both 0 keeps all): the keep_last latest checkpoints (at
+    least the latest, for resuming) and the keep_best ones with the lowest
+    metric (see set_metric) are kept, all files of a step are removed
+    together. Checkpoints found in root at start count, without metric.
+    '''
+    def __init__(self, root, keep_last=0, keep_best=0, prefixes=('ckpt_iter_', 'D_iter_')):
+        self.root = root
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.lock = threading.Lock()
+        # step: [paths], step: metric
+        self.files = {}
+        self.metrics = {}
+        for prefix in prefixes:
+            for it in checkpoint_iters(root, prefix):
+                self.files.setdefault(it, []).append(
+                    os.path.join(root, '{}{}.pth.tar'.format(prefix, it)))
+
+    def save(self, step, states):
+        '''
+        states: {path: state dict}, the files of checkpoint step
+        '''
+        # one checkpoint in flight, bounds the memory of the snapshots
+        self.wait()
+        snapshot = [(path, cpu_snapshot(state)) for path, state in states.items()]
+        self.future = self.executor.submit(self._write, step, snapshot)
+
+    def _write(self, step, snapshot):
+        for path, state in snapshot:
+            torch.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        with self.lock:
+            self.files[step] = [path for path, _ in snapshot]
+        self._retain()
+
+    def set_metric(self, step, value):
+        ''' metric (lower is better) of checkpoint step, for keep_best '''
+        with self.lock:
+            self.metrics[step] = value
+        if self.future is None or self.future.done():
+            self._retain()
+
+    def _retain(self):
+        if self.keep_last <= 0 and self.keep_best <= 0:
+            return
+        with self.lock:
+            steps = sorted(self.files.keys())
+            keep = set(steps[-max(self.keep_last, 1):])
+            rated = sorted([s for s in steps if s in self.metrics], key=lambda s: self.metrics[s])
+            keep |= set(rated[:self.keep_best])
+            for step in steps:
+                if step not in keep:
+                    for path in self.files.pop(step):
+                        if os.path.isfile(path):
+                            os.remove(path)
+
+    def wait(self):
+        ''' waits for the pending write, raises its error if it failed '''
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -1,10 +1,15 @@
 import os
+import time
 import logging
+import threading
+from contextlib import contextmanager, nullcontext
 import numpy as np
 
 import torch
 from torch.nn import init
 
+from .checkpoint_utils import load_checkpoint
+
 
 def init_weights(net, init_type='normal', init_gain=0.02):
     """Initialize network weights.
@@ -77,6 +82,64 @@ class AverageMeter(object):
             self.count += 1
             self.avg = self.sum / self.count
             
+class StageTimer(object):
+    """Busy time and processed images per pipeline stage, thread-safe"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.names = []
+        self.busy = {}
+        self.count = {}
+
+    @contextmanager
+    def stage(self, name, num=1):
+        start = time.time()
+        yield
+        elapsed = time.time() - start
+        with self.lock:
+            if name not in self.busy:
+                self.names.append(name)
+                self.busy[name] = 0.
+                self.count[name] = 0
+            self.busy[name] += elapsed
+            self.count[name] += num
+
+    def report(self, threads=None):
+        """threads: number of threads running a stage, 1 by default"""
+        lines = []
+        for name in self.names:
+            num = (threads or {}).get(name, 1)
+            lines.append("{}: {} imgs, busy {:.4g} s, {:.4g} imgs/s ({} thread{})".format(
+                name, self.count[name], self.busy[name],
+                num * self.count[name] / max(self.busy[name], 1e-10), num, 's' if num > 1 else ''))
+        return lines
+
+def amp_dtype(params, device):
+    """Reduced precision dtype of the model option amp, None for fp32.
+    amp: False, True (float16 on cuda, bfloat16 on cpu), 'float16' or 'bfloat16'
+    """
+    amp = params.get('amp', False)
+    if not amp:
+        return None
+    if amp is True:
+        return torch.float16 if device.type == 'cuda' else torch.bfloat16
+    if amp not in ['float16', 'bfloat16']:
+        raise Exception("No such amp mode: {}".format(amp))
+    return getattr(torch, amp)
+
+def autocast(device, dtype):
+    """autocast context of amp_dtype, does nothing for fp32"""
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device.type, dtype=dtype)
+
+def grad_scaler(device, dtype):
+    """loss scaling, only enabled for float16 on cuda (a no-op otherwise)"""
+    enabled = dtype == torch.float16 and device.type == 'cuda'
+    if not hasattr(torch.amp, 'GradScaler'):
+        # torch < 2.3
+        return torch.cuda.amp.GradScaler(enabled=enabled)
+    return torch.amp.GradScaler(device.type, enabled=enabled)
+
 def accuracy(output, target, topk=(1,)):
     """Computes the precision@k for the specified values of k"""
     maxk = max(topk)
@@ -92,12 +155,14 @@ def accuracy(output, target, topk=(1,)):
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
-def load_state(path, model, optimizer=None):
+def load_state(path, model, optimizer=None, map_location=None):
     def map_func(storage, location):
         return storage.cuda()
+    if map_location is None:
+        map_location = map_func
     if os.path.isfile(path):
         print("=> loading checkpoint '{}'".format(path))
-        checkpoint = torch.load(path, map_location=map_func)
+        checkpoint = load_checkpoint(path, map_location=map_location)
         model.load_state_dict(checkpoint['state_dict'], strict=False)
         ckpt_keys = set(checkpoint['state_dict'].keys())
         own_keys = set(model.state_dict().keys())
@@ -114,13 +179,15 @@ def load_state(path, model, optimizer=None):
     else:
         raise Exception("=> no checkpoint found at '{}'".format(path))
 
-def load_weights(path, model):
+def load_weights(path, model, map_location=None):
     def map_func(storage, location):
         return storage.cuda()
+    if map_location is None:
+        map_location = map_func
     if not os.path.isfile(path):
         raise Exception("File not exist: {}".format(path))
     print("=> loading checkpoint '{}'".format(path))
-    weights = torch.load(path, map_location=map_func)
+    weights = load_checkpoint(path, map_location=map_location)
     model.load_state_dict(weights, strict=False)
     ckpt_keys = set(weights.keys())
     own_keys = set(model.state_dict().keys())
@@ -30,6 +30,47 @@ def mask_to_bbox(mask):
     cmin, cmax = np.where(cols)[0][[0, -1]]
     return [cmin.item(), rmin.item(), cmax.item() + 1 - cmin.item(), rmax.item() + 1 - rmin.item()] # xywh
 
+def clip_crop(crop, box, height, width):
+    '''
+    crop: hxw mask placed at box (x,y,w,h) of a height x width image
+    -> (box, crop) clipped to the image, box may become empty
+    '''
+    x, y, w, h = [int(v) for v in box]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = max(min(x + w, width), x1), max(min(y + h, height), y1)
+    return [x1, y1, x2 - x1, y2 - y1], crop[y1 - y:y2 - y, x1 - x:x2 - x]
+
+def crop_to_dense(box, crop, height, width):
+    mask = np.zeros((height, width), dtype=crop.dtype)
+    x, y, w, h = box
+    mask[y:y+h, x:x+w] = crop
+    return mask
+
+def crop_to_rle(box, crop, height, width):
+    '''
+    COCO RLE of the height x width mask that is crop at box (clipped, see
+    clip_crop) and zero elsewhere, without building the full mask.
+    '''
+    import pycocotools.mask as maskUtils
+    x, y, w, h = box
+    # column-major transitions of the crop, each column padded with zeros
+    cols = np.zeros((w, h + 2), dtype=np.int8)
+    cols[:, 1:-1] = (crop > 0).T
+    c, r = np.nonzero(np.diff(cols, axis=1))
+    trans = (x + c) * height + y + r
+    # a run ending at the bottom of a column and one starting at the top of
+    # the next are the same run in column-major order
+    if len(trans) > 0:
+        keep = np.ones(len(trans), dtype=bool)
+        dup = np.nonzero(trans[1:] == trans[:-1])[0]
+        keep[dup] = False
+        keep[dup + 1] = False
+        trans = trans[keep]
+    counts = np.diff(np.concatenate([[0], trans, [height * width]])).tolist()
+    if len(counts) > 1 and counts[-1] == 0:
+        counts.pop()
+    return maskUtils.frPyObjects({'size': [height, width], 'counts': counts}, height, width)
+
 def bbox_iou(b1, b2):
     '''
     b: (x1,y1,x2,y2)
@@ -67,6 +108,42 @@ def crop_padding(img, roi, pad_value):
         output = np.squeeze(output)
     return output
 
+def fit_image(img, size, interpolation=cv2.INTER_LINEAR):
+    '''
+    img: HxWxC np.ndarray -> size x size x C, resized so that the longer
+    side is size and zero padded at the bottom / right, and the scale.
+    Boxes of img map to the result multiplied by the scale.
+    '''
+    H, W = img.shape[:2]
+    scale = size / float(max(H, W))
+    h, w = min(int(round(H * scale)), size), min(int(round(W * scale)), size)
+    output = np.zeros((size, size) + img.shape[2:], dtype=img.dtype)
+    output[:h, :w] = cv2.resize(img, (w, h), interpolation=interpolation)
+    return output, scale
+
+def paste_patch(img, box, patch, alpha):
+    '''
+    img: HxWxC float np.ndarray, blended in place with patch (hxwxC) resized
+    to box (x1, y1, x2, y2), weighted by alpha (hxw, in [0, 1]). Parts of
+    the box outside img are dropped.
+    '''
+    x1, y1, x2, y2 = [int(round(v)) for v in box]
+    if x2 <= x1 or y2 <= y1:
+        return img
+    patch = cv2.resize(patch.astype(np.float32), (x2 - x1, y2 - y1), interpolation=cv2.INTER_LINEAR)
+    alpha = cv2.resize(alpha.astype(np.float32), (x2 - x1, y2 - y1), interpolation=cv2.INTER_LINEAR)
+    if patch.ndim == 2:
+        patch = patch[:, :, np.newaxis]
+    alpha = alpha[:, :, np.newaxis]
+    H, W = img.shape[:2]
+    u1, v1, u2, v2 = max(x1, 0), max(y1, 0), min(x2, W), min(y2, H)
+    if u2 <= u1 or v2 <= v1:
+        return img
+    patch = patch[v1-y1:v2-y1, u1-x1:u2-x1]
+    alpha = alpha[v1-y1:v2-y1, u1-x1:u2-x1]
+    img[v1:v2, u1:u2] = img[v1:v2, u1:u2] * (1 - alpha) + patch * alpha
+    return img
+
 def place_eraser(inst, eraser, min_overlap, max_overlap):
     assert len(inst.shape) == 2
     assert len(eraser.shape) == 2
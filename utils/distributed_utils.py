@@ -1,37 +1,174 @@
 import os
+import time
 import subprocess
 import numpy as np
 import multiprocessing as mp
 import math
+from contextlib import contextmanager, nullcontext
 
 import torch
 import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 from torch.utils.data.sampler import Sampler
 from torch.nn import Module
 
+def _buckets(tensors, cap_bytes):
+    """ consecutive tensors of the same dtype and device, up to cap_bytes each """
+    buckets, size = [], 0
+    for t in tensors:
+        nbytes = t.numel() * t.element_size()
+        if (len(buckets) == 0 or buckets[-1][0].dtype != t.dtype or
+                buckets[-1][0].device != t.device or size + nbytes > cap_bytes):
+            buckets.append([])
+            size = 0
+        buckets[-1].append(t)
+        size += nbytes
+    return buckets
+
 class DistModule(Module):
-    def __init__(self, module):
+    """
+    Data parallel wrapper. Parameters are broadcast from rank 0, gradients
+    are summed over processes in buckets of about bucket_cap_mb, each
+    all-reduce is launched asynchronously as soon as the gradients of its
+    bucket are accumulated in backward, overlapping communication with the
+    rest of backward. sync_gradients() (average_gradients) waits for them.
+    Works with nccl and gloo.
+    """
+    def __init__(self, module, bucket_cap_mb=25):
         super(DistModule, self).__init__()
         self.module = module
         broadcast_params(self.module)
+        self.require_grad_sync = True
+        # gradients become ready roughly in reverse order of the parameters
+        params = [p for p in self.module.parameters() if p.requires_grad][::-1]
+        self.buckets = _buckets(params, bucket_cap_mb * 1024 * 1024)
+        self.bucket_of = {}
+        for k, bucket in enumerate(self.buckets):
+            for p in bucket:
+                self.bucket_of[p] = k
+        self._reset()
+        # hooks on the gradient accumulators fire once p.grad is accumulated
+        self._grad_accs = []
+        for p in params:
+            grad_acc = p.expand_as(p).grad_fn.next_functions[0][0]
+            grad_acc.register_hook(self._make_hook(p))
+            self._grad_accs.append(grad_acc)
+
     def forward(self, *inputs, **kwargs):
         return self.module(*inputs, **kwargs)
+
     def train(self, mode=True):
         super(DistModule, self).train(mode)
         self.module.train(mode)
 
+    def _reset(self):
+        self.pending = [len(bucket) for bucket in self.buckets]
+        self.works = [None] * len(self.buckets)
+        self.stale = [False] * len(self.buckets)
+        self.next_bucket = 0
+
+    def _make_hook(self, p):
+        def hook(*unused):
+            if self.require_grad_sync:
+                self._mark_ready(self.bucket_of[p])
+        return hook
+
+    def _mark_ready(self, k):
+        if self.works[k] is not None:
+            # a second backward before sync_gradients, reduce again then
+            self.stale[k] = True
+            return
+        self.pending[k] -= 1
+        # all processes launch the buckets in the same order
+        while self.next_bucket < len(self.buckets) and self.pending[self.next_bucket] == 0:
+            self._launch(self.next_bucket)
+            self.next_bucket += 1
+
+    def _launch(self, k):
+        grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in self.buckets[k]]
+        # a copy, p.grad may still change (see _mark_ready)
+        flat = torch.cat([g.reshape(-1) for g in grads])
+        self.works[k] = (dist.all_reduce(flat, async_op=True), flat)
+
+    def sync_gradients(self):
+        """ waits for (and launches the rest of) the bucket all-reduces """
+        for k in range(len(self.buckets)):
+            if self.works[k] is None or self.stale[k]:
+                if self.works[k] is not None:
+                    self.works[k][0].wait()
+                self._launch(k)
+        for k, bucket in enumerate(self.buckets):
+            work, flat = self.works[k]
+            work.wait()
+            for p, g in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+                if p.grad is None:
+                    p.grad = g
+                else:
+                    p.grad.copy_(g)
+        self._reset()
+
+    @contextmanager
+    def no_sync(self):
+        """ gradients of backward passes in this context are only accumulated """
+        self.require_grad_sync = False
+        try:
+            yield
+        finally:
+            self.require_grad_sync = True
+
+def grad_sync(model, enabled=True):
+    """ context of a backward pass, no_sync() of a DistModule if not enabled """
+    if enabled or not isinstance(model, DistModule):
+        return nullcontext()
+    return model.no_sync()
+
 def average_gradients(model):
     """ average gradients """
+    if isinstance(model, DistModule):
+        model.sync_gradients()
+        return
+    if not dist.is_initialized():
+        return
     for param in model.parameters():
         if param.requires_grad:
             dist.all_reduce(param.grad.data)
 
-def broadcast_params(model):
-    """ broadcast model parameters """
-    for p in model.state_dict().values():
-        dist.broadcast(p, 0)
-
-def dist_init(launcher, backend='nccl', **kwargs):
+def broadcast_params(model, bucket_cap_mb=25):
+    """ broadcast model parameters and buffers, in buckets """
+    tensors = list(model.state_dict().values())
+    for bucket in _buckets(tensors, bucket_cap_mb * 1024 * 1024):
+        flat = _flatten_dense_tensors(bucket)
+        dist.broadcast(flat, 0)
+        for t, b in zip(bucket, _unflatten_dense_tensors(flat, bucket)):
+            t.copy_(b)
+
+def get_world_size():
+    """ world size, 1 without a process group """
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+def get_rank():
+    """ rank, 0 without a process group """
+    return dist.get_rank() if dist.is_initialized() else 0
+
+def default_backend():
+    return 'nccl' if torch.cuda.is_available() else 'gloo'
+
+def dist_device():
+    """ device of the tensors of collectives: cuda for nccl, cpu otherwise """
+    if dist.is_initialized() and dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+def dist_init(launcher, backend=None, **kwargs):
+    """
+    launcher: pytorch, slurm or none (a single process without a process
+    group). backend: nccl (gpus) or gloo (cpu), default nccl if cuda is
+    available.
+    """
+    if launcher == 'none':
+        return
+    if backend is None:
+        backend = default_backend()
     if mp.get_start_method(allow_none=True) is None:
         mp.set_start_method('spawn')
     if launcher == 'pytorch':
@@ -46,8 +183,9 @@ def dist_init(launcher, backend='nccl', **kwargs):
 def _init_dist_pytorch(backend, **kwargs):
     rank = int(os.environ['RANK'])
     print('rank: ', rank)
-    num_gpus = torch.cuda.device_count()
-    torch.cuda.set_device(rank % num_gpus)
+    if backend == 'nccl':
+        num_gpus = torch.cuda.device_count()
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', rank)) % num_gpus)
     dist.init_process_group(backend=backend, **kwargs)
 
 def _init_dist_mpi(backend, **kwargs):
@@ -57,8 +195,9 @@ def _init_dist_slurm(backend, port=10086, **kwargs):
     proc_id = int(os.environ['SLURM_PROCID'])
     ntasks = int(os.environ['SLURM_NTASKS'])
     node_list = os.environ['SLURM_NODELIST']
-    num_gpus = torch.cuda.device_count()
-    torch.cuda.set_device(proc_id % num_gpus)
+    if backend == 'nccl':
+        num_gpus = torch.cuda.device_count()
+        torch.cuda.set_device(proc_id % num_gpus)
     addr = subprocess.getoutput(
         'scontrol show hostname {} | head -n1'.format(node_list))
     os.environ['MASTER_PORT'] = str(port)
@@ -72,8 +211,9 @@ def gather_tensors(input_array):
     ## gather shapes first
     myshape = input_array.shape
     mycount = input_array.size
-    shape_tensor = torch.Tensor(np.array(myshape)).cuda()
-    all_shape = [torch.Tensor(np.array(myshape)).cuda() for i in range(world_size)]
+    device = dist_device()
+    shape_tensor = torch.Tensor(np.array(myshape)).to(device)
+    all_shape = [torch.Tensor(np.array(myshape)).to(device) for i in range(world_size)]
     dist.all_gather(all_shape, shape_tensor)
     ## compute largest shapes
     all_shape = [x.cpu().numpy() for x in all_shape]
@@ -81,10 +221,10 @@ def gather_tensors(input_array):
     all_shape = [list(map(int, x)) for x in all_shape]
     max_count = max(all_count)
     ## padding tensors and gather them
-    output_tensors = [torch.Tensor(max_count).cuda() for i in range(world_size)]
+    output_tensors = [torch.Tensor(max_count).to(device) for i in range(world_size)]
     padded_input_array = np.zeros(max_count)
     padded_input_array[:mycount] = input_array.reshape(-1)
-    input_tensor = torch.Tensor(padded_input_array).cuda()
+    input_tensor = torch.Tensor(padded_input_array).to(device)
     dist.all_gather(output_tensors, input_tensor)
     ## unpadding gathered tensors
     padded_output = [x.cpu().numpy() for x in output_tensors]
@@ -109,15 +249,59 @@ def gather_tensors_batch(input_array, part_size=10):
 
 def reduce_tensors(tensor):
     reduced_tensor = tensor.clone()
+    if not dist.is_initialized():
+        return reduced_tensor
     dist.all_reduce(reduced_tensor)
     return reduced_tensor
 
+class MetricAccumulator(object):
+    """
+    Running sums of metrics, kept on their device between logging steps.
+    update() adds one iteration without synchronizing, reduce() sums all
+    keys and the sample count over processes in one flattened all-reduce
+    and returns the mean of each key per iteration since the last reduce,
+    with samples_per_sec (over all processes) and iters_per_sec.
+    All processes must call reduce() together, with the same keys, unless
+    distributed is False (local metrics of one process).
+    """
+    def __init__(self, distributed=True):
+        self.distributed = distributed
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.iters = 0
+        self.samples = 0
+        self.start = time.time()
+
+    def update(self, metrics, num_samples=0):
+        for k, v in metrics.items():
+            v = v.detach().float() if torch.is_tensor(v) else torch.tensor(float(v))
+            self.sums[k] = self.sums[k] + v if k in self.sums else v.clone()
+        self.iters += 1
+        self.samples += num_samples
+
+    def reduce(self):
+        keys = sorted(self.sums.keys())
+        device = self.sums[keys[0]].device if len(keys) > 0 else dist_device()
+        flat = torch.stack([self.sums[k].to(device).reshape(()) for k in keys] +
+                           [torch.tensor(float(self.samples), device=device)])
+        if self.distributed and dist.is_initialized():
+            dist.all_reduce(flat)
+        values = flat.tolist()
+        elapsed = max(time.time() - self.start, 1e-10)
+        stats = {k: v / max(self.iters, 1) for k, v in zip(keys, values[:-1])}
+        stats['samples_per_sec'] = values[-1] / elapsed
+        stats['iters_per_sec'] = self.iters / elapsed
+        self.reset()
+        return stats
+
 class DistributedSequentialSampler(Sampler):
     def __init__(self, dataset, world_size=None, rank=None):
         if world_size == None:
-            world_size = dist.get_world_size()
+            world_size = get_world_size()
         if rank == None:
-            rank = dist.get_rank()
+            rank = get_rank()
         self.dataset = dataset
         self.world_size = world_size
         self.rank = rank
@@ -178,9 +362,9 @@ class GivenIterationSampler(Sampler):
 class DistributedGivenIterationSampler(Sampler):
     def __init__(self, dataset, total_iter, batch_size, world_size=None, rank=None, last_iter=-1):
         if world_size is None:
-            world_size = dist.get_world_size()
+            world_size = get_world_size()
         if rank is None:
-            rank = dist.get_rank()
+            rank = get_rank()
         assert rank < world_size
         self.dataset = dataset
         self.total_iter = total_iter
@@ -0,0 +1,101 @@
+import gzip
+import json
+import re
+
+
+def open_results(path, mode='r'):
+    '''
+    text file object of a result file, gzip compressed if path ends with .gz
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+def is_jsonl(path):
+    return path[:-3].endswith('.jsonl') if path.endswith('.gz') else path.endswith('.jsonl')
+
+
+class ResultWriter(object):
+    '''
+    Writes COCO results (dicts) as they are produced: a json array, or one
+    json object per line if path ends with .jsonl (.jsonl.gz), gzip
+    compressed if path ends with .gz. The file is complete after close().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lines = is_jsonl(path)
+        self.f = open_results(path, 'w')
+        self.count = 0
+        if not self.lines:
+            self.f.write('[')
+
+    def write(self, results):
+        for data in results:
+            if self.lines:
+                self.f.write(json.dumps(data) + '\n')
+            else:
+                self.f.write((', ' if self.count > 0 else '') + json.dumps(data))
+            self.count += 1
+
+    def close(self):
+        if self.f is None:
+            return
+        if not self.lines:
+            self.f.write(']')
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# whitespace and commas between the records of a json array
+_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_results(path, chunk_size=1 << 20):
+    '''
+    Streams the results of a file written by ResultWriter (or json.dump of
+    a list), one dict at a time, without loading the whole file.
+    '''
+    with open_results(path) as f:
+        if is_jsonl(path):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        decoder = json.JSONDecoder()
+        buf = f.read(chunk_size).lstrip()
+        if not buf.startswith('['):
+            raise Exception("{} is not a json array".format(path))
+        # records are decoded in place at pos, the consumed prefix is only
+        # dropped when the next chunk is read
+        pos = 1
+        eof = False
+        while True:
+            pos = _SEPARATORS.match(buf, pos).end()
+            if buf.startswith(']', pos):
+                return
+            try:
+                data, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the object continues in the next chunk
+                if eof:
+                    raise Exception("{} is truncated".format(path))
+                chunk = f.read(chunk_size)
+                eof = len(chunk) == 0
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield data
+
+
+def jsonl_to_json(src, dst):
+    ''' converts a result file to the format of dst, e.g. .jsonl.gz to .json '''
+    with ResultWriter(dst) as writer:
+        for data in iter_results(src):
+            writer.write([data])